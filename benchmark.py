@@ -0,0 +1,503 @@
+"""Performance checks for the pathology web app
+
+    python benchmark.py wsgi --workers 1 2 4 --duration 10 --concurrency 16
+    python benchmark.py startup --runs 5
+    python benchmark.py imports --top 15
+    python benchmark.py pipeline --output results.json
+
+pipeline times the report pipeline in-process, offline, on synthetic
+patients: form and report HTML generation, every available PDF backend,
+concurrent report storage and /submit-report through the Flask test
+client. It prints p50/p95/p99 latency, throughput and peak RSS, can save
+them as JSON, and compares them with benchmark_baseline.json; it exits
+with status 1 when a case got slower than the baseline allows.
+
+wsgi starts gunicorn (gunicorn.conf.py) with each worker count in turn
+and drives it with concurrent keep-alive clients. It prints requests per
+second and latency percentiles per worker count.
+
+startup times "single_app.py serve" from launch to the first answered
+request; imports lists the slowest imports of single_app (-X importtime).
+
+Servers run in a scratch directory so the lab database is never touched.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from urllib.parse import urlencode
+
+import requests
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(ROOT, 'benchmark_baseline.json')
+
+# Synthetic data comes from this generator; --seed makes runs repeatable
+RNG = random.Random()
+
+# gunicorn only opens the admin endpoints (e.g. /reports) to this token
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN') or 'benchmark-admin-token'
+
+# A realistic mix of tests from the catalog with plausible results
+SAMPLE_RESULTS = {
+    'Glucose (F)/RI': '96',
+    'Urea': '28',
+    'Creatinine': '0.9',
+    'Cholesterol': '182',
+    'Triglyceride': '140',
+    'HDL': '45',
+    'SGOT/AST': '24',
+    'SGPT/ALT': '31'
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+def synthetic_report():
+    """A report submission for a made-up patient; every call renders a new report"""
+    patient_data = {
+        'name': f"Bench Patient {RNG.randrange(16 ** 8):08x}",
+        'age': str(RNG.randint(1, 90)),
+        'gender': RNG.choice(('Male', 'Female')),
+        'mobile': f"9{RNG.randint(100000000, 999999999)}",
+        'doctor': 'Dr. Bench',
+        'opd_no': str(RNG.randint(10000, 99999)),
+        'sample_date': f"2026-{RNG.randint(1, 12):02d}-{RNG.randint(1, 28):02d}"
+    }
+    # Results scattered around the sample values, as from real patients
+    test_results = {
+        name: f"{float(value) * RNG.uniform(0.7, 1.3):.1f}" for name, value in SAMPLE_RESULTS.items()
+    }
+    return {'patient_data': patient_data, 'test_results': test_results}
+
+
+def fillable_form_path():
+    """The result entry form for a made-up patient and the sample tests"""
+    return '/fillable-form?' + urlencode({
+        'patient_data': json.dumps(synthetic_report()['patient_data']),
+        'selected_tests': json.dumps(list(SAMPLE_RESULTS))
+    })
+
+
+# What one benchmark request does: scenario -> (method, path, json body factory)
+SCENARIOS = {
+    'health': ('GET', '/healthz', None),
+    'form': ('GET', fillable_form_path(), None),
+    'reports': ('GET', '/reports?limit=50', None),
+    'submit': ('POST', '/submit-report', synthetic_report)
+}
+
+
+def start_gunicorn(workers, port, workdir, env=None):
+    """Start gunicorn in workdir and wait until every worker answers; returns the process"""
+    environment = dict(os.environ, **(env or {}))
+    environment['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, environment.get('PYTHONPATH')]))
+    environment['WEB_WORKERS'] = str(workers)
+    environment['ADMIN_TOKEN'] = ADMIN_TOKEN
+    environment.setdefault('NOTIFICATION_WORKERS', '0')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py'),
+         '--bind', f'127.0.0.1:{port}', '--max-requests', '0', 'single_app:create_app()'],
+        cwd=workdir, env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with code {process.returncode}")
+        try:
+            requests.get(f'http://127.0.0.1:{port}/healthz', timeout=1).raise_for_status()
+            # The first answer comes from the fastest worker; give the rest a moment to boot
+            time.sleep(min(workers, 4) * 0.5)
+            return process
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("gunicorn did not become ready in time")
+
+
+def run_load(base_url, scenario, duration, concurrency):
+    """Drive base_url from concurrency client threads for duration seconds"""
+    method, path, make_body = SCENARIOS[scenario]
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client():
+        session = requests.Session()
+        session.headers['X-Admin-Token'] = ADMIN_TOKEN
+        own_latencies, own_errors = [], 0
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                response = session.request(
+                    method, base_url + path, json=make_body() if make_body else None, timeout=30
+                )
+                ok = response.status_code < 400
+            except requests.RequestException:
+                ok = False
+            if ok:
+                own_latencies.append(time.perf_counter() - started)
+            else:
+                own_errors += 1
+        with lock:
+            latencies.extend(own_latencies)
+            errors[0] += own_errors
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 1) if latencies else None,
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 1) if latencies else None
+    }
+
+
+def bench_wsgi(args):
+    print(f"🏁 {args.scenario}: {args.concurrency} clients for {args.duration}s per run")
+    print(f"{'workers':>8} {'requests':>9} {'errors':>7} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8}")
+    results = []
+    for workers in args.workers:
+        with tempfile.TemporaryDirectory(prefix='pathology-bench-') as workdir:
+            port = free_port()
+            process = start_gunicorn(workers, port, workdir)
+            try:
+                result = run_load(f'http://127.0.0.1:{port}', args.scenario, args.duration, args.concurrency)
+            finally:
+                process.terminate()
+                process.wait(timeout=90)
+        result['workers'] = workers
+        results.append(result)
+        print(f"{workers:>8} {result['requests']:>9} {result['errors']:>7} {result['rps']:>8} "
+              f"{result['p50_ms']!s:>8} {result['p95_ms']!s:>8}")
+
+    base = results[0]['rps']
+    if base:
+        print("📈 Scaling vs first run: " + ", ".join(
+            f"{result['workers']} workers x{result['rps'] / base:.2f}" for result in results
+        ))
+    print(f"💻 {os.cpu_count()} CPU(s) available; throughput stops scaling once workers exceed cores")
+    return results
+
+
+def wait_for_first_response(url, process, timeout=60):
+    """Poll url until it answers 200; returns the seconds waited"""
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with code {process.returncode}")
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return time.perf_counter() - started
+        except requests.RequestException:
+            pass
+        time.sleep(0.01)
+    raise RuntimeError(f"no answer from {url} in {timeout}s")
+
+
+def bench_startup(args):
+    """Launch the headless server repeatedly; time to /healthz and to the first page"""
+    print(f"🏁 Cold start of 'single_app.py serve', {args.runs} runs")
+    to_health, to_page = [], []
+    for _ in range(args.runs):
+        with tempfile.TemporaryDirectory(prefix='pathology-bench-') as workdir:
+            port = free_port()
+            started = time.perf_counter()
+            process = subprocess.Popen(
+                [sys.executable, os.path.join(ROOT, 'single_app.py'), 'serve', '--port', str(port)],
+                cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            try:
+                wait_for_first_response(f'http://127.0.0.1:{port}/healthz', process)
+                to_health.append(time.perf_counter() - started)
+                wait_for_first_response(f'http://127.0.0.1:{port}/', process)
+                to_page.append(time.perf_counter() - started)
+            finally:
+                process.terminate()
+                process.wait(timeout=90)
+
+    results = {}
+    for label, values in (('first /healthz', to_health), ('first form page', to_page)):
+        results[label] = {
+            'median_s': round(statistics.median(values), 3),
+            'min_s': round(min(values), 3),
+            'max_s': round(max(values), 3)
+        }
+        print(f"  {label:<16} median {results[label]['median_s']:.3f}s "
+              f"(min {results[label]['min_s']:.3f}s, max {results[label]['max_s']:.3f}s)")
+    return results
+
+
+def import_times(code):
+    """Run code in a fresh interpreter with -X importtime; returns (cumulative_us, self_us, depth, module) tuples"""
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT, capture_output=True, text=True
+    )
+    # "import time: self [us] | cumulative | imported package", nesting shown by indentation
+    timings = []
+    for line in completed.stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)', line)
+        if match:
+            timings.append((int(match.group(2)), int(match.group(1)), len(match.group(3)) // 2, match.group(4)))
+    return timings, completed.stderr
+
+
+def bench_imports(args):
+    """Import single_app in a fresh interpreter with -X importtime and list the slowest imports"""
+    # Modules the bare interpreter loads at startup (site, .pth files) aren't ours
+    interpreter = {name for _, _, _, name in import_times('pass')[0]}
+    timings, stderr = import_times('import single_app')
+    timings = [timing for timing in timings if timing[3] not in interpreter]
+
+    total = next((cumulative for cumulative, _, _, name in timings if name == 'single_app'), None)
+    if total is None:
+        raise RuntimeError(f"import failed:\n{stderr[-2000:]}")
+    print(f"🏁 import single_app: {total / 1000:.1f} ms")
+    print(f"{'cumulative ms':>14} {'self ms':>8}  module (imported directly by single_app)")
+    direct = sorted((timing for timing in timings if timing[2] == 1), reverse=True)
+    for cumulative, own, _, name in direct[:args.top]:
+        print(f"{cumulative / 1000:>14.1f} {own / 1000:>8.1f}  {name}")
+    return {'total_ms': total / 1000, 'imports': {name: cumulative / 1000 for cumulative, _, _, name in direct}}
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process so far, or None where unsupported (Windows)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def measure(operation, iterations, concurrency=1, warmup=3):
+    """Call operation() iterations times from concurrency threads; returns latency and throughput stats"""
+    for _ in range(warmup):
+        operation()
+
+    def timed(_):
+        started = time.perf_counter()
+        operation()
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            latencies = list(pool.map(timed, range(iterations)))
+    else:
+        latencies = [timed(i) for i in range(iterations)]
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'iterations': iterations,
+        'concurrency': concurrency,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'throughput_per_s': round(iterations / elapsed, 1),
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def pipeline_cases(app, single_app, iterations, concurrency):
+    """(name, operation, iterations, concurrency) for every pipeline stage, and {case: reason} for skipped ones"""
+    report = synthetic_report()
+    html_content = app.generate_pdf_html(report['patient_data'], report['test_results'])
+    client = app.flask_app.test_client()
+
+    def store_report():
+        report = synthetic_report()
+        app.store_completed_report(report['patient_data'], report['test_results'], None, None)
+
+    def submit_report():
+        response = client.post('/submit-report', json=synthetic_report())
+        if response.status_code >= 400:
+            raise RuntimeError(f"/submit-report answered {response.status_code}: {response.get_data(as_text=True)}")
+
+    cases = [
+        ('generate_exact_format_html_form',
+         lambda: app.generate_exact_format_html_form(report['patient_data'], list(report['test_results'])),
+         iterations, 1),
+        ('generate_pdf_html',
+         lambda: app.generate_pdf_html(report['patient_data'], report['test_results']),
+         iterations, 1)
+    ]
+    # Each backend on its own, not just the one generate_pdf_bytes would pick
+    skipped = {}
+    for name, probe, render, fallback_only in single_app.PDF_RENDERERS.backends:
+        try:
+            handle = probe()
+        except Exception as e:
+            skipped[f'pdf_backend[{name}]'] = str(e)
+            continue
+        cases.append((f'pdf_backend[{name}]', lambda handle=handle, render=render: render(handle, html_content),
+                      max(iterations // 10, 5), 1))
+    cases.append(('store_completed_report', store_report, iterations, concurrency))
+    cases.append(('submit_report', submit_report, iterations, 1))
+    return cases, skipped
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """Regression messages for cases slower than the baseline by more than tolerance.
+
+    Compares p50 and throughput; the tail percentiles of sub-millisecond
+    cases swing too much between runs to gate on.
+    """
+    regressions = []
+    for name, result in results['cases'].items():
+        before = baseline.get('cases', {}).get(name)
+        if not before:
+            continue
+        if result['p50_ms'] > before['p50_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p50 {before['p50_ms']} ms -> {result['p50_ms']} ms")
+        if result['throughput_per_s'] < before['throughput_per_s'] * (1 - tolerance):
+            regressions.append(
+                f"{name}: throughput {before['throughput_per_s']}/s -> {result['throughput_per_s']}/s"
+            )
+    return regressions
+
+
+def bench_pipeline(args):
+    RNG.seed(args.seed)
+    workdir = tempfile.mkdtemp(prefix='pathology-bench-')
+    cwd = os.getcwd()
+    # Synchronous renders and no message sends: the stages are measured on their own
+    os.environ.update(PDF_RENDER_WORKERS='0', NOTIFICATION_WORKERS='0')
+    os.environ.pop('MESSAGING_MOCK', None)
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    log = open(os.devnull, 'w')
+    with redirect_stdout(log):
+        import single_app
+        app = single_app.PathologyService()
+        app.warmed_up.wait()
+
+    print(f"🏁 Report pipeline, seed {args.seed}, best of {args.repeat} x {args.iterations} iterations per case")
+    print(f"{'case':<34} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'per s':>9} {'rss MB':>7}")
+    results = {
+        'python': sys.version.split()[0],
+        'platform': sys.platform,
+        'cpus': os.cpu_count(),
+        'seed': args.seed,
+        'cases': {}
+    }
+    try:
+        cases, results['skipped'] = pipeline_cases(app, single_app, args.iterations, args.concurrency)
+        for name, operation, iterations, concurrency in cases:
+            with redirect_stdout(log):
+                # Best of several runs, like timeit: slower runs measure other load on the machine
+                runs = [measure(operation, iterations, concurrency) for _ in range(args.repeat)]
+            result = min(runs, key=lambda run: run['p50_ms'])
+            result['throughput_per_s'] = max(run['throughput_per_s'] for run in runs)
+            result['repeat'] = args.repeat
+            results['cases'][name] = result
+            print(f"{name:<34} {result['p50_ms']:>9} {result['p95_ms']:>9} {result['p99_ms']:>9} "
+                  f"{result['throughput_per_s']:>9} {result['peak_rss_mb']!s:>7}")
+    finally:
+        with redirect_stdout(log):
+            app.close()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    results['peak_rss_mb'] = peak_rss_mb()
+    for name, reason in results['skipped'].items():
+        print(f"⏭️ {name} skipped: {reason}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"💾 Results saved to {args.output}")
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"💾 Baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"ℹ️ No baseline at {args.baseline}; run with --save-baseline to create one")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare_with_baseline(results, baseline, args.tolerance)
+    if regressions:
+        print(f"❌ Slower than the baseline by more than {args.tolerance:.0%}:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    print(f"✅ Within {args.tolerance:.0%} of the baseline")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pathology app benchmarks")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    wsgi_parser = commands.add_parser('wsgi', help="requests per second under gunicorn by worker count")
+    wsgi_parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    wsgi_parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='form')
+    wsgi_parser.add_argument('--duration', type=float, default=10)
+    wsgi_parser.add_argument('--concurrency', type=int, default=16)
+
+    startup_parser = commands.add_parser('startup', help="seconds from launch to the first answered request")
+    startup_parser.add_argument('--runs', type=int, default=5)
+
+    imports_parser = commands.add_parser('imports', help="import-time profile of single_app")
+    imports_parser.add_argument('--top', type=int, default=15)
+
+    pipeline_parser = commands.add_parser('pipeline', help="latency, throughput and memory of the report pipeline")
+    pipeline_parser.add_argument('--iterations', type=int, default=500)
+    pipeline_parser.add_argument('--concurrency', type=int, default=8,
+                                 help="threads storing reports at once")
+    pipeline_parser.add_argument('--repeat', type=int, default=3, help="runs per case; the best one counts")
+    pipeline_parser.add_argument('--seed', type=int, default=1)
+    pipeline_parser.add_argument('--output', help="write the results to this JSON file")
+    pipeline_parser.add_argument('--baseline', default=BASELINE_PATH)
+    pipeline_parser.add_argument('--save-baseline', action='store_true',
+                                 help="store these results as the new baseline instead of comparing")
+    pipeline_parser.add_argument('--tolerance', type=float, default=0.5,
+                                 help="allowed slowdown against the baseline, as a fraction")
+    args = parser.parse_args(argv)
+
+    if args.command == 'pipeline':
+        sys.exit(bench_pipeline(args))
+    if args.command == 'wsgi':
+        bench_wsgi(args)
+    elif args.command == 'startup':
+        bench_startup(args)
+    elif args.command == 'imports':
+        bench_imports(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""gunicorn settings for running the pathology web app on a server
+
+    gunicorn -c gunicorn.conf.py 'single_app:create_app()'
+
+Every worker process builds its own PathologyService after the fork. The
+database, report store, render cache and notification queue live on disk,
+so any worker can answer any request. Send the master HUP for a graceful
+reload: new workers start on the new code, old ones finish their
+requests first. TERM stops gracefully, INT/QUIT right away.
+USR2 to a worker (not the master, which upgrades on USR2) writes a stack
+profile of that worker to reports/profiles.
+
+Each worker has its own metrics; they publish them to METRICS_DIR
+(reports/metrics by default) and /metrics sums them all, so a scrape that
+reaches any worker sees the whole server. The directory is emptied when
+gunicorn starts, and counters of recycled workers stay in the sum.
+
+Set ADMIN_TOKEN for the report history, exports, imports, traces and
+profiles: they are only served with it in an X-Admin-Token header, and
+stay closed here without it.
+"""
+import glob
+import multiprocessing
+import os
+
+# HOST / PORT as for "single_app.py serve"; BIND overrides both, e.g. unix:/run/pathology.sock
+bind = os.environ.get('BIND', f"{os.environ.get('HOST', '127.0.0.1')}:{os.environ.get('PORT', '5000')}")
+workers = int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+# A few threads per worker keep status polls answered while a report is being stored
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 4))
+timeout = 120
+graceful_timeout = 60
+keepalive = 5
+# Background threads and SQLite connections don't survive fork, so each
+# worker must import and build the app itself
+preload_app = False
+# Recycle workers now and then to bound memory growth
+max_requests = 1000
+max_requests_jitter = 100
+accesslog = '-'
+
+# The workers split the messaging rate limits between them
+os.environ['WEB_WORKERS'] = str(workers)
+# Requests are already spread over worker processes; one render process each is plenty
+os.environ.setdefault('PDF_RENDER_WORKERS', '1')
+# Workers share their metrics here; relative to the working directory like the report store
+os.environ.setdefault('METRICS_DIR', os.path.join('reports', 'metrics'))
+
+
+def on_starting(server):
+    """Drop the metrics of a previous run; a HUP reload keeps them"""
+    for path in glob.glob(os.path.join(os.environ['METRICS_DIR'], '*.json')):
+        os.remove(path)
+
+
+def worker_exit(server, worker):
+    """Finish queued renders and stop the notification threads before a worker goes away"""
+    app = getattr(worker, 'wsgi', None)
+    service = app.extensions.get('pathology_service') if app is not None else None
+    if service is not None:
+        service.close()
@@ -1,58 +1,3077 @@
-import tkinter as tk
-from tkinter import ttk, messagebox
-import webbrowser
 import os
 from datetime import datetime
 import sqlite3
 import json
 import threading
+import argparse
+import socket
+import queue
+from contextlib import contextmanager
 import time
 import re
-import requests
-from flask import Flask, request, jsonify, send_from_directory, Response
+import random
+import csv
+import io
+import signal
+import hmac
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from flask import Flask, request, jsonify, send_from_directory, Response, g, url_for
 from flask import render_template_string
+from jinja2 import Environment, DictLoader
+from werkzeug.exceptions import HTTPException, NotFound
 import base64
+import hashlib
 import tempfile
+import subprocess
+import uuid
+from collections import namedtuple, OrderedDict
+from types import MappingProxyType
+import multiprocessing
+import itertools
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 
-# Try to import pdfkit, if not available we'll use alternative methods
-try:
-    import pdfkit
-    PDFKIT_AVAILABLE = True
-except ImportError:
-    PDFKIT_AVAILABLE = False
-    print("pdfkit not available. Using alternative PDF generation.")
-
-# Alternative PDF generation using weasyprint - handle import error
-try:
-    # Check if we're on Windows
-    import platform
-    if platform.system() == 'Windows':
-        # On Windows, weasyprint requires GTK which is difficult to install
-        # So we'll skip it and use alternative methods
-        WEASYPRINT_AVAILABLE = False
-        print("WeasyPrint not recommended on Windows. Using alternative methods.")
-    else:
-        from weasyprint import HTML
-        WEASYPRINT_AVAILABLE = True
-except ImportError:
-    WEASYPRINT_AVAILABLE = False
-    print("weasyprint not available. Using HTML fallback.")
-except Exception as e:
-    WEASYPRINT_AVAILABLE = False
-    print(f"Error importing weasyprint: {e}. Using alternative methods.")
-
-# Import for HTML to PDF alternative
 import sys
 
-class PathologyTestsForm(tk.Tk):
+# Renderer and HTTP client libraries are imported on first use, not here:
+# some take seconds to load and most installs use only one of them.
+# PathologyService.warm_up() loads the ones in use in the background.
+
+PDFKIT_OPTIONS = {
+    'page-size': 'A4',
+    'margin-top': '0.5in',
+    'margin-right': '0.5in',
+    'margin-bottom': '0.5in',
+    'margin-left': '0.5in',
+    'encoding': "UTF-8",
+    'no-outline': None,
+    'quiet': ''
+}
+
+WKHTMLTOPDF_PATHS = [
+    '/usr/bin/wkhtmltopdf',
+    '/usr/local/bin/wkhtmltopdf',
+    'C:/Program Files/wkhtmltopdf/bin/wkhtmltopdf.exe',
+    'C:/wkhtmltopdf/bin/wkhtmltopdf.exe'
+]
+
+# A wkhtmltopdf batch gets this long to start plus this long per document
+PDFKIT_BATCH_TIMEOUT = 30
+PDFKIT_BATCH_SECONDS_PER_DOCUMENT = 10
+
+
+# Each backend has a probe, which raises if the backend can't be used and
+# otherwise returns a handle, and a render function taking that handle.
+
+def _probe_weasyprint():
+    if sys.platform == 'win32':
+        # weasyprint needs GTK, which is difficult to install on Windows
+        raise RuntimeError("weasyprint not supported on Windows")
+    from weasyprint import HTML
+    return HTML
+
+
+def _render_weasyprint(HTML, html_content):
+    return HTML(string=html_content, encoding='utf-8').write_pdf()
+
+
+def _probe_pdfkit():
+    import pdfkit
+    for path in WKHTMLTOPDF_PATHS:
+        if os.path.exists(path):
+            return pdfkit.configuration(wkhtmltopdf=path)
+    # Falls back to wkhtmltopdf on PATH, raises if there is none
+    return pdfkit.configuration()
+
+
+def _render_pdfkit(config, html_content):
+    import pdfkit
+    # output_path=False makes wkhtmltopdf write to stdout, so nothing touches the disk
+    return pdfkit.from_string(html_content, False, options=PDFKIT_OPTIONS, configuration=config)
+
+
+def _render_pdfkit_batch(config, html_documents):
+    """Render many documents with one wkhtmltopdf process.
+
+    wkhtmltopdf has no daemon mode, but with --read-args-from-stdin it runs
+    one conversion per stdin line inside a single process. Inputs and
+    outputs have to be files for that, so they go through a temp directory.
+    Returns a list of PDF bytes, None for documents that failed. Raises if
+    wkhtmltopdf times out or exits with an error, like a single render.
+    """
+    binary = config.wkhtmltopdf
+    if isinstance(binary, bytes):
+        binary = binary.decode()
+    
+    args = [binary]
+    for option, value in PDFKIT_OPTIONS.items():
+        args.append(f"--{option}")
+        if value:
+            args.append(value)
+    args.append('--read-args-from-stdin')
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        lines = []
+        output_paths = []
+        for i, html_content in enumerate(html_documents):
+            input_path = os.path.join(tmp_dir, f"report_{i}.html").replace('\\', '/')
+            output_path = os.path.join(tmp_dir, f"report_{i}.pdf").replace('\\', '/')
+            with open(input_path, 'w', encoding='utf-8') as f:
+                f.write(html_content)
+            lines.append(f'"{input_path}" "{output_path}"')
+            output_paths.append(output_path)
+        
+        # A hung wkhtmltopdf is killed and raises TimeoutExpired
+        timeout = PDFKIT_BATCH_TIMEOUT + PDFKIT_BATCH_SECONDS_PER_DOCUMENT * len(html_documents)
+        completed = subprocess.run(
+            args, input='\n'.join(lines) + '\n', capture_output=True, text=True, timeout=timeout
+        )
+        if completed.returncode != 0:
+            print(f"❌ wkhtmltopdf exited with code {completed.returncode}: {completed.stderr.strip()[-2000:]}")
+            raise RuntimeError(f"wkhtmltopdf exited with code {completed.returncode}")
+        
+        results = []
+        for output_path in output_paths:
+            if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+                with open(output_path, 'rb') as f:
+                    results.append(f.read())
+            else:
+                results.append(None)
+        return results
+
+
+def _probe_xhtml2pdf():
+    from xhtml2pdf import pisa
+    return pisa
+
+
+def _render_xhtml2pdf(pisa, html_content):
+    import io
+    
+    # Create a PDF in memory
+    pdf_bytes = io.BytesIO()
+    pisa_status = pisa.CreatePDF(html_content, dest=pdf_bytes)
+    
+    if pisa_status.err:
+        raise Exception("PDF generation failed")
+    
+    return pdf_bytes.getvalue()
+
+
+def _probe_reportlab():
+    from reportlab.lib.pagesizes import letter
+    from reportlab.pdfgen import canvas
+    return canvas, letter
+
+
+def _render_reportlab(handle, html_content):
+    import io
+    canvas, letter = handle
+    
+    # Create a simple PDF with reportlab (the HTML itself is not rendered)
+    pdf_bytes = io.BytesIO()
+    c = canvas.Canvas(pdf_bytes, pagesize=letter)
+    width, height = letter
+    
+    # Add simple text to PDF
+    c.setFont("Helvetica", 12)
+    c.drawString(100, height - 100, "UJJIVAN HOSPITAL PATHOLOGY REPORT")
+    c.drawString(100, height - 120, "Patient Report - HTML version available")
+    c.drawString(100, height - 140, "Please view the HTML report for detailed results")
+    c.save()
+    
+    return pdf_bytes.getvalue()
+
+
+class PdfRendererRegistry:
+    """PDF backends probed once, tried fastest first, with a failure cooldown"""
+
+    # Consecutive failures before a backend is skipped, and for how long
+    FAILURE_THRESHOLD = 3
+    COOLDOWN_SECONDS = 300
+
+    PROBE_HTML = "<html><body><p>UJJIVAN HOSPITAL</p></body></html>"
+
+    def __init__(self):
+        # (name, probe, render, fallback_only); fallback_only backends don't
+        # render the report HTML, so they always go last whatever their speed
+        self.backends = []
+        self.batch_renderers = {}
+        self.available = []
+        self.probe_results = {}
+        self.failures = {}
+        self.open_until = {}
+        self.probed = False
+        self.lock = threading.Lock()
+
+    def register(self, name, probe, render, fallback_only=False, render_batch=None):
+        """Add a backend; must be called before the first probe"""
+        self.backends.append((name, probe, render, fallback_only))
+        if render_batch:
+            self.batch_renderers[name] = render_batch
+
+    def probe(self):
+        """Check every backend once with a tiny test render and order them by speed"""
+        with self.lock:
+            if self.probed:
+                return
+            
+            timed = []
+            for name, probe, render, fallback_only in self.backends:
+                try:
+                    handle = probe()
+                    start = time.perf_counter()
+                    render(handle, self.PROBE_HTML)
+                    elapsed = time.perf_counter() - start
+                except Exception as e:
+                    self.probe_results[name] = f"unavailable: {e}"
+                    continue
+                
+                self.probe_results[name] = f"ok ({elapsed * 1000:.0f} ms)"
+                timed.append((fallback_only, elapsed, name, handle, render))
+            
+            timed.sort(key=lambda backend: (backend[0], backend[1]))
+            self.available = [(name, handle, render) for _, _, name, handle, render in timed]
+            self.probed = True
+            
+            print(f"🖨️ PDF backends: {self.probe_results}")
+
+    def is_open(self, name):
+        return self.open_until.get(name, 0) > time.time()
+
+    def record_failure(self, name):
+        with self.lock:
+            self.failures[name] = self.failures.get(name, 0) + 1
+            if self.failures[name] >= self.FAILURE_THRESHOLD:
+                self.open_until[name] = time.time() + self.COOLDOWN_SECONDS
+                print(f"⚠️ {name} disabled for {self.COOLDOWN_SECONDS}s after {self.failures[name]} failures")
+
+    def record_success(self, name):
+        with self.lock:
+            self.failures.pop(name, None)
+            self.open_until.pop(name, None)
+
+    def active_backend(self):
+        """Name of the backend the next report will be rendered with, or None"""
+        self.probe()
+        for name, handle, render in self.available:
+            if not self.is_open(name):
+                return name
+        return None
+
+    def status(self):
+        self.probe()
+        return {
+            'active': self.active_backend(),
+            'order': [name for name, handle, render in self.available],
+            'probe_results': dict(self.probe_results),
+            'failures': dict(self.failures),
+            'disabled_until': {
+                name: datetime.fromtimestamp(until).isoformat()
+                for name, until in self.open_until.items() if until > time.time()
+            }
+        }
+
+    def render(self, html_content, attempts=None):
+        """Render with the first healthy backend; returns (success, pdf_bytes).
+
+        Pass a list as attempts to get a {backend, outcome, ms} dict
+        appended for every backend tried.
+        """
+        self.probe()
+        for name, handle, render in self.available:
+            if self.is_open(name):
+                continue
+            started = time.perf_counter()
+            try:
+                pdf_bytes = render(handle, html_content)
+            except Exception as e:
+                elapsed = time.perf_counter() - started
+                METRICS.observe('pdf_render_duration_seconds', elapsed, name)
+                METRICS.inc('pdf_renders_total', name, 'failure')
+                if attempts is not None:
+                    attempts.append({'backend': name, 'outcome': 'failure', 'ms': round(elapsed * 1000, 3)})
+                print(f"❌ {name} failed: {e}")
+                self.record_failure(name)
+                continue
+            
+            elapsed = time.perf_counter() - started
+            METRICS.observe('pdf_render_duration_seconds', elapsed, name)
+            METRICS.inc('pdf_renders_total', name, 'success')
+            if attempts is not None:
+                attempts.append({'backend': name, 'outcome': 'success', 'ms': round(elapsed * 1000, 3)})
+            self.record_success(name)
+            print(f"✅ PDF generated successfully with {name}")
+            return True, pdf_bytes
+        
+        # Final fallback - generate HTML file only
+        METRICS.inc('pdf_renders_total', 'html', 'fallback')
+        if attempts is not None:
+            attempts.append({'backend': 'html', 'outcome': 'fallback', 'ms': 0})
+        print("⚠️ No PDF generation method available. Using HTML fallback.")
+        return False, None
+
+    def render_batch(self, html_documents):
+        """Render several documents; returns a list of (success, pdf_bytes).
+
+        Uses the active backend's batch mode when it has one. Documents the
+        batch could not render go through render() one by one.
+        """
+        results = [None] * len(html_documents)
+        name = self.active_backend()
+        if name in self.batch_renderers and len(html_documents) > 1:
+            handle = next(handle for backend, handle, render in self.available if backend == name)
+            started = time.perf_counter()
+            try:
+                batch = self.batch_renderers[name](handle, html_documents)
+                for i, pdf_bytes in enumerate(batch):
+                    if pdf_bytes:
+                        results[i] = (True, pdf_bytes)
+                rendered = sum(1 for r in results if r)
+                # Spread the batch time over its documents, like single renders
+                for _ in range(rendered):
+                    METRICS.observe('pdf_render_duration_seconds', (time.perf_counter() - started) / rendered, name)
+                METRICS.inc('pdf_renders_total', name, 'success', amount=rendered)
+                self.record_success(name)
+                print(f"✅ {sum(1 for r in results if r)}/{len(html_documents)} PDFs generated in one {name} batch")
+            except Exception as e:
+                METRICS.inc('pdf_renders_total', name, 'failure')
+                print(f"❌ {name} batch failed: {e}")
+                self.record_failure(name)
+        
+        for i, html_content in enumerate(html_documents):
+            if results[i] is None:
+                results[i] = self.render(html_content)
+        return results
+
+
+PDF_RENDERERS = PdfRendererRegistry()
+PDF_RENDERERS.register('weasyprint', _probe_weasyprint, _render_weasyprint)
+PDF_RENDERERS.register('pdfkit', _probe_pdfkit, _render_pdfkit, render_batch=_render_pdfkit_batch)
+PDF_RENDERERS.register('xhtml2pdf', _probe_xhtml2pdf, _render_xhtml2pdf)
+PDF_RENDERERS.register('reportlab', _probe_reportlab, _render_reportlab, fallback_only=True)
+
+
+def render_pdf_bytes(html_content, attempts=None):
+    """Generate PDF bytes from HTML content using the best available backend"""
+    try:
+        return PDF_RENDERERS.render(html_content, attempts)
+    except Exception as e:
+        print(f"❌ Error in PDF generation: {e}")
+        return False, None
+
+
+def render_pdf_in_worker(html_content):
+    """render_pdf_bytes for the pool processes.
+
+    Returns (result, metrics, render_info): the metrics recorded while
+    rendering and the timing of the render for the request's trace.
+    """
+    attempts = []
+    started = time.time()
+    result = render_pdf_bytes(html_content, attempts)
+    render_info = {'started': started, 'finished': time.time(), 'attempts': attempts, 'pid': os.getpid()}
+    return result, METRICS.drain(), render_info
+
+
+def render_pdf_batch(html_documents):
+    """Generate PDFs for many documents at once; returns a list of (success, pdf_bytes)"""
+    try:
+        return PDF_RENDERERS.render_batch(html_documents)
+    except Exception as e:
+        print(f"❌ Error in batch PDF generation: {e}")
+        return [(False, None)] * len(html_documents)
+
+
+def _warm_render_worker():
+    """Render a tiny document once so each worker keeps its PDF backend loaded"""
+    try:
+        render_pdf_bytes("<html><body></body></html>")
+    except Exception as e:
+        print(f"⚠️ Render worker warm-up failed: {e}")
+    # Not a real report; keep it out of the render metrics
+    METRICS.drain()
+
+
+class PdfRenderPool:
+    """Render report PDFs in worker processes, out of the Flask request"""
+
+    # Finished jobs are kept this long so the form can still poll their status
+    JOB_TTL_SECONDS = 3600
+
+    def __init__(self, workers, db=None):
+        self.workers = workers
+        # Created on first use: even an idle process pool starts a helper process
+        self.executor = None
+        # Saving the file, WhatsApp and the DB insert run back in this process
+        self.finisher = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="report-finisher")
+        self.jobs = {}
+        self.lock = threading.Lock()
+        # With a database, job status is also kept in render_jobs so any web
+        # worker process can answer a status poll, not just the one that queued it
+        self.db = db
+        self.last_db_prune = 0
+
+    def shutdown(self):
+        """Finish queued renders and their reports, then stop the workers"""
+        if self.executor:
+            self.executor.shutdown(wait=True)
+        self.finisher.shutdown(wait=True)
+
+    def _executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = self._new_executor()
+            return self.executor
+
+    def _new_executor(self):
+        # spawn, not fork: the parent runs Flask threads and a Tk main loop
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_warm_render_worker
+        )
+
+    def submit(self, html_content, on_rendered, trace=None):
+        """Queue a render job and return its id right away.
+
+        on_rendered(pdf_success, pdf_bytes) is called in this process once the
+        worker is done and its return value becomes the job result. The wait
+        and the render are added to trace, which is finished afterwards.
+        """
+        job_id = uuid.uuid4().hex
+        submitted = time.time()
+        future = self._submit_render(html_content)
+
+        with self.lock:
+            self._prune_finished()
+            self.jobs[job_id] = {"status": "queued", "future": future, "created": time.time()}
+        self._save_job(job_id, "queued")
+
+        future.add_done_callback(
+            lambda f: self.finisher.submit(self._finish, job_id, f, on_rendered, trace, submitted)
+        )
+        return job_id
+
+    def start_workers(self):
+        """Start the worker processes now instead of on the first report"""
+        for _ in range(self.workers):
+            self._executor().submit(os.getpid)
+
+    def _submit_render(self, html_content):
+        try:
+            return self._executor().submit(render_pdf_in_worker, html_content)
+        except BrokenProcessPool:
+            print("⚠️ Render pool was broken, starting new workers")
+            self.executor = self._new_executor()
+            return self.executor.submit(render_pdf_in_worker, html_content)
+
+    def _result(self, future):
+        """((pdf_success, pdf_bytes), render_info) of a render; the worker's metrics are added to this process's"""
+        try:
+            result, metrics, render_info = future.result()
+        except Exception as e:
+            print(f"❌ Render worker failed: {e}")
+            return (False, None), None
+        METRICS.merge(metrics)
+        return result, render_info
+
+    def render_many(self, html_documents):
+        """Render documents across all workers; yields (index, (pdf_success, pdf_bytes)) as each finishes"""
+        futures = {self._submit_render(html_content): index for index, html_content in enumerate(html_documents)}
+        for future in as_completed(futures):
+            result, _ = self._result(future)
+            yield futures[future], result
+
+    def _finish(self, job_id, future, on_rendered, trace=None, submitted=None):
+        (pdf_success, pdf_bytes), render_info = self._result(future)
+        if trace is not None and render_info:
+            trace.add('render_wait', submitted, render_info['started'])
+            trace.add('render_pdf', render_info['started'], render_info['finished'],
+                      attempts=render_info['attempts'], pid=render_info['pid'])
+
+        try:
+            result = on_rendered(pdf_success, pdf_bytes)
+            status = "done"
+        except Exception as e:
+            print(f"❌ Error finishing report job {job_id}: {e}")
+            result = {"success": False, "message": f"Server Error: {str(e)}"}
+            status = "failed"
+
+        self._save_job(job_id, status, result)
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                job.update(status=status, result=result, finished=time.time())
+                job.pop("future", None)
+        if trace is not None:
+            trace.finish()
+
+    def _save_job(self, job_id, status, result=None):
+        if self.db is None:
+            return
+        now = time.time()
+        try:
+            with self.db.transaction() as conn:
+                if status == "queued":
+                    conn.execute(
+                        "INSERT INTO render_jobs (job_id, status, created_at) VALUES (?, ?, ?)",
+                        (job_id, status, now)
+                    )
+                else:
+                    conn.execute(
+                        "UPDATE render_jobs SET status = ?, result = ?, finished_at = ? WHERE job_id = ?",
+                        (status, json.dumps(result), now, job_id)
+                    )
+                if now - self.last_db_prune > 60:
+                    self.last_db_prune = now
+                    conn.execute(
+                        "DELETE FROM render_jobs WHERE COALESCE(finished_at, created_at) < ?", (now - self.JOB_TTL_SECONDS,)
+                    )
+        except Exception as e:
+            print(f"⚠️ Could not record render job {job_id}: {e}")
+
+    def _prune_finished(self):
+        cutoff = time.time() - self.JOB_TTL_SECONDS
+        for job_id in [j for j, job in self.jobs.items() if job.get("finished", cutoff) < cutoff]:
+            del self.jobs[job_id]
+
+    def queue_depth(self):
+        """Jobs submitted from this process that are queued or rendering"""
+        with self.lock:
+            return sum(1 for job in self.jobs.values() if job["status"] == "queued")
+
+    def get_status(self, job_id):
+        """Return (status, result) for a job, or (None, None) if it is unknown"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                status = job["status"]
+                if status == "queued" and job["future"].running():
+                    status = "rendering"
+                return status, job.get("result")
+        if self.db is None:
+            return None, None
+
+        # Queued by another web worker process
+        with self.db.connection() as conn:
+            row = conn.execute(
+                "SELECT status, result FROM render_jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None, None
+        return row[0], json.loads(row[1]) if row[1] else None
+
+
+# Every test the lab offers, grouped by report section, with the normal range
+# printed on the form and the report. This is the only place tests are defined.
+TEST_CATEGORIES = (
+    ("BIOCHEMISTRY", (
+        ("Glucose (F)/RI", "70-110 mg/dl"),
+        ("Post Prandial / after 2 Hrs", "Up to 140 mg/dl"),
+        ("HbA1c", "4.5-6.5 %")
+    )),
+    ("RENAL FUNCTION", (
+        ("Urea", "10-40 mg/dl"),
+        ("Creatinine", "0.6-1.4 mg/dl"),
+        ("S. Uric Acid", "2.8-7.0 mg/dl"),
+        ("BUN", "5-20 mg/dl")
+    )),
+    ("LIPID PROFILE", (
+        ("Cholesterol", "150-200 mg/dl"),
+        ("Triglyceride", "0-170 mg/dl"),
+        ("HDL", "30-96 (F)/30-70 (M) mg/dl"),
+        ("LDL", "<100 mg/dl")
+    )),
+    ("LIVER FUNCTION", (
+        ("Bilirubin Total", "0.1-1.2 mg/dl (new born 1.0-12.0)"),
+        ("Bilirubin (Conjugated)", "0.0-0.3 mg/dl"),
+        ("Bilirubin (Unconjugated)", "0.1-1.0 mg/dl"),
+        ("SGOT/AST", "0-35 U/L"),
+        ("SGPT/ALT", "0-40 U/L"),
+        ("Alk. Phosphatase", "175-575 U/L"),
+        ("Total Protein", "6.5-8.0 gm/dl"),
+        ("Albumin", "3.5-5.0 gm/dl"),
+        ("Globulin", "2.3-3.5 gm/dl"),
+        ("A/G Ratio", "1.0-2.5"),
+        ("GGT", "8-60 U/L")
+    )),
+    ("ELECTROLYTES", (
+        ("S. Calcium", "8.8-11.0 mg/dl"),
+        ("S. Sodium", "138-148 meq/l"),
+        ("S. Potassium", "3.8-4.8 meq/l")
+    )),
+    ("OTHER TESTS", (
+        ("Urine Protein (24 Hrs)", "24-120 mg/24 Hrs"),
+        ("Urine micro protein (albumin)", "28-150 mg/24 Hrs"),
+        ("CK-MB", "0-24 U/L"),
+        ("S. Phosphorous", "2.7-4.5 mg/dl"),
+        ("S. Amylase", "0-110 U/L"),
+        ("TROP-T", "Negative")
+    )),
+    ("HAEMATOLOGY", (
+        ("Haemoglobin", "14-18 gm% (M)/12-15 gm% (F)"),
+        ("Total leukocyte count", "4000-10,000/cu mm"),
+        ("Differential WBC count - Polymorphs", "40-75%"),
+        ("Differential WBC count - Lymphocytes", "20-45%"),
+        ("Differential WBC count - Eosinophils", "1-6%"),
+        ("Differential WBC count - Monocytes", "0-10%"),
+        ("Differential WBC count - Basophiles", "0-1%"),
+        ("AEC", "40-500 No/cu mm"),
+        ("E.S.R. (Westergren)", "0-12 mm (F), 0-10 mm (M) at the end of 1st hr."),
+        ("Platelet Count", "1.5-4.5 lac/cu mm"),
+        ("RBC Count", "F=3.5-5.0, M=4.2-5.5 million/cu mm"),
+        ("Reticulocyte count", "2-5% of RBC"),
+        ("Haematocrit/PCV", "M=39-49%, F=33-43%"),
+        ("MCV", "76-100 fl"),
+        ("MCH", "29.5 ± 2.5 pg"),
+        ("MCHC", "32.5 ± 2.5 gm/dl"),
+        ("Malaria Parasite", "Negative"),
+        ("BLOOD GROUP", "Rh = Positive/Negative"),
+        ("Bleeding Time", "2-7 Min. (Ivy's method)"),
+        ("Clotting Time", "6 Min. (Lee & White, 37°C)"),
+        ("Prothrombin Time", "10-14 Sec."),
+        ("PERIPHERAL BLOOD SMEAR - RBC", "Normal morphology"),
+        ("PERIPHERAL BLOOD SMEAR - WBC", "Normal morphology"),
+        ("PERIPHERAL BLOOD SMEAR - PLATELET", "Adequate"),
+        ("PERIPHERAL BLOOD SMEAR - HAEMOPARASITE", "Negative")
+    )),
+    ("SEROLOGY", (
+        ("HbsAg", "Negative"),
+        ("HIV (1+2)", "Negative"),
+        ("HCV", "Negative"),
+        ("VDRL", "Non-reactive"),
+        ("ASO Titer", "<200 IU/ml"),
+        ("R.A. factor", "<20 IU/ml"),
+        ("CRP", "<6 mg/L"),
+        ("Gravindex (PREGNANCY)", "Negative"),
+        ("WIDAL TEST - S. Typhi, 'O'", "Negative (<1:80)"),
+        ("WIDAL TEST - S. Typhi, 'H'", "Negative (<1:160)"),
+        ("WIDAL TEST - S. Paratyphi, 'AH'", "Negative (<1:80)"),
+        ("WIDAL TEST - S. Paratyphi, 'BH'", "Negative (<1:80)"),
+        ("Dengue NS1", "Negative"),
+        ("Typhi Dot", "Negative")
+    ))
+)
+
+TestInfo = namedtuple('TestInfo', 'name category normal_range units low high slug reference')
+
+# One band of a reference range; sex is 'M', 'F' or None for both, ages are
+# in years and None means unbounded
+RangeBand = namedtuple('RangeBand', 'low high sex min_age max_age')
+
+# A parsed normal range. expected is the normal text result ('negative',
+# 'adequate', ...) for qualitative tests, max_titre the highest normal
+# dilution for titre tests such as "Negative (<1:80)"
+ReferenceRange = namedtuple('ReferenceRange', 'bands units expected max_titre')
+
+NEWBORN_MAX_AGE = 28 / 365
+
+# Panic values outside which a result is flagged critical, not just high/low
+CRITICAL_LIMITS = {
+    "Glucose (F)/RI": (40, 400),
+    "S. Sodium": (120, 160),
+    "S. Potassium": (2.5, 6.5),
+    "S. Calcium": (6.0, 13.0),
+    "Haemoglobin": (7.0, 20.0),
+    "Total leukocyte count": (2000, 30000),
+    "Platelet Count": (0.2, 10.0)
+}
+
+_NUMBER = r'\d[\d,]*(?:\.\d+)?'
+# Units may contain digits ("mg/24 Hrs") as long as they don't start another range
+_UNITS = r'(?:[^\d(),=]|\d(?![\d.,]*\s*(?:-|to)\s*\d))*'
+_RANGE_BAND = re.compile(
+    r'(?:(?P<sex_before>[MF])\s*=\s*)?(?P<low>' + _NUMBER + r')\s*(?:-|to)\s*(?P<high>' + _NUMBER + r')'
+    r'\s*(?P<units>' + _UNITS + r')(?:\((?P<sex_after>[MF])\))?'
+)
+_UPPER_LIMIT = re.compile(r'^(?:Up to|<)\s*(?P<high>' + _NUMBER + r')\s*(?P<units>' + _UNITS + r')')
+_PLUS_MINUS = re.compile(r'^(?P<mid>' + _NUMBER + r')\s*±\s*(?P<delta>' + _NUMBER + r')\s*(?P<units>.*)$')
+_NEWBORN = re.compile(r'\(new born (?P<low>' + _NUMBER + r')-(?P<high>' + _NUMBER + r')\)')
+_TITRE = re.compile(r'<\s*1:(?P<titre>\d+)')
+_RESULT_NUMBER = re.compile(r'^[<>]?\s*(' + _NUMBER + r')')
+_RESULT_TITRE = re.compile(r'1\s*:\s*(\d+)')
+_AGE = re.compile(r'(?P<value>\d+(?:\.\d+)?)\s*(?P<unit>[a-z]*)')
+
+_ABNORMAL_WORDS = ('positive', 'reactive', 'abnormal', 'high', 'low', 'inadequate')
+_NEGATED_WORDS = ('non-reactive', 'non reactive', 'nonreactive')
+
+
+# Marker printed next to a flagged result on the report
+FLAG_LABELS = {
+    'low': 'L',
+    'high': 'H',
+    'critical_low': 'Critical L',
+    'critical_high': 'Critical H'
+}
+
+
+def _number(text):
+    return float(text.replace(',', ''))
+
+
+def parse_reference_range(normal_range):
+    """Compile a normal range string such as "30-96 (F)/30-70 (M) mg/dl" into a ReferenceRange"""
+    text = normal_range.strip()
+    bands = []
+    
+    # Qualitative results, e.g. "Negative", "Non-reactive", "Negative (<1:80)"
+    if not text[:1].isdigit() and not text.startswith(('<', 'Up to', 'M=', 'F=')):
+        if text.startswith('Rh'):
+            # Blood group: every answer is normal
+            return ReferenceRange((), '', 'any', None)
+        titre = _TITRE.search(text)
+        expected = text.split('(')[0].strip().lower()
+        return ReferenceRange((), '', expected, int(titre.group('titre')) if titre else None)
+    
+    # Age band for newborns, e.g. "0.1-1.2 mg/dl (new born 1.0-12.0)"
+    newborn = _NEWBORN.search(text)
+    if newborn:
+        bands.append(RangeBand(_number(newborn.group('low')), _number(newborn.group('high')), None, 0, NEWBORN_MAX_AGE))
+        text = text[:newborn.start()] + text[newborn.end():]
+    
+    plus_minus = _PLUS_MINUS.match(text)
+    if plus_minus:
+        mid, delta = _number(plus_minus.group('mid')), _number(plus_minus.group('delta'))
+        bands.append(RangeBand(round(mid - delta, 6), round(mid + delta, 6), None, None, None))
+        return ReferenceRange(tuple(bands), plus_minus.group('units').strip(), None, None)
+    
+    upper = _UPPER_LIMIT.match(text)
+    if upper:
+        bands.append(RangeBand(None, _number(upper.group('high')), None, None, None))
+        return ReferenceRange(tuple(bands), upper.group('units').strip(), None, None)
+    
+    units = ''
+    last_end = None
+    for match in _RANGE_BAND.finditer(text):
+        sex = match.group('sex_before') or match.group('sex_after')
+        bands.append(RangeBand(_number(match.group('low')), _number(match.group('high')), sex, None, None))
+        units = units or match.group('units').strip()
+        last_end = match.end()
+    
+    if not units and last_end is not None:
+        # Shared units after the last band, e.g. "30-96 (F)/30-70 (M) mg/dl"
+        units = text[last_end:].strip(' ,/')
+    return ReferenceRange(tuple(bands), units, None, None)
+
+
+def _patient_sex(gender):
+    gender = str(gender or '').strip().upper()
+    return gender[0] if gender[:1] in ('M', 'F') else None
+
+
+def _age_in_years(age):
+    """Parse ages such as "45", "45 years", "6 months" or "10 days"; None if unreadable"""
+    match = _AGE.search(str(age or '').lower())
+    if not match:
+        return None
+    value, unit = float(match.group('value')), match.group('unit')
+    if unit.startswith('d'):
+        return value / 365
+    if unit.startswith('w'):
+        return value / 52
+    if unit.startswith('m'):
+        return value / 12
+    return value
+
+
+def _bounds_for(reference, sex, age_years):
+    """Pick the (low, high) that applies to this patient, or None"""
+    if age_years is not None:
+        aged = [band for band in reference.bands
+                if band.max_age is not None and band.min_age <= age_years < band.max_age]
+        if aged:
+            return aged[0].low, aged[0].high
+    
+    bands = [band for band in reference.bands if band.max_age is None]
+    if sex:
+        bands = [band for band in bands if band.sex in (None, sex)] or bands
+    if not bands:
+        return None
+    
+    # Unknown sex with sex-specific bands: only flag what is outside all of them
+    lows = [band.low for band in bands]
+    highs = [band.high for band in bands]
+    return (None if None in lows else min(lows)), (None if None in highs else max(highs))
+
+
+def classify_result(test_name, result, sex=None, age_years=None):
+    """Flag one result: 'normal', 'low', 'high', 'critical_low', 'critical_high',
+    'abnormal' (qualitative) or None when it can't be judged"""
+    test = TEST_CATALOG.get(test_name)
+    result_text = str(result).strip().lower()
+    if test and test.reference.expected == 'any':
+        return 'normal'
+    
+    numeric = _RESULT_NUMBER.match(result_text)
+    if test and test.reference.bands and numeric:
+        bounds = _bounds_for(test.reference, sex, age_years)
+        if bounds:
+            value = _number(numeric.group(1))
+            low, high = bounds
+            critical_low, critical_high = CRITICAL_LIMITS.get(test_name, (None, None))
+            if critical_low is not None and value < critical_low:
+                return 'critical_low'
+            if critical_high is not None and value > critical_high:
+                return 'critical_high'
+            if low is not None and value < low:
+                return 'low'
+            if high is not None and value > high:
+                return 'high'
+            return 'normal'
+    
+    if test and test.reference.max_titre:
+        titre = _RESULT_TITRE.search(result_text)
+        if titre:
+            return 'high' if int(titre.group(1)) >= test.reference.max_titre else 'normal'
+    
+    for word in _NEGATED_WORDS:
+        result_text = result_text.replace(word, '')
+    if any(word in result_text for word in _ABNORMAL_WORDS):
+        return 'abnormal'
+    return 'normal' if test and (test.reference.expected or test.reference.bands) else None
+
+
+def classify_report(patient_data, test_results):
+    """Flag every result of a report in one pass; returns {test_name: flag}"""
+    sex = _patient_sex(patient_data.get('gender'))
+    age_years = _age_in_years(patient_data.get('age'))
+    return {test_name: classify_result(test_name, result, sex, age_years)
+            for test_name, result in test_results.items()}
+
+
+def _test_slug(test_name):
+    """Stable HTML id for a test, e.g. "Glucose (F)/RI" -> "glucose_f_ri" """
+    return re.sub(r'[^a-z0-9]+', '_', test_name.lower()).strip('_')
+
+
+def _build_test_catalog():
+    catalog = {}
+    for category, tests in TEST_CATEGORIES:
+        for test_name, normal_range in tests:
+            reference = parse_reference_range(normal_range)
+            # Plain low/high only when one band covers everybody
+            general = [band for band in reference.bands if band.sex is None and band.max_age is None]
+            low, high = (general[0].low, general[0].high) if len(general) == 1 else (None, None)
+            catalog[test_name] = TestInfo(
+                test_name, category, normal_range, reference.units, low, high, _test_slug(test_name), reference
+            )
+    
+    if len({test.slug for test in catalog.values()}) != len(catalog):
+        raise ValueError("Test names must have unique slugs")
+    return MappingProxyType(catalog)
+
+
+# Test name -> TestInfo, built once at import
+TEST_CATALOG = _build_test_catalog()
+
+# Report pages are Jinja2 templates compiled once at import. Autoescaping is
+# off so the output stays exactly what the old f-string builders produced.
+
+FILLABLE_FORM_CSS = '''    body {
+      background: #f8f9fa;
+      font-family: 'Times New Roman', serif;
+    }
+
+    .report-container {
+      background: #fff;
+      border: 2px solid #000;
+      padding: 40px 50px;
+      max-width: 900px;
+      margin: 30px auto;
+      box-shadow: 0 0 10px rgba(0,0,0,0.15);
+    }
+
+    .header {
+      text-align: center;
+      border-bottom: 2px solid #000;
+      margin-bottom: 15px;
+      padding-bottom: 8px;
+    }
+
+    .header h2 {
+      font-weight: bold;
+      text-transform: uppercase;
+      color: #003366;
+    }
+
+    .hospital-info {
+      font-size: 13px;
+    }
+
+    .patient-info {
+      font-size: 14px;
+      margin-bottom: 15px;
+    }
+
+    .section-title {
+      background: #e8f0ff;
+      color: #003366;
+      font-weight: bold;
+      border: 1px solid #003366;
+      padding: 6px 8px;
+      text-transform: uppercase;
+      margin-top: 20px;
+    }
+
+    table {
+      width: 100%;
+      border-collapse: collapse;
+      margin-bottom: 10px;
+      font-size: 14px;
+    }
+
+    th, td {
+      border: 1px solid #666;
+      padding: 6px;
+    }
+
+    th {
+      background: #e9ecef;
+      text-align: center;
+    }
+
+    input.result {
+      border: none;
+      border-bottom: 1px solid #888;
+      width: 100%;
+      outline: none;
+      text-align: center;
+      background: #fefefe;
+      font-weight: bold;
+    }
+
+    .footer {
+      text-align: right;
+      margin-top: 40px;
+      font-weight: bold;
+    }
+
+    @media print {
+      body {
+        background: white;
+      }
+      .report-container {
+        box-shadow: none;
+        border: 1px solid #000;
+        margin: 0;
+      }
+      input.result {
+        border: none;
+      }
+    }
+'''
+
+FILLABLE_FORM_TEMPLATE = '''<!DOCTYPE html>
+<html lang="en">
+<head>
+  <meta charset="UTF-8">
+  <title>UJJIVAN Hospital Pathology Report</title>
+  <meta name="viewport" content="width=device-width, initial-scale=1">
+  <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/css/bootstrap.min.css" rel="stylesheet">
+
+  <style>
+{% include 'fillable_form.css' %}
+  </style>
+</head>
+<body>
+
+  <div class="report-container">
+
+    <div class="header">
+      <h2>Pathology Test Report</h2>
+      <div class="hospital-info">
+        <p>UJJIVAN Hospital, Vidyut Nagar, Gautam Budh Nagar, Uttar Pradesh - 201008</p>
+      </div>
+    </div>
+
+    <div class="row patient-info">
+      <div class="col-6">
+        <strong>OPD No:</strong> <input type="text" class="result" placeholder="" value="{{ patient_data['opd_no'] }}" id="opd_no"><br>
+        <strong>Patient Name:</strong> <input type="text" class="result" placeholder="" value="{{ patient_data['name'] }}" id="patient_name"><br>
+        <strong>Age/Sex:</strong> <input type="text" class="result" placeholder="" value="{{ patient_data['age'] }}/{{ patient_data['gender'] }}" id="age_gender">
+      </div>
+      <div class="col-6 text-end">
+        <strong>Doctor Name:</strong> <input type="text" class="result" placeholder="" value="{{ patient_data['doctor'] }}" id="doctor_name"><br>
+        <strong>Sample Date:</strong> <input type="text" class="result" placeholder="" value="{{ patient_data['sample_date'] }}" id="sample_date">
+      </div>
+    </div>
+{% for section in sections %}
+
+    <!-- {{ section.category }} -->
+    <div class="section-title">{{ section.category }}</div>
+    <table>
+      <thead>
+        <tr>
+          <th>S.No</th>
+          <th>Test Description</th>
+          <th>Normal Value</th>
+          <th>Result Value</th>
+        </tr>
+      </thead>
+      <tbody>
+{% for row in section.rows %}
+        <tr><td>{{ row.serial_no }}</td><td>{{ row.test_name }}</td><td>{{ row.normal_value }}</td><td><input type="text" class="result" placeholder="Enter value" name="{{ row.test_name }}" id="{{ row.html_id }}"></td></tr>
+{% endfor %}
+      </tbody>
+    </table>
+{% endfor %}
+
+    <div class="footer">
+      Signature<br>(Pathologist)
+    </div>
+
+    <!-- ✅ Submit Button -->
+    <div class="d-grid gap-2 d-md-flex justify-content-md-end mt-4">
+      <button type="button" class="btn btn-success me-md-2" onclick="submitForm()">
+        ✅ Submit & Send WhatsApp Report
+      </button>
+      <button type="reset" class="btn btn-secondary">Clear Form</button>
+    </div>
+
+  </div>
+
+  <script>
+    function pollReportStatus(statusUrl) {
+      return fetch(statusUrl)
+        .then(response => response.json())
+        .then(data => {
+          if (data.status === 'queued' || data.status === 'rendering') {
+            return new Promise(resolve => setTimeout(resolve, 1000))
+              .then(() => pollReportStatus(statusUrl));
+          }
+          return data;
+        });
+    }
+
+    function submitForm() {
+      const inputs = document.querySelectorAll('input.result');
+      const testResults = {};
+      
+      inputs.forEach(input => {
+        if (input.value.trim() !== '' && input.name) {
+          testResults[input.name] = input.value;
+        }
+      });
+      
+      // Validate that at least one test result is entered
+      if (Object.keys(testResults).length === 0) {
+        alert('Please enter at least one test result.');
+        return;
+      }
+      
+      const submissionData = {
+        patient_data: {
+          name: "{{ patient_data['name'] }}",
+          age: "{{ patient_data['age'] }}",
+          gender: "{{ patient_data['gender'] }}",
+          mobile: "{{ patient_data['mobile'] }}",
+          doctor: "{{ patient_data['doctor'] }}",
+          opd_no: "{{ patient_data['opd_no'] }}",
+          sample_date: "{{ patient_data['sample_date'] }}"
+        },
+        test_results: testResults
+      };
+      
+      console.log('Submitting data:', submissionData);
+      
+      fetch('/submit-report', {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+        },
+        body: JSON.stringify(submissionData)
+      })
+      .then(response => {
+        if (!response.ok) {
+          // Try to parse error response as JSON first
+          return response.json().then(err => {
+            throw new Error(err.message || 'HTTP error ' + response.status);
+          }).catch(() => {
+            throw new Error('HTTP error ' + response.status);
+          });
+        }
+        return response.json();
+      })
+      .then(data => {
+        // PDF is rendered by a worker; wait for the job to finish
+        if (data.success && data.job_id) {
+          return pollReportStatus(data.status_url);
+        }
+        return data;
+      })
+      .then(data => {
+        if (data.success) {
+          alert('✅ Report submitted successfully!\\\\n\\\\n' + data.message + '\\\\n\\\\nWhatsApp Status: ' + data.whatsapp_message + '\\\\n\\\\nThe patient will receive this link to view their report:\\\\n' + data.pdf_url);
+          if (data.pdf_url) {
+            window.open(data.pdf_url, '_blank');
+          }
+        } else {
+          alert('❌ Error: ' + data.message);
+        }
+      })
+      .catch(error => {
+        alert('❌ Error submitting form: ' + error);
+        console.error('Error:', error);
+      });
+    }
+  </script>
+</body>
+</html>'''
+
+PDF_REPORT_CSS = '''                body { 
+                    font-family: 'Times New Roman', serif; 
+                    margin: 20px;
+                    line-height: 1.4;
+                }
+                .header { 
+                    text-align: center; 
+                    border-bottom: 2px solid #000; 
+                    padding-bottom: 10px; 
+                    margin-bottom: 20px; 
+                }
+                .header h1 {
+                    color: #003366;
+                    margin-bottom: 5px;
+                    font-size: 24px;
+                }
+                .patient-info { 
+                    margin-bottom: 20px;
+                    background: #f8f9fa;
+                    padding: 15px;
+                    border-radius: 5px;
+                    border: 1px solid #ddd;
+                }
+                .patient-info p {
+                    margin: 5px 0;
+                    font-size: 14px;
+                }
+                .section { 
+                    margin-bottom: 20px; 
+                }
+                .section-title { 
+                    background: #003366; 
+                    color: white; 
+                    padding: 8px 12px; 
+                    font-weight: bold;
+                    border-radius: 3px;
+                    margin-bottom: 10px;
+                    font-size: 16px;
+                }
+                table { 
+                    width: 100%; 
+                    border-collapse: collapse; 
+                    margin-bottom: 15px;
+                    font-size: 12px;
+                }
+                th, td { 
+                    border: 1px solid #000; 
+                    padding: 8px; 
+                    text-align: left; 
+                }
+                th { 
+                    background: #e9ecef; 
+                    font-weight: bold;
+                    font-size: 13px;
+                }
+                .normal-range {
+                    color: #666;
+                    font-size: 11px;
+                }
+                .footer {
+                    margin-top: 40px; 
+                    text-align: right;
+                    border-top: 1px solid #000;
+                    padding-top: 20px;
+                }
+                .abnormal {
+                    color: #dc3545;
+                    font-weight: bold;
+                }
+                .normal {
+                    color: #28a745;
+                }
+                .hospital-info {
+                    font-size: 12px;
+                    color: #666;
+                }
+                @media print {
+                    body { margin: 0; padding: 10px; }
+                    .header { border-bottom: 2px solid #000; }
+                }
+'''
+
+PDF_REPORT_TEMPLATE = '''
+        <!DOCTYPE html>
+        <html>
+        <head>
+            <meta charset="UTF-8">
+            <style>
+{% include 'pdf_report.css' %}
+            </style>
+        </head>
+        <body>
+            <div class="header">
+                <h1>UJJIVAN HOSPITAL PATHOLOGY REPORT</h1>
+                <div class="hospital-info">
+                    <p>Vidyut Nagar, Gautam Budh Nagar, Uttar Pradesh - 201008</p>
+                    <p>Phone: [Hospital Phone] | Email: [Hospital Email]</p>
+                </div>
+            </div>
+            
+            <div class="patient-info">
+                <p><strong>Patient Name:</strong> {{ patient_data.get('name', '') }}</p>
+                <p><strong>Age/Gender:</strong> {{ patient_data.get('age', '') }}/{{ patient_data.get('gender', '') }}</p>
+                <p><strong>Mobile:</strong> {{ patient_data.get('mobile', '') }}</p>
+                <p><strong>Doctor:</strong> {{ patient_data.get('doctor', '') }}</p>
+                <p><strong>OPD No:</strong> {{ patient_data.get('opd_no', '') }}</p>
+                <p><strong>Sample Date:</strong> {{ patient_data.get('sample_date', '') }}</p>
+                <p><strong>Report Date:</strong> {{ report_date }}</p>
+            </div>
+            
+            <div class="section">
+                <div class="section-title">TEST RESULTS</div>
+                <table>
+                    <tr>
+                        <th width="40%">Test Name</th>
+                        <th width="30%">Normal Range</th>
+                        <th width="30%">Result</th>
+                    </tr>
+        
+{% for section in sections %}
+                    <tr>
+                        <td colspan="3" style="background: #e8f0ff; font-weight: bold; text-align: center; font-size: 14px;">
+                            {{ section.category }}
+                        </td>
+                    </tr>
+                
+{% for row in section.rows %}
+                    <tr>
+                        <td>{{ row.serial_no }}. {{ row.test_name }}</td>
+                        <td><span class="normal-range">{{ row.normal_range }}</span></td>
+                        <td class="{{ row.status_class }}"><strong>{{ row.result }}</strong>{% if row.flag_label %} ({{ row.flag_label }}){% endif %}</td>
+                    </tr>
+                    
+{% endfor %}
+{% endfor %}
+                </table>
+            </div>
+            
+            <div class="footer">
+                <p><strong>Signature</strong></p>
+                <p>_________________________</p>
+                <p>(Pathologist)</p>
+                <p>UJJIVAN Hospital Pathology Department</p>
+                <p>License No: [Pathology License Number]</p>
+            </div>
+            
+            <div style="margin-top: 20px; font-size: 10px; color: #666; text-align: center; border-top: 1px solid #eee; padding-top: 10px;">
+                <p>This is a computer generated report. For any queries, please contact the laboratory.</p>
+                <p>Report ID: {{ report_id }} | Generated on: {{ generated_on }}</p>
+            </div>
+        </body>
+        </html>
+        '''
+
+REPORT_TEMPLATES = Environment(
+    loader=DictLoader({
+        'fillable_form.css': FILLABLE_FORM_CSS,
+        'fillable_form.html': FILLABLE_FORM_TEMPLATE,
+        'pdf_report.css': PDF_REPORT_CSS,
+        'pdf_report.html': PDF_REPORT_TEMPLATE
+    }),
+    trim_blocks=True,
+    lstrip_blocks=True,
+    keep_trailing_newline=True,
+    autoescape=False
+)
+# Templates are compiled on first use and then cached by the environment
+
+
+def _write_atomic(path, data):
+    """Write bytes through a temp file in the same directory and rename it into place"""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        # Atomic on the same filesystem
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+REPORT_STORE_DIR = os.path.join('reports', 'store')
+# Reports saved before the store existed; still served by /view-pdf
+LEGACY_REPORTS_DIR = os.path.join('reports', 'completed_reports')
+
+_STORE_KEY = re.compile(r'^(?P<digest>[0-9a-f]{64})\.(?:pdf|html)$')
+
+
+class ReportStore:
+    """Content-addressed report files.
+
+    A report is saved as <sha256>.<ext> under two levels of shard
+    directories taken from the hash (ab/cd/abcd....pdf), so no directory
+    grows past a few hundred entries and identical renders share one file.
+    Writes go to a temp file in the target directory and are renamed into
+    place, so readers never see a half-written report.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def directory_for(self, key):
+        """Shard directory of a key; raises ValueError for anything that isn't a store key"""
+        match = _STORE_KEY.match(key)
+        if not match:
+            raise ValueError(f'Invalid report key: {key}')
+        digest = match.group('digest')
+        return os.path.join(self.root, digest[:2], digest[2:4])
+
+    def path_for(self, key):
+        return os.path.join(self.directory_for(key), key)
+
+    def put(self, data, extension):
+        """Save bytes unless the same content is already stored; returns (key, path)"""
+        key = f"{hashlib.sha256(data).hexdigest()}.{extension}"
+        path = self.path_for(key)
+        if os.path.exists(path):
+            return key, path
+        
+        # A concurrent writer of the same key writes the same bytes
+        _write_atomic(path, data)
+        return key, path
+
+
+# Rendered reports kept by RenderCache, in memory and on disk
+RENDER_CACHE_DIR = os.path.join('reports', 'render_cache')
+RENDER_CACHE_MEMORY_MB = 64
+RENDER_CACHE_DISK_MB = 512
+
+# Changes whenever the report template or the reference ranges behind the
+# flags change, so cached renders of the old layout are never served
+REPORT_TEMPLATE_VERSION = hashlib.sha256(
+    (PDF_REPORT_TEMPLATE + PDF_REPORT_CSS + repr(TEST_CATEGORIES)).encode('utf-8')
+).hexdigest()[:16]
+
+
+def render_cache_key(patient_data, test_results):
+    """Canonical hash of everything a rendered report depends on"""
+    canonical = json.dumps(
+        [REPORT_TEMPLATE_VERSION, patient_data, test_results],
+        sort_keys=True, separators=(',', ':'), ensure_ascii=False
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class RenderCache:
+    """LRU cache of rendered reports keyed by render_cache_key.
+
+    Entries are (html_content, pdf_bytes); pdf_bytes is None when only the
+    HTML could be produced, so the PDF render is retried on the next hit.
+    Every entry is written to disk, and the most recently used ones are
+    also kept in memory. Each tier evicts least recently used entries once
+    it is over its byte budget.
+    """
+
+    def __init__(self, directory, max_memory_bytes, max_disk_bytes):
+        self.directory = directory
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()  # key -> (html_content, pdf_bytes)
+        self.memory_bytes = 0
+        self.disk = OrderedDict()  # key -> bytes on disk
+        self.disk_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._load_disk_index()
+
+    def _paths(self, key):
+        return os.path.join(self.directory, f'{key}.html'), os.path.join(self.directory, f'{key}.pdf')
+
+    def _load_disk_index(self):
+        """Rebuild the disk LRU from file modification times"""
+        os.makedirs(self.directory, exist_ok=True)
+        entries = {}
+        for entry in os.scandir(self.directory):
+            key, extension = os.path.splitext(entry.name)
+            if extension in ('.html', '.pdf') and entry.is_file():
+                stat = entry.stat()
+                size, mtime = entries.get(key, (0, 0))
+                entries[key] = (size + stat.st_size, max(mtime, stat.st_mtime))
+        
+        for key, (size, mtime) in sorted(entries.items(), key=lambda item: item[1][1]):
+            self.disk[key] = size
+            self.disk_bytes += size
+        self._evict_disk()
+
+    def _read_disk(self, key):
+        html_path, pdf_path = self._paths(key)
+        try:
+            with open(html_path, 'r', encoding='utf-8') as f:
+                html_content = f.read()
+            pdf_bytes = None
+            if os.path.exists(pdf_path):
+                with open(pdf_path, 'rb') as f:
+                    pdf_bytes = f.read()
+            # Keeps the LRU order across restarts
+            os.utime(html_path)
+            return html_content, pdf_bytes
+        except OSError:
+            return None
+
+    def _remember(self, key, entry):
+        """Put an entry at the front of the memory tier; call with the lock held"""
+        size = len(entry[0]) + len(entry[1] or b'')
+        if key in self.memory:
+            old = self.memory.pop(key)
+            self.memory_bytes -= len(old[0]) + len(old[1] or b'')
+        if size > self.max_memory_bytes:
+            return
+        self.memory[key] = entry
+        self.memory_bytes += size
+        while self.memory_bytes > self.max_memory_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted[0]) + len(evicted[1] or b'')
+
+    def _evict_disk(self):
+        """Drop least recently used files until under budget; call with the lock held"""
+        while self.disk_bytes > self.max_disk_bytes and self.disk:
+            key, size = self.disk.popitem(last=False)
+            self.disk_bytes -= size
+            for path in self._paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def get(self, key):
+        """(html_content, pdf_bytes) for a cached report, or None"""
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                if key in self.disk:
+                    self.disk.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+            on_disk = key in self.disk
+        
+        # Not in this process's index may still mean another web worker wrote it
+        entry = self._read_disk(key)
+        with self.lock:
+            if entry:
+                self.hits += 1
+                if key in self.disk:
+                    self.disk.move_to_end(key)
+                else:
+                    self.disk[key] = len(entry[0].encode('utf-8')) + len(entry[1] or b'')
+                    self.disk_bytes += self.disk[key]
+                self._remember(key, entry)
+            else:
+                self.misses += 1
+                if on_disk and key in self.disk:
+                    # Unreadable entry: forget it and remove what is left of it
+                    self.disk_bytes -= self.disk.pop(key)
+                    for path in self._paths(key):
+                        try:
+                            os.remove(path)
+                        except OSError:
+                            pass
+        return entry
+
+    def put(self, key, html_content, pdf_bytes=None):
+        """Cache a render; a cached PDF is never replaced by an HTML-only entry"""
+        with self.lock:
+            current = self.memory.get(key)
+            if current and (current[1] or not pdf_bytes):
+                self.memory.move_to_end(key)
+                return
+        
+        html_path, pdf_path = self._paths(key)
+        html_data = html_content.encode('utf-8')
+        try:
+            # The PDF goes first: an entry exists once its HTML file does
+            if pdf_bytes:
+                _write_atomic(pdf_path, pdf_bytes)
+            _write_atomic(html_path, html_data)
+        except OSError as e:
+            print(f"⚠️ Could not write render cache entry: {e}")
+            with self.lock:
+                self._remember(key, (html_content, pdf_bytes or None))
+            return
+        
+        with self.lock:
+            self._remember(key, (html_content, pdf_bytes or None))
+            self.disk_bytes -= self.disk.pop(key, 0)
+            self.disk[key] = len(html_data) + len(pdf_bytes or b'')
+            self.disk_bytes += self.disk[key]
+            self._evict_disk()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+                'memory_entries': len(self.memory),
+                'memory_bytes': self.memory_bytes,
+                'max_memory_bytes': self.max_memory_bytes,
+                'disk_entries': len(self.disk),
+                'disk_bytes': self.disk_bytes,
+                'max_disk_bytes': self.max_disk_bytes
+            }
+
+
+DB_PATH = 'pathology_reports.db'
+DB_POOL_SIZE = 8
+DB_BUSY_TIMEOUT_MS = 5000
+
+
+class SQLiteConnectionPool:
+    """Pooled SQLite connections shared by the Flask threads.
+
+    Each connection is used by one thread at a time, so cursors are never
+    shared. WAL journaling lets report reads run while a submission is
+    writing, and the busy timeout makes concurrent writers wait instead of
+    failing. Connections live as long as the pool, so sqlite3's
+    per-connection statement cache keeps the INSERTs prepared.
+    """
+
+    def __init__(self, path, size=DB_POOL_SIZE, busy_timeout_ms=DB_BUSY_TIMEOUT_MS):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        # LIFO so the most recently used (warm) connection is handed out first
+        self.idle = queue.LifoQueue(maxsize=size)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        # NORMAL is safe with WAL; only the last commits can be lost on power failure
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={self.busy_timeout_ms}')
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of a with block"""
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            try:
+                self.idle.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    @contextmanager
+    def transaction(self):
+        """Borrow a connection and commit on success, roll back on error"""
+        with self.connection() as conn:
+            with conn:
+                yield conn
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+# Outbound notification delivery
+NOTIFICATION_WORKERS = 2
+NOTIFICATION_MAX_ATTEMPTS = 6
+# First retry delay; doubles with every failed attempt up to the maximum
+NOTIFICATION_BACKOFF_SECONDS = 5
+NOTIFICATION_MAX_BACKOFF_SECONDS = 15 * 60
+# Longest an idle worker sleeps before looking for due retries
+NOTIFICATION_POLL_SECONDS = 1
+# A claimed message that is still 'sending' after this long belongs to a
+# process that died mid-send and is picked up again
+NOTIFICATION_LEASE_SECONDS = 5 * 60
+# Messages per second each provider may be sent
+NOTIFICATION_RATE_LIMITS = {
+    'whatsapp_api': 20,
+    # Every message opens a browser tab on the lab PC
+    'whatsapp_web': 0.5
+}
+# Bulk mode: held notifications are sent in concurrent batches
+NOTIFICATION_BULK_CONCURRENCY = 8
+NOTIFICATION_BULK_LIMIT = 500
+# Most /notifications/dispatch may send at once, and its most concurrent sends
+NOTIFICATION_DISPATCH_MAX_LIMIT = 2000
+NOTIFICATION_DISPATCH_MAX_CONCURRENCY = 32
+
+# Pre-registered WhatsApp template for report notifications. Its body takes
+# these parameters in order, e.g. "Dear {{1}}, your report for the sample of
+# {{2}} (OPD {{3}}) is ready: {{4}}"
+WHATSAPP_TEMPLATE_NAME = 'pathology_report_ready'
+WHATSAPP_TEMPLATE_LANGUAGE = 'en'
+WHATSAPP_TEMPLATE_PARAMETERS = ('name', 'sample_date', 'opd_no', 'pdf_url')
+# Where a notification goes once a provider has used up its attempts
+NOTIFICATION_FALLBACKS = {
+    'whatsapp_api': 'whatsapp_web'
+}
+
+
+# HTTP client settings for the messaging providers
+MESSAGING_CONNECT_TIMEOUT = 3.05
+MESSAGING_READ_TIMEOUT = 10
+# Transport-level retries; the notification queue retries anything beyond that
+MESSAGING_RETRIES = 2
+MESSAGING_POOL_SIZE = 10
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class LatencyHistogram:
+    """Cumulative latency histogram with fixed buckets, safe to share between threads"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # One count per bucket plus the overflow (+Inf) bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = next((i for i, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def _percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of observations; call with the lock held"""
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float('inf')
+
+    def snapshot(self):
+        with self.lock:
+            cumulative = 0
+            buckets = {}
+            for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+                cumulative += count
+                buckets[str(bound)] = cumulative
+            return {
+                'count': self.count,
+                'sum': round(self.sum, 6),
+                'buckets': buckets,
+                'p50': self._percentile(0.5),
+                'p95': self._percentile(0.95),
+                'p99': self._percentile(0.99)
+            }
+
+
+# Buckets for work that is usually well under a second: requests, DB writes
+FAST_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class MetricsRegistry:
+    """Counters and histograms served by /metrics in the Prometheus text format.
+
+    Every thread records into its own shard, a plain dict, so the hot path
+    takes no lock; shards are only summed when /metrics is scraped. Metrics
+    are declared once with their label names, and recorded with the label
+    values in the same order. Each process has its own registry: render
+    workers send theirs back with drain() and merge(). Request threads come
+    and go, so the shards of finished threads are folded into one retired
+    total whenever a shard is added or the registry is read.
+
+    Web server processes (e.g. gunicorn workers) can't hand totals to each
+    other like that. After share(directory) this process publishes its
+    totals to a file there, and render() sums the files of every process,
+    so a scrape that reaches any worker sees the whole server.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.shards = []  # (owning thread, shard)
+        self.retired = {}
+        # Only guards the shard list, never taken while recording
+        self.lock = threading.Lock()
+        self.metrics = {}  # name -> (kind, help text, label names, buckets)
+        self.shared_dir = None
+        self.snapshot_path = None
+
+    def counter(self, name, help_text, labels=()):
+        self.metrics[name] = ('counter', help_text, labels, None)
+
+    def histogram(self, name, help_text, labels=(), buckets=FAST_LATENCY_BUCKETS):
+        self.metrics[name] = ('histogram', help_text, labels, buckets)
+
+    def _shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.lock:
+                self._retire_finished()
+                self.shards.append((threading.current_thread(), shard))
+            return shard
+
+    def _retire_finished(self):
+        """Fold the shards of threads that have exited into self.retired; needs self.lock"""
+        live = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                self._add(self.retired, shard)
+        self.shards = live
+
+    def inc(self, name, *labels, amount=1):
+        shard = self._shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def observe(self, name, seconds, *labels):
+        shard = self._shard()
+        key = (name, labels)
+        series = shard.get(key)
+        if series is None:
+            # One count per bucket, the +Inf bucket, then the sum
+            series = shard[key] = [0] * (len(self.metrics[name][3]) + 1) + [0.0]
+        series[bisect_left(self.metrics[name][3], seconds)] += 1
+        series[-1] += seconds
+
+    def collect(self):
+        """Sum all shards; returns {(name, label values): count or histogram series}"""
+        with self.lock:
+            self._retire_finished()
+            shards = [self.retired] + [shard for _, shard in self.shards]
+            return self._sum(shards)
+
+    def _sum(self, shards):
+        totals = {}
+        for shard in shards:
+            self._add(totals, shard)
+        return totals
+
+    @staticmethod
+    def _add(totals, shard):
+        # dict.copy() is atomic, so the owning thread can keep recording
+        for key, value in shard.copy().items():
+            if isinstance(value, list):
+                total = totals.setdefault(key, [0] * len(value))
+                for index, part in enumerate(list(value)):
+                    total[index] += part
+            else:
+                totals[key] = totals.get(key, 0) + value
+
+    def drain(self):
+        """Remove and return everything recorded in this process, for merge() elsewhere"""
+        with self.lock:
+            shards = [self.retired] + [shard for _, shard in self.shards]
+            self.shards, self.retired = [], {}
+            self.local = threading.local()
+        return self._sum(shards)
+
+    def merge(self, totals):
+        """Add the result of drain() from another process"""
+        shard = self._shard()
+        for key, value in totals.items():
+            if isinstance(value, list):
+                series = shard.setdefault(key, [0] * len(value))
+                for index, part in enumerate(value):
+                    series[index] += part
+            else:
+                shard[key] = shard.get(key, 0) + value
+
+    def share(self, directory):
+        """Publish this process's totals in directory and sum every process's in render()"""
+        os.makedirs(directory, exist_ok=True)
+        self.shared_dir = directory
+        # pid plus a random part, so a reused pid never takes over a dead process's file
+        self.snapshot_path = os.path.join(directory, f"{os.getpid()}-{uuid.uuid4().hex[:8]}.json")
+        self.publish()
+
+    def publish(self):
+        """Write this process's totals to its file in the shared directory"""
+        if not self.snapshot_path:
+            return
+        _write_metric_totals(self.snapshot_path, self.collect())
+
+    def retire(self):
+        """Fold this process's totals into the shared retired file; call once when the process exits.
+
+        Counters must not drop when a worker is recycled, so its totals stay
+        in the sum; folding them keeps the directory to one file per live process.
+        """
+        if not self.snapshot_path:
+            return
+        totals = self.collect()
+        with _shared_metrics_lock(self.shared_dir, exclusive=True):
+            retired_path = os.path.join(self.shared_dir, 'retired.json')
+            retired = _read_metric_totals(retired_path)
+            self._add(retired, totals)
+            _write_metric_totals(retired_path, retired)
+            try:
+                os.remove(self.snapshot_path)
+            except OSError:
+                pass
+        self.snapshot_path = None
+
+    def collect_shared(self):
+        """collect() summed over every process sharing this registry's directory"""
+        if not self.snapshot_path:
+            return self.collect()
+        self.publish()
+        totals = {}
+        # Under the lock, a retiring process is either in retired.json or in its own file
+        with _shared_metrics_lock(self.shared_dir, exclusive=False):
+            for entry in os.scandir(self.shared_dir):
+                if entry.name.endswith('.json'):
+                    self._add(totals, _read_metric_totals(entry.path))
+        return totals
+
+    def render(self, gauges=()):
+        """Prometheus text exposition of every metric plus gauges.
+
+        gauges is a list of (name, help text, label names, {label values: value}),
+        read by the caller at scrape time.
+        """
+        totals = self.collect_shared()
+        lines = []
+        for name, (kind, help_text, label_names, buckets) in self.metrics.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for (series_name, labels), value in sorted(totals.items(), key=lambda item: item[0]):
+                if series_name != name:
+                    continue
+                label_text = _metric_labels(label_names, labels)
+                if kind == 'counter':
+                    lines.append(f'{_metric_series(name, label_text)} {value}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ['+Inf'], value):
+                    cumulative += count
+                    bucket_labels = ','.join(filter(None, [label_text, f'le="{bound}"']))
+                    lines.append(f'{name}_bucket{{{bucket_labels}}} {cumulative}')
+                lines.append(f'{_metric_series(name + "_sum", label_text)} {value[-1]:.6f}')
+                lines.append(f'{_metric_series(name + "_count", label_text)} {cumulative}')
+        
+        for name, help_text, label_names, values in gauges:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            for labels, value in values.items():
+                lines.append(f'{_metric_series(name, _metric_labels(label_names, labels))} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _write_metric_totals(path, totals):
+    temp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump([[name, list(labels), value] for (name, labels), value in totals.items()], f)
+    # Readers see the old file or the new one, never half of one
+    os.replace(temp_path, path)
+
+
+def _read_metric_totals(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return {(name, tuple(labels)): value for name, labels, value in json.load(f)}
+    except (OSError, ValueError):
+        # Removed by a retiring process since the directory was listed
+        return {}
+
+
+@contextmanager
+def _shared_metrics_lock(directory, exclusive):
+    """flock on the shared metrics directory; a no-op where there is no fcntl (Windows)"""
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(os.path.join(directory, 'metrics.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _metric_labels(names, values):
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return ','.join(f'{name}="{value}"' for name, value in zip(names, escaped))
+
+
+def _metric_series(name, label_text):
+    return f'{name}{{{label_text}}}' if label_text else name
+
+
+def directory_size(path):
+    """Total size of the files under path"""
+    total = 0
+    try:
+        for entry in os.scandir(path):
+            if entry.is_dir(follow_symlinks=False):
+                total += directory_size(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                total += entry.stat(follow_symlinks=False).st_size
+    except OSError:
+        pass
+    return total
+
+
+# How long /metrics reuses the measured size of the reports directory
+REPORTS_SIZE_TTL_SECONDS = 60
+# With METRICS_DIR set (gunicorn.conf.py sets it), each process writes its
+# counters there this often, and /metrics sums every process's
+METRICS_PUBLISH_SECONDS = 5
+
+METRICS = MetricsRegistry()
+METRICS.counter('http_requests_total', "HTTP requests by route, method and status code",
+                ('route', 'method', 'status'))
+METRICS.histogram('http_request_duration_seconds', "Time to answer HTTP requests", ('route', 'method'))
+METRICS.counter('pdf_renders_total', "PDF render attempts by backend and outcome", ('backend', 'outcome'))
+METRICS.histogram('pdf_render_duration_seconds', "Time per PDF render attempt", ('backend',), LATENCY_BUCKETS)
+METRICS.counter('db_writes_total', "Report database writes by operation and outcome", ('operation', 'outcome'))
+METRICS.histogram('db_write_duration_seconds', "Time per report database write transaction", ('operation',))
+METRICS.counter('notifications_total', "Notification delivery attempts by provider and outcome",
+                ('provider', 'outcome'))
+METRICS.histogram('notification_send_duration_seconds', "Time per notification delivery attempt",
+                  ('provider',), LATENCY_BUCKETS)
+
+
+# Request traces: finished spans are appended here as JSON lines
+TRACE_FILE = os.path.join('reports', 'traces.jsonl')
+# Past this size the file is moved to traces.jsonl.1, replacing the previous one
+TRACE_FILE_MAX_BYTES = 50 * 1024 * 1024
+# Requests whose spans /debug/trace answers from memory, without reading the file
+TRACE_MEMORY_REQUESTS = 1000
+# Request ids accepted from an X-Request-ID header; anything else gets a new id
+_REQUEST_ID = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+
+class Trace:
+    """Timed spans for one request, handed to the tracer by finish().
+
+    Spans are flat: each has a name, start time (epoch seconds), duration
+    and whatever attributes the stage adds. The request thread and the
+    render finisher may record and finish the same trace at once; each
+    finish() exports the spans recorded since the last one.
+    """
+
+    def __init__(self, tracer, request_id):
+        self.tracer = tracer
+        self.request_id = request_id
+        self.spans = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Time the block; the yielded dict takes more attributes"""
+        span = dict(attributes, request_id=self.request_id, name=name, start=time.time(), pid=os.getpid())
+        started = time.perf_counter()
+        try:
+            yield span
+        except Exception as e:
+            span['error'] = str(e)
+            raise
+        finally:
+            span['duration_ms'] = round((time.perf_counter() - started) * 1000, 3)
+            with self.lock:
+                self.spans.append(span)
+
+    def add(self, name, start, end, **attributes):
+        """Record a span timed elsewhere, e.g. in a render worker; start and end are epoch seconds"""
+        span = dict(
+            attributes, request_id=self.request_id, name=name, start=start,
+            duration_ms=round((end - start) * 1000, 3), pid=attributes.get('pid', os.getpid())
+        )
+        with self.lock:
+            self.spans.append(span)
+
+    def finish(self):
+        """Export the spans recorded so far; later spans can still be added and finished"""
+        with self.lock:
+            spans, self.spans = self.spans, []
+        if spans and self.tracer is not None:
+            self.tracer.export(spans)
+
+
+class Tracer:
+    """Collects finished traces, keeps the latest in memory and appends them to a JSONL file.
+
+    The file is written by a background thread, so a request only pays
+    for building its span dicts. Every worker process appends to the same
+    file, which is where /debug/trace looks for requests it doesn't have
+    in memory.
+    """
+
+    def __init__(self, path, max_bytes=TRACE_FILE_MAX_BYTES, keep=TRACE_MEMORY_REQUESTS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.recent = OrderedDict()  # request_id -> spans
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+        self.writer = threading.Thread(target=self._write, name='trace-writer', daemon=True)
+        self.writer.start()
+
+    def start(self, request_id):
+        return Trace(self, request_id)
+
+    def export(self, spans):
+        with self.lock:
+            for span in spans:
+                self.recent.setdefault(span['request_id'], []).append(span)
+                self.recent.move_to_end(span['request_id'])
+            while len(self.recent) > self.keep:
+                self.recent.popitem(last=False)
+        self.pending.put(spans)
+
+    def close(self):
+        """Write out what is still queued and stop the writer"""
+        self.pending.put(None)
+        self.writer.join(timeout=5)
+
+    def _write(self):
+        while True:
+            batch = [self.pending.get()]
+            # Everything else already waiting goes out in the same write
+            while True:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            
+            lines = ''.join(
+                json.dumps(span, default=str) + '\n' for spans in batch if spans for span in spans
+            )
+            if lines:
+                try:
+                    self._append(lines)
+                except OSError as e:
+                    print(f"⚠️ Could not write traces: {e}")
+            if None in batch:
+                return
+
+    def _append(self, lines):
+        try:
+            if os.path.getsize(self.path) > self.max_bytes:
+                os.replace(self.path, self.path + '.1')
+        except OSError:
+            pass
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(lines)
+
+    def find(self, request_id):
+        """All spans recorded for a request, oldest first"""
+        with self.lock:
+            spans = list(self.recent.get(request_id, ()))
+        if not spans:
+            # Older requests, and ones served by another worker process
+            for path in (self.path + '.1', self.path):
+                try:
+                    with open(path, encoding='utf-8') as f:
+                        for line in f:
+                            # Cheap substring test first; most lines belong to other requests
+                            if request_id in line:
+                                span = json.loads(line)
+                                if span.get('request_id') == request_id:
+                                    spans.append(span)
+                except (OSError, ValueError):
+                    continue
+        return sorted(spans, key=lambda span: span['start'])
+
+
+# Admin diagnostics (profiles) write here
+PROFILE_DIR = os.path.join('reports', 'profiles')
+# Longest sampling run /debug/profile accepts
+PROFILE_MAX_SECONDS = 120
+# Seconds between stack samples, i.e. 200 samples a second
+PROFILE_SAMPLE_INTERVAL = 0.005
+# Length of the sampling run started by SIGUSR2
+PROFILE_SIGNAL_SECONDS = 30
+# Most functions /debug/profile/<request_id> lists
+PROFILE_MAX_LIMIT = 1000
+# One sampling run and one cProfile'd request at a time; cProfile can't nest
+_SAMPLER_LOCK = threading.Lock()
+_REQUEST_PROFILE_LOCK = threading.Lock()
+
+
+class StackSampler:
+    """Statistical profiler: samples the stack of every thread at a fixed interval.
+
+    The result is in the collapsed format flamegraph.pl and speedscope
+    read: one line per distinct stack, root first, frames separated by
+    ';', followed by the number of samples. Threads blocked on a lock or
+    socket are sampled too, so stalls show up, not only CPU time.
+    """
+
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.labels = {}  # code object -> frame label
+
+    def _label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ':')
+            self.labels[code] = label
+        return label
+
+    def run(self, seconds):
+        """Sample for the given seconds; returns (collapsed stacks text, number of samples)"""
+        counts = {}
+        own = threading.get_ident()
+        samples = 0
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            # Request threads are numbered (Thread-12 ...); merge them into one root
+            names = {thread.ident: re.sub(r'-\d+', '', thread.name).replace(';', ':')
+                     for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'thread'))
+                key = ';'.join(reversed(stack))
+                counts[key] = counts.get(key, 0) + 1
+            samples += 1
+            time.sleep(self.interval)
+        lines = ''.join(f"{stack} {count}\n" for stack, count in sorted(counts.items()))
+        return lines, samples
+
+
+def sample_stacks(seconds, interval=PROFILE_SAMPLE_INTERVAL):
+    """Run the sampler unless another run is in progress; returns (success, collapsed stacks or message)"""
+    if not _SAMPLER_LOCK.acquire(blocking=False):
+        return False, "A profile is already running"
+    try:
+        stacks, samples = StackSampler(interval).run(seconds)
+        print(f"🔬 Sampled {samples} times over {seconds}s")
+        return True, stacks
+    finally:
+        _SAMPLER_LOCK.release()
+
+
+def sample_stacks_to_file(seconds=PROFILE_SIGNAL_SECONDS):
+    """Sample in a background thread and write reports/profiles/stacks-<pid>-<time>.collapsed"""
+    def run():
+        success, stacks = sample_stacks(seconds)
+        if not success:
+            print(f"⚠️ {stacks}")
+            return
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"stacks-{os.getpid()}-{datetime.now().strftime('%Y%m%d_%H%M%S')}.collapsed")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(stacks)
+        print(f"🔬 Stack profile saved: {path}")
+    
+    print(f"🔬 Sampling all threads for {seconds}s")
+    threading.Thread(target=run, name='stack-sampler', daemon=True).start()
+
+
+def start_request_profile():
+    """cProfile the current request's thread; None if another request is being profiled"""
+    if not _REQUEST_PROFILE_LOCK.acquire(blocking=False):
+        return None
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Some other profiler is active
+        _REQUEST_PROFILE_LOCK.release()
+        return None
+    return profiler
+
+
+def stop_request_profile(profiler, path=None):
+    """Stop a profile from start_request_profile and optionally save it in pstats format"""
+    try:
+        profiler.disable()
+    finally:
+        _REQUEST_PROFILE_LOCK.release()
+    if path:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        profiler.dump_stats(path)
+
+
+class MessagingClient:
+    """Keep-alive HTTP sessions for the messaging providers.
+
+    Each provider gets its own requests.Session with a connection pool, so
+    messages reuse TLS connections instead of handshaking every time. Every
+    request gets connect/read timeouts and a small number of transport
+    retries: connection failures, and 429/503 answers, which mean the
+    message was not accepted. Latency is recorded per provider.
+    """
+
+    def __init__(self, connect_timeout=MESSAGING_CONNECT_TIMEOUT, read_timeout=MESSAGING_READ_TIMEOUT,
+                 retries=MESSAGING_RETRIES, pool_size=MESSAGING_POOL_SIZE):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.pool_size = pool_size
+        self.sessions = {}
+        self.latency = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def session(self, provider):
+        with self.lock:
+            if provider not in self.sessions:
+                import requests
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+                
+                retry = Retry(
+                    total=self.retries,
+                    connect=self.retries,
+                    # A read timeout may mean the message went out; resending could duplicate it
+                    read=0,
+                    status_forcelist=(429, 503),
+                    allowed_methods=frozenset(['GET', 'POST']),
+                    backoff_factor=0.3,
+                    raise_on_status=False,
+                    respect_retry_after_header=True
+                )
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self.sessions[provider] = session
+                self.latency[provider] = LatencyHistogram()
+                self.errors[provider] = 0
+            return self.sessions[provider]
+
+    def post(self, provider, url, **kwargs):
+        """POST through the provider's session; raises like requests.post"""
+        session = self.session(provider)
+        kwargs.setdefault('timeout', self.timeout)
+        started = time.perf_counter()
+        try:
+            response = session.post(url, **kwargs)
+        except Exception:
+            self._record(provider, time.perf_counter() - started, True)
+            raise
+        self._record(provider, time.perf_counter() - started, response.status_code >= 400)
+        return response
+
+    def _record(self, provider, seconds, failed):
+        self.latency[provider].observe(seconds)
+        if failed:
+            with self.lock:
+                self.errors[provider] += 1
+
+    def stats(self):
+        with self.lock:
+            providers = list(self.sessions)
+            errors = dict(self.errors)
+        return {
+            provider: {'errors': errors[provider], 'latency_seconds': self.latency[provider].snapshot()}
+            for provider in providers
+        }
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+
+
+class _MockMessagingHandler(BaseHTTPRequestHandler):
+    """Answers like the Graph API and Fast2SMS; see start_mock_messaging_server"""
+    # Keep-alive, so the pooled sessions are exercised as in production
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        
+        if random.random() < self.server.failure_rate:
+            status, body = 503, {'error': {'message': 'Mock provider failure'}}
+        elif self.path.endswith('/messages'):
+            status, body = 200, {'messaging_product': 'whatsapp', 'messages': [{'id': f'wamid.mock-{uuid.uuid4().hex}'}]}
+        else:
+            status, body = 200, {'return': True, 'request_id': uuid.uuid4().hex, 'message': ['SMS sent successfully.']}
+        
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_mock_messaging_server(port=0, latency=0.0, failure_rate=0.0):
+    """Serve fake messaging provider endpoints on localhost for offline throughput tests.
+
+    Every POST waits latency seconds and fails with 503 at the given rate.
+    Returns (server, base_url); port 0 picks a free port.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), _MockMessagingHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.failure_rate = failure_rate
+    threading.Thread(target=server.serve_forever, name='mock-messaging', daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+class RateLimiter:
+    """Token bucket shared by the threads sending through one provider"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a send is allowed"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class NotificationQueue:
+    """Durable outbound notifications, stored in SQLite and sent by background threads.
+
+    Rows are enqueued in the same transaction as the report they belong to,
+    so a stored report always has its notification, even across restarts.
+    Workers claim due rows, respect the provider's rate limit and call
+    deliver(provider, mobile, payload), which returns (success, message,
+    retryable). Failures are retried with exponential backoff; the outcome
+    is written back to completed_reports.whatsapp_status/whatsapp_error.
+    """
+
+    def __init__(self, db, deliver, workers=NOTIFICATION_WORKERS, rate_limits=NOTIFICATION_RATE_LIMITS,
+                 fallbacks=NOTIFICATION_FALLBACKS, max_attempts=NOTIFICATION_MAX_ATTEMPTS, tracer=None):
+        self.db = db
+        self.deliver = deliver
+        # Sends of notifications that carry a request id are added to that request's trace
+        self.tracer = tracer
+        self.workers = workers
+        self.rate_limiters = {provider: RateLimiter(rate) for provider, rate in rate_limits.items()}
+        self.fallbacks = fallbacks
+        self.max_attempts = max_attempts
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.threads = []
+        # Providers whose notifications are left to dispatch_bulk
+        self.bulk_providers = set()
+
+    def start(self):
+        # Rows left 'sending' by a crash or restart are reclaimed once their
+        # lease runs out; other processes may still be sending the rest
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'notifications-{index}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def start_bulk(self, provider, deliver, interval, max_concurrency=NOTIFICATION_BULK_CONCURRENCY):
+        """Hold a provider's notifications and send them with dispatch_bulk every interval seconds.
+
+        Call before start() so the regular workers never pick them up.
+        """
+        self.bulk_providers.add(provider)
+        
+        def dispatch_periodically():
+            while not self.stopping.wait(interval):
+                try:
+                    summary = self.dispatch_bulk(provider, deliver, max_concurrency)
+                except Exception as e:
+                    print(f"❌ Bulk dispatch error: {e}")
+                    continue
+                if summary['attempted']:
+                    print(f"📨 Bulk {provider}: {summary['sent']}/{summary['attempted']} sent, "
+                          f"{summary['sends_per_second']} sends/s")
+        
+        thread = threading.Thread(target=dispatch_periodically, name=f'bulk-{provider}', daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def stop(self):
+        self.stopping.set()
+        self.wakeup.set()
+
+    def enqueue(self, conn, completed_report_id, provider, mobile, payload, request_id=None):
+        """Add a notification on the caller's connection; call wake() after the commit"""
+        conn.execute('''
+            INSERT INTO notification_queue (completed_report_id, provider, mobile, payload, next_attempt_at, request_id)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (completed_report_id, provider, mobile, json.dumps(payload), time.time(), request_id))
+
+    def wake(self):
+        self.wakeup.set()
+
+    def backoff(self, attempts):
+        """Seconds to wait after the given number of failed attempts"""
+        delay = min(NOTIFICATION_BACKOFF_SECONDS * 2 ** (attempts - 1), NOTIFICATION_MAX_BACKOFF_SECONDS)
+        # Jitter so a provider outage doesn't end in a burst of simultaneous retries
+        return delay * random.uniform(0.8, 1.2)
+
+    def _claim(self):
+        """Mark the next due notification as sending; returns its row or None"""
+        while True:
+            with self.db.transaction() as conn:
+                held = list(self.bulk_providers)
+                row = conn.execute(f'''
+                    SELECT id, completed_report_id, provider, mobile, payload, attempts, next_attempt_at, request_id
+                    FROM notification_queue
+                    WHERE status IN ('pending', 'sending') AND next_attempt_at <= ?
+                          AND provider NOT IN ({', '.join('?' * len(held))})
+                    ORDER BY next_attempt_at, id LIMIT 1
+                ''', [time.time()] + held).fetchone()
+                if row is None:
+                    return None
+                claimed = self._lease(conn, row[0], row[6])
+            if claimed:
+                return row[:5] + (row[5] + 1, row[7])
+            # Another worker took it first
+
+    def _claim_many(self, provider, limit):
+        """Mark up to limit due notifications of one provider as sending; returns their rows"""
+        claimed = []
+        with self.db.transaction() as conn:
+            rows = conn.execute('''
+                SELECT id, completed_report_id, provider, mobile, payload, attempts, next_attempt_at, request_id
+                FROM notification_queue
+                WHERE status IN ('pending', 'sending') AND provider = ? AND next_attempt_at <= ?
+                ORDER BY next_attempt_at, id LIMIT ?
+            ''', (provider, time.time(), limit)).fetchall()
+            for row in rows:
+                if self._lease(conn, row[0], row[6]):
+                    claimed.append(row[:5] + (row[5] + 1, row[7]))
+        return claimed
+
+    def _lease(self, conn, notification_id, next_attempt_at):
+        """Mark a due notification as sending until its lease runs out; False if another worker got it first"""
+        return conn.execute('''
+            UPDATE notification_queue
+            SET status = 'sending', attempts = attempts + 1, next_attempt_at = ?
+            WHERE id = ? AND status IN ('pending', 'sending') AND next_attempt_at = ?
+        ''', (time.time() + NOTIFICATION_LEASE_SECONDS, notification_id, next_attempt_at)).rowcount > 0
+
+    def dispatch_bulk(self, provider, deliver, max_concurrency=NOTIFICATION_BULK_CONCURRENCY,
+                      limit=NOTIFICATION_BULK_LIMIT):
+        """Send the due notifications of one provider concurrently.
+
+        At most max_concurrency sends are in flight, and all of them share the
+        provider's rate limit. Failures get the same retry/fallback handling
+        as single sends. Returns per-recipient results and the send rate.
+        """
+        started = time.perf_counter()
+        rows = self._claim_many(provider, limit)
+        limiter = self.rate_limiters.get(provider)
+        
+        def send(row):
+            notification_id, completed_report_id, provider, mobile, payload, attempts, request_id = row
+            if limiter:
+                limiter.acquire()
+            success, message, retryable = self._send(deliver, provider, mobile, payload, request_id, attempts)
+            try:
+                status = self._finish(notification_id, completed_report_id, provider, attempts, success, message, retryable)
+            except Exception as e:
+                print(f"❌ Error recording notification {notification_id}: {e}")
+                status = 'unknown'
+            return {
+                'notification_id': notification_id,
+                'report_id': completed_report_id,
+                'mobile': mobile,
+                'success': success,
+                'status': status,
+                'message': message
+            }
+        
+        results = []
+        if rows:
+            with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(rows)))) as executor:
+                results = list(executor.map(send, rows))
+        
+        elapsed = time.perf_counter() - started
+        sent = sum(1 for result in results if result['success'])
+        return {
+            'provider': provider,
+            'attempted': len(results),
+            'sent': sent,
+            'failed': len(results) - sent,
+            'elapsed_seconds': round(elapsed, 3),
+            'sends_per_second': round(sent / elapsed, 2) if results and elapsed else 0,
+            'results': results
+        }
+
+    def _seconds_until_due(self):
+        """How long an idle worker can sleep before the next retry is due"""
+        try:
+            with self.db.connection() as conn:
+                next_attempt_at = conn.execute(
+                    "SELECT MIN(next_attempt_at) FROM notification_queue WHERE status IN ('pending', 'sending')"
+                ).fetchone()[0]
+        except Exception:
+            return NOTIFICATION_POLL_SECONDS
+        if next_attempt_at is None:
+            return NOTIFICATION_POLL_SECONDS
+        return min(max(next_attempt_at - time.time(), 0.01), NOTIFICATION_POLL_SECONDS)
+
+    def _work(self):
+        while not self.stopping.is_set():
+            try:
+                row = self._claim()
+            except Exception as e:
+                print(f"❌ Notification queue error: {e}")
+                row = None
+            
+            if row is None:
+                self.wakeup.wait(self._seconds_until_due())
+                self.wakeup.clear()
+                continue
+            
+            notification_id, completed_report_id, provider, mobile, payload, attempts, request_id = row
+            limiter = self.rate_limiters.get(provider)
+            if limiter:
+                limiter.acquire()
+            
+            success, message, retryable = self._send(self.deliver, provider, mobile, payload, request_id, attempts)
+            
+            try:
+                self._finish(notification_id, completed_report_id, provider, attempts, success, message, retryable)
+            except Exception as e:
+                print(f"❌ Error recording notification {notification_id}: {e}")
+
+    def _send(self, deliver, provider, mobile, payload, request_id=None, attempt=None):
+        """Call deliver for one notification; returns (success, message, retryable)"""
+        started_at = time.time()
+        started = time.perf_counter()
+        try:
+            result = deliver(provider, mobile, json.loads(payload))
+        except Exception as e:
+            result = False, f"{provider} delivery failed: {str(e)}", True
+        elapsed = time.perf_counter() - started
+        METRICS.observe('notification_send_duration_seconds', elapsed, provider)
+        if self.tracer is not None and request_id:
+            trace = self.tracer.start(request_id)
+            trace.add('notify', started_at, started_at + elapsed, provider=provider, attempt=attempt, success=result[0])
+            trace.finish()
+        return result
+
+    def _finish(self, notification_id, completed_report_id, provider, attempts, success, message, retryable):
+        """Record a delivery attempt; returns the report's new whatsapp_status"""
+        with self.db.transaction() as conn:
+            if success:
+                conn.execute('''
+                    UPDATE notification_queue SET status = 'sent', last_error = NULL, sent_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', (notification_id,))
+                conn.execute(
+                    "UPDATE completed_reports SET whatsapp_status = 'sent', whatsapp_error = NULL WHERE id = ?",
+                    (completed_report_id,)
+                )
+                METRICS.inc('notifications_total', provider, 'sent')
+                print(f"✅ Notification {notification_id} sent via {provider}")
+                return 'sent'
+            
+            if retryable and attempts < self.max_attempts:
+                conn.execute('''
+                    UPDATE notification_queue SET status = 'pending', last_error = ?, next_attempt_at = ?
+                    WHERE id = ?
+                ''', (message, time.time() + self.backoff(attempts), notification_id))
+                status = 'queued'
+                METRICS.inc('notifications_total', provider, 'retry')
+                print(f"⚠️ Notification {notification_id} failed (attempt {attempts}), will retry: {message}")
+            elif provider in self.fallbacks:
+                conn.execute('''
+                    UPDATE notification_queue SET status = 'pending', provider = ?, attempts = 0,
+                                                  last_error = ?, next_attempt_at = ?
+                    WHERE id = ?
+                ''', (self.fallbacks[provider], message, time.time(), notification_id))
+                status = 'queued'
+                METRICS.inc('notifications_total', provider, 'fallback')
+                print(f"⚠️ Notification {notification_id} moving from {provider} to {self.fallbacks[provider]}")
+            else:
+                conn.execute(
+                    "UPDATE notification_queue SET status = 'failed', last_error = ? WHERE id = ?",
+                    (message, notification_id)
+                )
+                status = 'failed'
+                METRICS.inc('notifications_total', provider, 'failed')
+                print(f"❌ Notification {notification_id} failed: {message}")
+            
+            conn.execute(
+                'UPDATE completed_reports SET whatsapp_status = ?, whatsapp_error = ? WHERE id = ?',
+                (status, message, completed_report_id)
+            )
+        self.wake()
+        return status
+
+    def stats(self):
+        """Notification counts by status and provider"""
+        with self.db.connection() as conn:
+            rows = conn.execute(
+                'SELECT status, provider, COUNT(*) FROM notification_queue GROUP BY status, provider'
+            ).fetchall()
+        counts = {}
+        for status, provider, count in rows:
+            counts.setdefault(status, {})[provider] = count
+        return counts
+
+
+# Largest batch /submit-reports accepts in one request
+MAX_BATCH_REPORTS = 500
+
+# Finished batch reports stored per database transaction
+BATCH_STORE_CHUNK = 25
+
+INSERT_FORM_SUBMISSION = '''
+    INSERT INTO form_submissions 
+    (patient_name, patient_age, patient_gender, patient_mobile, doctor_name, opd_no, sample_date, selected_tests)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+# OR IGNORE: a report whose content_key is already stored (a retry or double
+# submit) is not stored, or sent, again
+INSERT_COMPLETED_REPORT = '''
+    INSERT OR IGNORE INTO completed_reports 
+    (patient_name, patient_age, patient_gender, patient_mobile, doctor_name, opd_no, sample_date, test_results, pdf_path, whatsapp_status, whatsapp_error, request_id, content_key)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+# Normalized copy of the report blobs: one lab_results row per test with the
+# numeric value and flag already worked out, so history queries can use
+# indexes instead of decoding JSON. The lab_ prefix keeps clear of the old
+# patients/test_results tables that older builds left in the same file.
+NORMALIZED_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS lab_patients (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL COLLATE NOCASE,
+        mobile TEXT NOT NULL,
+        gender TEXT,
+        UNIQUE (mobile, name)
+    );
+    CREATE TABLE IF NOT EXISTS lab_reports (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        patient_id INTEGER NOT NULL REFERENCES lab_patients (id),
+        kind TEXT NOT NULL,
+        source_id INTEGER NOT NULL,
+        patient_age TEXT,
+        age_years REAL,
+        doctor_name TEXT,
+        opd_no TEXT,
+        sample_date TEXT,
+        pdf_path TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (kind, source_id)
+    );
+    CREATE TABLE IF NOT EXISTS lab_results (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        report_id INTEGER NOT NULL REFERENCES lab_reports (id),
+        test_name TEXT NOT NULL,
+        category TEXT,
+        result_text TEXT,
+        result_value REAL,
+        flag TEXT
+    );
+    -- lab_patients (mobile, name) is already indexed by its UNIQUE constraint
+    CREATE INDEX IF NOT EXISTS idx_lab_reports_patient ON lab_reports (patient_id, sample_date);
+    CREATE INDEX IF NOT EXISTS idx_lab_reports_opd_no ON lab_reports (opd_no);
+    CREATE INDEX IF NOT EXISTS idx_lab_reports_sample_date ON lab_reports (sample_date);
+    CREATE INDEX IF NOT EXISTS idx_lab_reports_doctor ON lab_reports (doctor_name, sample_date);
+    CREATE INDEX IF NOT EXISTS idx_lab_results_report ON lab_results (report_id, test_name);
+    CREATE INDEX IF NOT EXISTS idx_lab_results_test ON lab_results (test_name, result_value);
+    -- History search: newest-first listing and patient name prefix lookups. The
+    -- listing key treats a missing sample_date as '' so cursors can page past it
+    DROP INDEX IF EXISTS idx_lab_reports_listing;
+    CREATE INDEX IF NOT EXISTS idx_lab_reports_history ON lab_reports (kind, COALESCE(sample_date, ''), id);
+    CREATE INDEX IF NOT EXISTS idx_lab_patients_name ON lab_patients (name);
+'''
+
+# lab_reports.kind for rows copied from each blob table
+REPORT_KIND_ORDERED = 'ordered'
+REPORT_KIND_COMPLETED = 'completed'
+
+# Rows per transaction when backfilling the normalized tables
+MIGRATION_BATCH_SIZE = 200
+# Tries per backfill batch when other processes are writing the same tables
+MIGRATION_BATCH_ATTEMPTS = 5
+
+# Another writer (e.g. a second gunicorn worker backfilling) may add the same patient first
+INSERT_LAB_PATIENT = 'INSERT INTO lab_patients (name, mobile, gender) VALUES (?, ?, ?) ON CONFLICT DO NOTHING'
+SELECT_LAB_PATIENT = 'SELECT id FROM lab_patients WHERE mobile = ? AND name = ?'
+
+INSERT_LAB_REPORT = '''
+    INSERT OR IGNORE INTO lab_reports
+    (patient_id, kind, source_id, patient_age, age_years, doctor_name, opd_no, sample_date, pdf_path)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+INSERT_LAB_RESULT = '''
+    INSERT INTO lab_results (report_id, test_name, category, result_text, result_value, flag)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+
+# Seconds a browser may reuse a report without revalidating; saved reports never change
+REPORT_CACHE_MAX_AGE = 24 * 60 * 60
+
+# Page sizes for the /reports history search
+REPORT_PAGE_SIZE = 50
+MAX_REPORT_PAGE_SIZE = 200
+
+SELECT_REPORT_HISTORY = '''
+    SELECT r.id, r.source_id, p.name, p.mobile, p.gender, r.patient_age, r.doctor_name,
+           r.opd_no, r.sample_date, r.pdf_path
+    FROM lab_reports AS r
+    JOIN lab_patients AS p ON p.id = r.patient_id
+    WHERE r.kind = ? {filters}
+    ORDER BY COALESCE(r.sample_date, '') DESC, r.id DESC
+    LIMIT ?
+'''
+
+SELECT_RESULT_COUNTS = '''
+    SELECT report_id, COUNT(*), SUM(flag != 'normal') FROM lab_results
+    WHERE report_id IN ({placeholders}) AND result_text IS NOT NULL
+    GROUP BY report_id
+'''
+
+SELECT_TEST_TREND = '''
+    SELECT r.source_id, r.sample_date, p.name, x.result_text, x.result_value, x.flag
+    FROM lab_patients AS p
+    JOIN lab_reports AS r ON r.patient_id = p.id AND r.kind = ?
+    JOIN lab_results AS x ON x.report_id = r.id AND x.test_name = ?
+    WHERE p.mobile = ? {filters}
+    ORDER BY r.sample_date, r.id
+'''
+
+
+def _encode_cursor(sample_date, report_id):
+    """Opaque keyset cursor for the row a page ended on"""
+    return base64.urlsafe_b64encode(json.dumps([sample_date, report_id]).encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(cursor):
+    """Inverse of _encode_cursor; raises ValueError for a cursor we didn't issue"""
+    try:
+        sample_date, report_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise ValueError(f'Invalid cursor: {cursor}')
+    if not isinstance(sample_date, str) or not isinstance(report_id, int):
+        raise ValueError(f'Invalid cursor: {cursor}')
+    return sample_date, report_id
+
+
+def _result_value(result):
+    """Numeric value of a result such as "14.2", "<0.5" or "1,200"; None for text and titres"""
+    result_text = str(result or '').strip()
+    numeric = _RESULT_NUMBER.match(result_text)
+    if not numeric or ':' in result_text:
+        return None
+    return _number(numeric.group(1))
+
+
+# Reports read per query when exporting; each batch is one short read
+EXPORT_BATCH_SIZE = 500
+EXPORT_FORMATS = ('csv', 'ndjson', 'columnar')
+# One exported line per test result
+EXPORT_COLUMNS = (
+    'report_id', 'report_date', 'patient_name', 'patient_age', 'patient_gender', 'patient_mobile',
+    'doctor_name', 'opd_no', 'sample_date', 'whatsapp_status', 'test_name', 'category', 'result'
+)
+
+SELECT_EXPORT_BATCH = '''
+    SELECT id, COALESCE(report_date, sample_date), patient_name, patient_age, patient_gender, patient_mobile,
+           doctor_name, opd_no, sample_date, whatsapp_status, test_results
+    FROM completed_reports
+    WHERE id > ? AND id <= ? {filters}
+    ORDER BY id LIMIT ?
+'''
+
+
+def iter_export_batches(db, date_from=None, date_to=None, batch_size=EXPORT_BATCH_SIZE):
+    """Completed reports flattened to EXPORT_COLUMNS tuples, yielded a batch (list) at a time.
+
+    Batches are read by id, each with its own borrowed connection, so no
+    read stays open while the caller writes the previous batch out and
+    submissions keep committing. Reports stored after the export started
+    are left out. date_from is inclusive and date_to exclusive, compared
+    with report_date ('YYYY-MM-DD'). Rows from older builds have no
+    report_date; their sample_date stands in, in the filter and the output.
+    """
+    filters, params = '', []
+    if date_from:
+        filters += ' AND COALESCE(report_date, sample_date) >= ?'
+        params.append(date_from)
+    if date_to:
+        filters += ' AND COALESCE(report_date, sample_date) < ?'
+        params.append(date_to)
+    query = SELECT_EXPORT_BATCH.format(filters=filters)
+    
+    with db.connection() as conn:
+        last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM completed_reports').fetchone()[0]
+    after_id = 0
+    while True:
+        with db.connection() as conn:
+            reports = conn.execute(query, [after_id, last_id] + params + [batch_size]).fetchall()
+        if not reports:
+            return
+        after_id = reports[-1][0]
+        
+        rows = []
+        for report in reports:
+            try:
+                test_results = json.loads(report[10] or '{}')
+            except ValueError:
+                print(f"⚠️ Unreadable test_results in completed_reports row {report[0]}")
+                test_results = {}
+            if not isinstance(test_results, dict):
+                test_results = {}
+            for test_name, result in test_results.items():
+                test = TEST_CATALOG.get(test_name)
+                rows.append(report[:10] + (test_name, test.category if test else None, result))
+        if rows:
+            yield rows
+
+
+def export_completed_reports(db, fmt='csv', date_from=None, date_to=None, batch_size=EXPORT_BATCH_SIZE):
+    """Export as text chunks, one per batch, for a streamed response or a file.
+
+    csv and ndjson have one line per test result. columnar has one JSON
+    line per batch with a list of values per column, for loading into
+    dataframes or Parquet writers without re-pivoting.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt} (use {', '.join(EXPORT_FORMATS)})")
+    
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+        yield buffer.getvalue()
+    
+    for rows in iter_export_batches(db, date_from, date_to, batch_size):
+        if fmt == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerows(rows)
+            yield buffer.getvalue()
+        elif fmt == 'ndjson':
+            yield ''.join(json.dumps(dict(zip(EXPORT_COLUMNS, row))) + '\n' for row in rows)
+        else:
+            yield json.dumps({
+                'rows': len(rows),
+                'columns': dict(zip(EXPORT_COLUMNS, (list(values) for values in zip(*rows))))
+            }) + '\n'
+
+
+def _export_date(value):
+    """Validate a YYYY-MM-DD export bound; None when not given"""
+    if not value:
+        return None
+    return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+
+
+# Analyzer result files (LIS exports) imported as completed reports
+IMPORT_FORMATS = ('csv', 'hl7')
+# Samples turned into reports per transaction
+IMPORT_BATCH_SIZE = 200
+# Most unmatched samples, unknown codes and errors listed in an import summary
+IMPORT_MAX_EXAMPLES = 100
+# Analyzer test codes -> catalog test names; ANALYZER_CODES_FILE (JSON) adds to
+# or overrides these, and catalog names themselves are always accepted
+ANALYZER_CODES = {
+    'GLU': 'Glucose (F)/RI', 'FBS': 'Glucose (F)/RI', 'PPBS': 'Post Prandial / after 2 Hrs',
+    'HBA1C': 'HbA1c', 'UREA': 'Urea', 'CREA': 'Creatinine', 'UA': 'S. Uric Acid', 'BUN': 'BUN',
+    'CHOL': 'Cholesterol', 'TG': 'Triglyceride', 'HDL': 'HDL', 'LDL': 'LDL',
+    'TBIL': 'Bilirubin Total', 'DBIL': 'Bilirubin (Conjugated)', 'IBIL': 'Bilirubin (Unconjugated)',
+    'AST': 'SGOT/AST', 'ALT': 'SGPT/ALT', 'ALP': 'Alk. Phosphatase', 'TP': 'Total Protein',
+    'ALB': 'Albumin', 'GLOB': 'Globulin', 'A/G': 'A/G Ratio', 'GGT': 'GGT',
+    'CA': 'S. Calcium', 'NA': 'S. Sodium', 'K': 'S. Potassium', 'PHOS': 'S. Phosphorous',
+    'AMY': 'S. Amylase', 'CKMB': 'CK-MB', 'TROPT': 'TROP-T',
+    'HGB': 'Haemoglobin', 'WBC': 'Total leukocyte count', 'NEU%': 'Differential WBC count - Polymorphs',
+    'LYM%': 'Differential WBC count - Lymphocytes', 'EOS%': 'Differential WBC count - Eosinophils',
+    'MON%': 'Differential WBC count - Monocytes', 'BAS%': 'Differential WBC count - Basophiles',
+    'ESR': 'E.S.R. (Westergren)', 'PLT': 'Platelet Count', 'RBC': 'RBC Count', 'RET%': 'Reticulocyte count',
+    'HCT': 'Haematocrit/PCV', 'MCV': 'MCV', 'MCH': 'MCH', 'MCHC': 'MCHC', 'PT': 'Prothrombin Time',
+    'CRP': 'CRP', 'ASO': 'ASO Titer', 'RF': 'R.A. factor'
+}
+# Accepted CSV header names (lower case) for each field
+IMPORT_CSV_COLUMNS = {
+    'sample_id': ('opd_no', 'opd no', 'opd', 'sample_id', 'sample id', 'sample'),
+    'code': ('code', 'test_code', 'test code', 'test', 'assay'),
+    'value': ('result', 'value')
+}
+# HL7 OBX-11 statuses whose results must not be reported: deleted, not obtained, wrong
+HL7_SKIPPED_STATUSES = ('D', 'X', 'W')
+
+AnalyzerResult = namedtuple('AnalyzerResult', ['sample_id', 'code', 'value'])
+
+
+def parse_analyzer_csv(lines):
+    """Yield AnalyzerResults from CSV lines with a header row, one row at a time"""
+    reader = csv.reader(lines)
+    header = [column.strip().lower() for column in next(reader, [])]
+    positions = {}
+    for field, names in IMPORT_CSV_COLUMNS.items():
+        position = next((header.index(name) for name in names if name in header), None)
+        if position is None:
+            raise ValueError(f"CSV has no {field} column (expected one of: {', '.join(names)})")
+        positions[field] = position
+    
+    last = max(positions.values())
+    for row in reader:
+        if len(row) <= last:
+            continue
+        yield AnalyzerResult(row[positions['sample_id']], row[positions['code']], row[positions['value']])
+
+
+def _hl7_field(fields, number):
+    """Field number of a split segment; trailing empty fields may be left out"""
+    return fields[number] if len(fields) > number else ''
+
+
+def parse_hl7_results(lines):
+    """Yield AnalyzerResults from HL7 v2 ORU messages, one segment at a time.
+
+    The sample is OBR-2 (placer order number), or OBR-3 when that is empty;
+    each OBX gives the code (first component of OBX-3) and value (OBX-5).
+    """
+    field_separator, component_separator = '|', '^'
+    sample_id = None
+    for line in lines:
+        segment = line.strip()
+        if segment.startswith('MSH') and len(segment) > 4:
+            # MSH-1 and MSH-2 declare the separators for this message
+            field_separator, component_separator = segment[3], segment[4]
+            sample_id = None
+            continue
+        
+        fields = segment.split(field_separator)
+        if fields[0] == 'OBR':
+            sample_id = (_hl7_field(fields, 2) or _hl7_field(fields, 3)).split(component_separator)[0]
+        elif fields[0] == 'OBX' and sample_id:
+            if _hl7_field(fields, 11) in HL7_SKIPPED_STATUSES:
+                continue
+            yield AnalyzerResult(
+                sample_id, _hl7_field(fields, 3).split(component_separator)[0], _hl7_field(fields, 5)
+            )
+
+
+def parse_analyzer_results(lines, fmt=None):
+    """Parse CSV or HL7 lines; without fmt, files starting with an MSH segment are HL7"""
+    lines = iter(lines)
+    if fmt is None:
+        first = next(lines, '')
+        lines = itertools.chain([first], lines)
+        fmt = 'hl7' if first.lstrip('\ufeff').startswith('MSH') else 'csv'
+    if fmt not in IMPORT_FORMATS:
+        raise ValueError(f"Unknown import format: {fmt} (use {', '.join(IMPORT_FORMATS)})")
+    return parse_hl7_results(lines) if fmt == 'hl7' else parse_analyzer_csv(lines)
+
+
+def consume_in_background(items, name):
+    """Iterate items on a separate thread and yield them from a queue.
+
+    The thread runs to the end even if the caller stops reading, e.g. when
+    a streaming client disconnects.
+    """
+    results = queue.Queue()
+    done = object()
+    
+    def run():
+        try:
+            for item in items:
+                results.put(item)
+        except Exception as e:
+            print(f"❌ Error in {name}: {e}")
+        finally:
+            results.put(done)
+    
+    threading.Thread(target=run, name=name, daemon=True).start()
+    while True:
+        item = results.get()
+        if item is done:
+            return
+        yield item
+
+
+# Where the web app listens unless HOST / PORT say otherwise
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 5000
+
+
+class PathologyService:
+    """The web app and everything behind it: storage, rendering and notifications.
+
+    Nothing here touches Tk, so the same service runs under the launcher
+    window, the headless "serve" command and WSGI servers (see create_app).
+    """
+
     def __init__(self):
-        super().__init__()
-        self.title("UJJIVAN Hospital Pathology System Launcher")
-        self.geometry("600x400")
-        self.configure(bg="#f0e1c6")
-        
         # Create necessary directories first
-        os.makedirs('reports/completed_reports', exist_ok=True)
+        os.makedirs(REPORT_STORE_DIR, exist_ok=True)
+        self.report_store = ReportStore(REPORT_STORE_DIR)
+        # (measured_at, bytes) for the reports_directory_bytes metric
+        self.reports_size = (0, 0)
+        
+        # Address used in report links sent to patients; set PUBLIC_BASE_URL
+        # when the app runs behind a proxy or on another host
+        self.base_url = os.environ.get(
+            'PUBLIC_BASE_URL', f"http://localhost:{os.environ.get('PORT', DEFAULT_PORT)}"
+        ).rstrip('/')
+        
+        # Per-request stage timings for /debug/trace
+        self.tracer = Tracer(TRACE_FILE)
+        
+        # Admin endpoints need this in an X-Admin-Token header. Without it they
+        # only answer local requests to the built-in server (start_server,
+        # serve); behind gunicorn or a reverse proxy every request comes from
+        # loopback, so there they stay closed
+        self.admin_token = os.environ.get('ADMIN_TOKEN', '')
+        self.trust_loopback = False
+        if not self.admin_token:
+            print("⚠️ ADMIN_TOKEN is not set: report history, exports, imports, traces and profiles "
+                  "only answer local requests to the built-in server")
+        # kill -USR2 <pid> samples every thread into reports/profiles
+        self.install_profile_signal()
+        
+        # Rendered reports reused for retries and reprints
+        self.render_cache = RenderCache(
+            RENDER_CACHE_DIR,
+            int(os.environ.get('RENDER_CACHE_MEMORY_MB', RENDER_CACHE_MEMORY_MB)) * 1024 * 1024,
+            int(os.environ.get('RENDER_CACHE_DISK_MB', RENDER_CACHE_DISK_MB)) * 1024 * 1024
+        )
         
         # Initialize database
         self.init_database()
@@ -63,164 +3082,132 @@ class PathologyTestsForm(tk.Tk):
         self.whatsapp_access_token = "YOUR_ACCESS_TOKEN"
         self.whatsapp_web_url = "https://web.whatsapp.com/send?phone={phone}&text={message}"
         
+        # SMS configuration (sign up at https://www.fast2sms.com/)
+        self.fast2sms_url = "https://www.fast2sms.com/dev/bulkV2"
+        self.fast2sms_api_key = "YOUR_FAST2SMS_API_KEY"
+        
+        # Pooled keep-alive sessions shared by the notification workers
+        self.messaging = MessagingClient(
+            connect_timeout=float(os.environ.get('MESSAGING_CONNECT_TIMEOUT', MESSAGING_CONNECT_TIMEOUT)),
+            read_timeout=float(os.environ.get('MESSAGING_READ_TIMEOUT', MESSAGING_READ_TIMEOUT))
+        )
+        
+        # MESSAGING_MOCK=1 sends everything to a local fake provider, e.g. to measure throughput offline
+        if os.environ.get('MESSAGING_MOCK'):
+            self.mock_messaging_server, mock_url = start_mock_messaging_server(
+                int(os.environ.get('MESSAGING_MOCK_PORT', 0)),
+                float(os.environ.get('MESSAGING_MOCK_LATENCY_MS', 50)) / 1000,
+                float(os.environ.get('MESSAGING_MOCK_FAILURE_RATE', 0))
+            )
+            self.whatsapp_api_url = f"{mock_url}/v17.0/"
+            self.whatsapp_phone_number_id = "mock-phone-number-id"
+            self.whatsapp_access_token = "mock-access-token"
+            self.fast2sms_url = f"{mock_url}/dev/bulkV2"
+            self.fast2sms_api_key = "mock-api-key"
+            print(f"🧪 Messaging providers mocked at {mock_url}")
+        
+        # WhatsApp messages are sent in the background, never inside a request
+        # Provider rate limits are totals; with WEB_WORKERS processes each one sends its share
+        web_workers = max(int(os.environ.get('WEB_WORKERS', 1)), 1)
+        self.notifications = NotificationQueue(
+            self.db,
+            self.deliver_notification,
+            workers=int(os.environ.get('NOTIFICATION_WORKERS', NOTIFICATION_WORKERS)),
+            rate_limits={provider: rate / web_workers for provider, rate in NOTIFICATION_RATE_LIMITS.items()},
+            tracer=self.tracer
+        )
+        # Template message used for bulk sends
+        self.whatsapp_template_name = os.environ.get('WHATSAPP_TEMPLATE_NAME', WHATSAPP_TEMPLATE_NAME)
+        self.whatsapp_template_language = os.environ.get('WHATSAPP_TEMPLATE_LANGUAGE', WHATSAPP_TEMPLATE_LANGUAGE)
+        self.notification_bulk_concurrency = int(
+            os.environ.get('NOTIFICATION_BULK_CONCURRENCY', NOTIFICATION_BULK_CONCURRENCY)
+        )
+        # NOTIFICATION_BULK_INTERVAL (seconds) > 0 sends API messages as periodic template batches
+        bulk_interval = float(os.environ.get('NOTIFICATION_BULK_INTERVAL', 0))
+        if bulk_interval > 0:
+            self.notifications.start_bulk(
+                'whatsapp_api', self.deliver_template_notification, bulk_interval, self.notification_bulk_concurrency
+            )
+        self.notifications.start()
+        
+        # PDF rendering worker processes (0 renders inside the request as before)
+        self.pdf_render_workers = int(os.environ.get('PDF_RENDER_WORKERS', os.cpu_count() or 1))
+        self.render_pool = PdfRenderPool(self.pdf_render_workers, self.db) if self.pdf_render_workers > 0 else None
+        
+        # METRICS_DIR makes /metrics sum the counters of every process serving the app
+        self.metrics_stopping = threading.Event()
+        metrics_dir = os.environ.get('METRICS_DIR')
+        if metrics_dir:
+            METRICS.share(metrics_dir)
+            interval = float(os.environ.get('METRICS_PUBLISH_SECONDS', METRICS_PUBLISH_SECONDS))
+            threading.Thread(
+                target=self.publish_metrics_periodically, args=(interval,), name='metrics-publisher', daemon=True
+            ).start()
+        
         # Store current report data
         self.current_patient_data = {}
         self.current_selected_tests = []
         
-        # Test normal ranges dictionary
-        self.normal_ranges = {
-            "Glucose (F)/RI": "70-110 mg/dl",
-            "Post Prandial / after 2 Hrs": "Up to 140 mg/dl",
-            "HbA1c": "4.5-6.5 %",
-            "Urea": "10-40 mg/dl",
-            "Creatinine": "0.6-1.4 mg/dl",
-            "S. Uric Acid": "2.8-7.0 mg/dl",
-            "BUN": "5-20 mg/dl",
-            "Cholesterol": "150-200 mg/dl",
-            "Triglyceride": "0-170 mg/dl",
-            "HDL": "30-96 (F)/30-70 (M) mg/dl",
-            "LDL": "<100 mg/dl",
-            "Bilirubin Total": "0.1-1.2 mg/dl",
-            "Bilirubin (Conjugated)": "0.0-0.3 mg/dl",
-            "Bilirubin (Unconjugated)": "0.1-1.0 mg/dl",
-            "SGOT/AST": "0-35 U/L",
-            "SGPT/ALT": "0-40 U/L",
-            "Alk. Phosphatase": "175-575 U/L",
-            "Total Protein": "6.5-8.0 gm/dl",
-            "Albumin": "3.5-5.0 gm/dl",
-            "Globulin": "2.3-3.5 gm/dl",
-            "A/G Ratio": "1.0-2.5",
-            "GGT": "8-60 U/L",
-            "S. Calcium": "8.8-11.0 mg/dl",
-            "S. Sodium": "138-148 meq/l",
-            "S. Potassium": "3.8-4.8 meq/l",
-            "Urine Protein (24 Hrs)": "24-120 mg/24 Hrs",
-            "Urine micro protein (albumin)": "28-150 mg/24 Hrs",
-            "CK-MB": "0-24 U/L",
-            "S. Phosphorous": "2.7-4.5 mg/dl",
-            "S. Amylase": "0-110 U/L",
-            "TROP-T": "Negative",
-            "Haemoglobin": "14-18 gm% (M)/12-15 gm% (F)",
-            "Total leukocyte count": "4000-10,000/cu mm",
-            "Differential WBC count - Polymorphs": "40-75%",
-            "Differential WBC count - Lymphocytes": "20-45%",
-            "Differential WBC count - Eosinophils": "1-6%",
-            "Differential WBC count - Monocytes": "0-10%",
-            "Differential WBC count - Basophiles": "0-1%",
-            "AEC": "40-500 No/cu mm",
-            "E.S.R. (Westergren)": "0-12 mm (F), 0-10 mm (M)",
-            "Platelet Count": "1.5-4.5 lac/cu mm",
-            "RBC Count": "F=3.5-5.0, M=4.2-5.5 million/cu mm",
-            "Reticulocyte count": "2-5% of RBC",
-            "Haematocrit/PCV": "M=39-49%, F=33-43%",
-            "MCV": "76-100 fl",
-            "MCH": "29.5 ± 2.5 pg",
-            "MCHC": "32.5 ± 2.5 gm/dl",
-            "Malaria Parasite": "Negative",
-            "BLOOD GROUP": "Rh = Positive/Negative",
-            "Bleeding Time": "2-7 Min.",
-            "Clotting Time": "6 Min.",
-            "Prothrombin Time": "10-14 Sec.",
-            "PERIPHERAL BLOOD SMEAR - RBC": "Normal morphology",
-            "PERIPHERAL BLOOD SMEAR - WBC": "Normal morphology",
-            "PERIPHERAL BLOOD SMEAR - PLATELET": "Adequate",
-            "PERIPHERAL BLOOD SMEAR - HAEMOPARASITE": "Negative",
-            "HbsAg": "Negative",
-            "HIV (1+2)": "Negative",
-            "HCV": "Negative",
-            "VDRL": "Non-reactive",
-            "ASO Titer": "<200 IU/ml",
-            "R.A. factor": "<20 IU/ml",
-            "CRP": "<6 mg/L",
-            "Gravindex (PREGNANCY)": "Negative",
-            "WIDAL TEST - S. Typhi, 'O'": "Negative (<1:80)",
-            "WIDAL TEST - S. Typhi, 'H'": "Negative (<1:160)",
-            "WIDAL TEST - S. Paratyphi, 'AH'": "Negative (<1:80)",
-            "WIDAL TEST - S. Paratyphi, 'BH'": "Negative (<1:80)",
-            "Dengue NS1": "Negative",
-            "Typhi Dot": "Negative"
-        }
+        # Views of TEST_CATALOG kept for the web form and report code
+        self.normal_ranges = {name: test.normal_range for name, test in TEST_CATALOG.items()}
+        self.tests = {category: [name for name, normal_range in tests] for category, tests in TEST_CATEGORIES}
+        
+        # Analyzer codes accepted by the result import, upper-cased
+        self.analyzer_codes = self.load_analyzer_codes(os.environ.get('ANALYZER_CODES_FILE'))
+        
+        # Set by the Tk launcher to show messages that must be sent by hand; called as (title, text)
+        self.on_manual_message = None
         
-        # Start Flask server for handling form submissions
+        # Flask app handling the web form and report submissions
         self.flask_app = Flask(__name__)
+        self.flask_app.extensions['pathology_service'] = self
         self.setup_flask_routes()
-        self.start_flask_server()
         
-        # Main title
-        title_label = tk.Label(self, text="UJJIVAN HOSPITAL PATHOLOGY SYSTEM", 
-                              font=("Arial", 20, "bold"), bg="#f0e1c6", fg="#003366")
-        title_label.pack(pady=(20,10))
-        
-        subtitle_label = tk.Label(self, text="Vidyut Nagar, Gautam Budh Nagar, Uttar Pradesh - 201008", 
-                                 font=("Arial", 12), bg="#f0e1c6")
-        subtitle_label.pack(pady=(0,20))
-
-        # Info text
-        info_label = tk.Label(self, text="This system will open in your web browser\nwhere you can fill patient information and select tests", 
-                             font=("Arial", 12), bg="#f0e1c6", justify=tk.CENTER)
-        info_label.pack(pady=(0,30))
-
-        # Launch button
-        launch_btn = tk.Button(self, text="🚀 Launch Web Application", 
-                              fg="white", bg="#28a745", font=("Arial", 16, "bold"), 
-                              command=self.launch_web_app, height=3, width=25)
-        launch_btn.pack(pady=(0, 20))
+        # Slow one-off setup runs after startup so the first request isn't kept waiting
+        self.warmed_up = threading.Event()
+        threading.Thread(target=self.warm_up, name='warm-up', daemon=True).start()
 
-        # Status label
-        self.status_label = tk.Label(self, text="Ready to launch...", 
-                                   font=("Arial", 10), bg="#f0e1c6", fg="#666")
-        self.status_label.pack(pady=(10,5))
+    def warm_up(self):
+        """Load PDF backends, templates and render workers in the background.
 
-        # Pathology tests data
-        self.tests = {
-            "BIOCHEMISTRY": [
-                "Glucose (F)/RI", "Post Prandial / after 2 Hrs", "HbA1c"
-            ],
-            "RENAL FUNCTION": [
-                "Urea", "Creatinine", "S. Uric Acid", "BUN"
-            ],
-            "LIPID PROFILE": [
-                "Cholesterol", "Triglyceride", "HDL", "LDL"
-            ],
-            "LIVER FUNCTION": [
-                "Bilirubin Total", "Bilirubin (Conjugated)", "Bilirubin (Unconjugated)", 
-                "SGOT/AST", "SGPT/ALT", "Alk. Phosphatase", "Total Protein", 
-                "Albumin", "Globulin", "A/G Ratio", "GGT"
-            ],
-            "ELECTROLYTES": [
-                "S. Calcium", "S. Sodium", "S. Potassium"
-            ],
-            "OTHER TESTS": [
-                "Urine Protein (24 Hrs)", "Urine micro protein (albumin)", 
-                "CK-MB", "S. Phosphorous", "S. Amylase", "TROP-T"
-            ],
-            "HAEMATOLOGY": [
-                "Haemoglobin", "Total leukocyte count", "Differential WBC count - Polymorphs",
-                "Differential WBC count - Lymphocytes", "Differential WBC count - Eosinophils",
-                "Differential WBC count - Monocytes", "Differential WBC count - Basophiles",
-                "AEC", "E.S.R. (Westergren)", "Platelet Count", "RBC Count", 
-                "Reticulocyte count", "Haematocrit/PCV", "MCV", "MCH", "MCHC",
-                "Malaria Parasite", "BLOOD GROUP", "Bleeding Time", "Clotting Time",
-                "Prothrombin Time", "PERIPHERAL BLOOD SMEAR - RBC", 
-                "PERIPHERAL BLOOD SMEAR - WBC", "PERIPHERAL BLOOD SMEAR - PLATELET",
-                "PERIPHERAL BLOOD SMEAR - HAEMOPARASITE"
-            ],
-            "SEROLOGY": [
-                "HbsAg", "HIV (1+2)", "HCV", "VDRL", "ASO Titer", "R.A. factor", 
-                "CRP", "Gravindex (PREGNANCY)", "WIDAL TEST - S. Typhi, 'O'",
-                "WIDAL TEST - S. Typhi, 'H'", "WIDAL TEST - S. Paratyphi, 'AH'",
-                "WIDAL TEST - S. Paratyphi, 'BH'", "Dengue NS1", "Typhi Dot"
-            ]
-        }
+        Anything still loading when a request needs it is waited for then,
+        so this only moves the cost off startup.
+        """
+        started = time.perf_counter()
+        try:
+            # Probe PDF backends once so reports don't pay for the fallback chain
+            PDF_RENDERERS.probe()
+            print(f"🖨️ Active PDF backend: {PDF_RENDERERS.active_backend() or 'none (HTML fallback)'}")
+            for name in ('fillable_form.html', 'pdf_report.html'):
+                REPORT_TEMPLATES.get_template(name)
+            # On a single core the spawned interpreters would compete with the first requests
+            if self.render_pool and (os.cpu_count() or 1) > 1:
+                self.render_pool.start_workers()
+        except Exception as e:
+            print(f"⚠️ Warm-up failed: {e}")
+        self.warmed_up.set()
+        print(f"🔥 Warm-up finished in {time.perf_counter() - started:.2f}s")
 
     def init_database(self):
         """Initialize SQLite database for storing reports"""
         try:
-            self.conn = sqlite3.connect('pathology_reports.db', check_same_thread=False)
-            self.cursor = self.conn.cursor()
+            self.db = SQLiteConnectionPool(DB_PATH)
+            
+            with self.db.transaction() as conn:
+                self.create_tables(conn)
+            print("Database initialized successfully")
+            
+            # Copy old JSON blobs into the normalized tables without holding up startup
+            threading.Thread(target=self.backfill_normalized_reports, daemon=True).start()
             
-            # Create table for form submissions
-            self.cursor.execute('''
+        except Exception as e:
+            print(f"Error initializing database: {e}")
+
+    @staticmethod
+    def create_tables(conn):
+        """Create the report tables if they don't exist yet, and add columns missing from older databases"""
+        # Create table for form submissions
+        conn.execute('''
                 CREATE TABLE IF NOT EXISTS form_submissions (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     patient_name TEXT,
@@ -233,10 +3220,10 @@ class PathologyTestsForm(tk.Tk):
                     selected_tests TEXT,
                     submission_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
-            ''')
-            
-            # Create table for completed reports
-            self.cursor.execute('''
+        ''')
+        
+        # Create table for completed reports
+        conn.execute('''
                 CREATE TABLE IF NOT EXISTS completed_reports (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     patient_name TEXT,
@@ -250,15 +3237,140 @@ class PathologyTestsForm(tk.Tk):
                     pdf_path TEXT,
                     whatsapp_status TEXT,
                     whatsapp_error TEXT,
+                    request_id TEXT,
+                    content_key TEXT,
                     report_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
-            ''')
+        ''')
+        
+        # Outbound WhatsApp/SMS messages waiting for the notification workers
+        conn.execute('''
+                CREATE TABLE IF NOT EXISTS notification_queue (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    completed_report_id INTEGER NOT NULL,
+                    provider TEXT NOT NULL,
+                    mobile TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    last_error TEXT,
+                    request_id TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    sent_at TIMESTAMP
+                )
+        ''')
+        # Analyzer result imports find submissions by OPD no
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_form_submissions_opd_no ON form_submissions (opd_no)')
+        conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_notification_queue_due
+                ON notification_queue (status, next_attempt_at)
+        ''')
+
+        # Background PDF render jobs, so every web worker process can report their status
+        conn.execute('''
+                CREATE TABLE IF NOT EXISTS render_jobs (
+                    job_id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    result TEXT,
+                    created_at REAL NOT NULL,
+                    finished_at REAL
+                )
+        ''')
+
+        # Databases from older builds predate the WhatsApp status, request id and content key columns
+        for table, added in (('completed_reports', ('whatsapp_status', 'whatsapp_error', 'request_id', 'content_key')),
+                             ('notification_queue', ('request_id',))):
+            columns = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+            for column in added:
+                if column not in columns:
+                    try:
+                        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} TEXT')
+                    except sqlite3.OperationalError as e:
+                        # Another worker process added it since the PRAGMA above
+                        if 'duplicate column' not in str(e):
+                            raise
+        # render_cache_key of the report; NULL (older rows, benchmarks) never conflicts
+        conn.execute(
+            'CREATE UNIQUE INDEX IF NOT EXISTS idx_completed_reports_content_key ON completed_reports (content_key)'
+        )
+        
+        # One statement at a time; executescript() would commit the open transaction
+        for statement in NORMALIZED_SCHEMA.split(';'):
+            if statement.strip():
+                conn.execute(statement)
+
+    def backfill_normalized_reports(self, batch_size=MIGRATION_BATCH_SIZE):
+        """Copy form_submissions and completed_reports rows into the normalized tables.
+
+        Runs in small batches, each in its own short transaction, so the app
+        keeps serving while it works. New rows are written to both places by
+        the store methods, and UNIQUE (kind, source_id) makes re-running safe.
+        Every gunicorn worker runs this at startup; rows another worker
+        copied first are skipped, and a batch that collides with another
+        writer is retried.
+        """
+        sources = (
+            (REPORT_KIND_ORDERED, 'form_submissions', 'selected_tests'),
+            (REPORT_KIND_COMPLETED, 'completed_reports', 'test_results'),
+        )
+        try:
+            migrated = 0
+            for kind, table, blob_column in sources:
+                last_id = 0
+                while True:
+                    for attempt in range(1, MIGRATION_BATCH_ATTEMPTS + 1):
+                        try:
+                            last_id, copied = self._backfill_batch(kind, table, blob_column, last_id, batch_size)
+                            break
+                        except (sqlite3.IntegrityError, sqlite3.OperationalError) as e:
+                            if attempt == MIGRATION_BATCH_ATTEMPTS:
+                                raise
+                            print(f"⚠️ Retrying migration batch of {table} after row {last_id}: {e}")
+                            time.sleep(0.1 * attempt)
+                    if last_id is None:
+                        break
+                    migrated += copied
             
-            self.conn.commit()
-            print("Database initialized successfully")
+            if migrated:
+                print(f"✅ Migrated {migrated} reports to the normalized tables")
+            return True
             
         except Exception as e:
-            print(f"Error initializing database: {e}")
+            print(f"❌ Error migrating reports to the normalized tables: {e}")
+            return False
+
+    def _backfill_batch(self, kind, table, blob_column, last_id, batch_size):
+        """Copy the next batch after last_id; returns (new last_id or None when done, rows copied)"""
+        copied = 0
+        with self.db.transaction() as conn:
+            rows = conn.execute(f'''
+                SELECT id, patient_name, patient_age, patient_gender, patient_mobile,
+                       doctor_name, opd_no, sample_date, {blob_column},
+                       {'pdf_path' if kind == REPORT_KIND_COMPLETED else 'NULL'}
+                FROM {table} AS source
+                WHERE id > ? AND NOT EXISTS (
+                    SELECT 1 FROM lab_reports WHERE kind = ? AND source_id = source.id
+                )
+                ORDER BY id LIMIT ?
+            ''', (last_id, kind, batch_size)).fetchall()
+            
+            for row in rows:
+                patient_data = dict(zip(
+                    ('name', 'age', 'gender', 'mobile', 'doctor', 'opd_no', 'sample_date'), row[1:8]
+                ))
+                try:
+                    tests = json.loads(row[8] or 'null')
+                except ValueError:
+                    print(f"⚠️ Unreadable {blob_column} in {table} row {row[0]}")
+                    tests = None
+                if isinstance(tests, list):
+                    tests = dict.fromkeys(tests)
+                # None when another process copied the row in the meantime
+                if self.insert_normalized_report(conn, kind, row[0], patient_data, tests or {}, row[9]):
+                    copied += 1
+        
+        return (rows[-1][0] if rows else None), copied
 
     def setup_flask_routes(self):
         """Setup Flask routes for handling form submissions and file serving"""
@@ -503,7 +3615,9 @@ class PathologyTestsForm(tk.Tk):
         def handle_form_submission():
             if request.method == 'OPTIONS':
                 return jsonify({'status': 'ok'}), 200
-                
+            
+            # Stage timings, kept under the request id; see /debug/trace
+            trace = self.tracer.start(g.request_id)
             try:
                 # Ensure content type is JSON
                 if not request.is_json:
@@ -526,97 +3640,50 @@ class PathologyTestsForm(tk.Tk):
                 print(f"Mobile Number: {patient_data.get('mobile', 'Not provided')}")
                 print(f"Test results received: {len(test_results)} tests")
                 
-                # Validate required fields
-                required_fields = ['name', 'age', 'gender', 'mobile']
-                for field in required_fields:
-                    if not patient_data.get(field):
-                        return jsonify({
-                            'success': False,
-                            'message': f'Missing required field: {field}'
-                        }), 400
-                
-                # Generate PDF from filled data
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                patient_name_clean = patient_data.get('name', 'Unknown').replace(' ', '_').replace('/', '_').replace('\\', '_')
-                pdf_filename = f"Pathology_Report_{patient_name_clean}_{timestamp}.pdf"
-                pdf_filepath = os.path.join('reports', 'completed_reports', pdf_filename)
-                
-                # Ensure directory exists
-                os.makedirs('reports/completed_reports', exist_ok=True)
-                
-                # Generate HTML content for PDF WITH FILLED RESULTS
-                html_content = self.generate_pdf_html(patient_data, test_results)
+                with trace.span('validate', tests=len(test_results)):
+                    validation_error = self.validate_submission(patient_data, test_results)
+                if validation_error:
+                    return jsonify({
+                        'success': False,
+                        'message': validation_error
+                    }), 400
                 
-                # Generate PDF using available method
-                pdf_success, pdf_bytes = self.generate_pdf_bytes(html_content)
+                # Generate HTML content for PDF WITH FILLED RESULTS; retries and
+                # reprints of the same report reuse the earlier render
+                with trace.span('build_html') as span:
+                    cache_key, html_content, cached_pdf = self.generate_report_html(patient_data, test_results)
+                    span['cache_hit'] = bool(cached_pdf)
+                if cached_pdf:
+                    print("♻️ Reusing cached render")
+                    return jsonify(self.finish_report(
+                        patient_data, test_results, html_content, True, cached_pdf, cache_key, trace
+                    ))
                 
-                if pdf_success and pdf_bytes:
-                    # Save PDF to file
-                    with open(pdf_filepath, 'wb') as f:
-                        f.write(pdf_bytes)
-                    
-                    print(f"✅ PDF saved to: {pdf_filepath}")
-                    
-                    # Generate view URL for the PDF
-                    pdf_url = f"http://localhost:5000/view-pdf/{pdf_filename}"
-                    
-                    # Send WhatsApp message with PDF view link
-                    whatsapp_success, whatsapp_message = self.send_whatsapp_direct(
-                        patient_data.get('mobile', ''), 
-                        patient_data,
-                        pdf_url
-                    )
-                    
-                    # Store in database with WhatsApp status
-                    db_success = self.store_completed_report(
-                        patient_data, 
-                        test_results, 
-                        pdf_filepath, 
-                        whatsapp_success, 
-                        whatsapp_message
-                    )
-                    
-                    return jsonify({
-                        'success': True,
-                        'message': 'Report submitted successfully! PDF generated and WhatsApp message sent.',
-                        'whatsapp_status': 'sent' if whatsapp_success else 'failed',
-                        'whatsapp_message': whatsapp_message,
-                        'pdf_path': pdf_filepath,
-                        'pdf_url': pdf_url
-                    })
-                else:
-                    # If PDF generation fails, still store the data and return HTML option
-                    html_filename = f"Pathology_Report_{patient_name_clean}_{timestamp}.html"
-                    html_filepath = os.path.join('reports', 'completed_reports', html_filename)
-                    
-                    with open(html_filepath, 'w', encoding='utf-8') as f:
-                        f.write(html_content)
-                    
-                    # Use view-pdf for HTML files as well
-                    html_url = f"http://localhost:5000/view-pdf/{html_filename}"
-                    
-                    whatsapp_success, whatsapp_message = self.send_whatsapp_direct(
-                        patient_data.get('mobile', ''), 
-                        patient_data,
-                        html_url
-                    )
-                    
-                    self.store_completed_report(
-                        patient_data, 
-                        test_results, 
-                        html_filepath, 
-                        whatsapp_success, 
-                        whatsapp_message
+                if self.render_pool:
+                    # Render in a worker process and let the form poll for the result
+                    job_id = self.render_pool.submit(
+                        html_content,
+                        lambda pdf_success, pdf_bytes: self.finish_report(
+                            patient_data, test_results, html_content, pdf_success, pdf_bytes, cache_key, trace
+                        ),
+                        trace
                     )
-                    
+                    print(f"🕒 Report queued for rendering: {job_id}")
                     return jsonify({
                         'success': True,
-                        'message': 'Report submitted successfully! (HTML version - PDF generation failed)',
-                        'whatsapp_status': 'sent' if whatsapp_success else 'failed',
-                        'whatsapp_message': whatsapp_message,
-                        'pdf_path': html_filepath,
-                        'pdf_url': html_url
-                    })
+                        'message': 'Report received. PDF is being generated.',
+                        'job_id': job_id,
+                        'status': 'queued',
+                        'status_url': url_for('report_status', job_id=job_id)
+                    }), 202
+                
+                # Generate PDF using available method
+                with trace.span('render_pdf') as span:
+                    span['attempts'] = []
+                    pdf_success, pdf_bytes = self.generate_pdf_bytes(html_content, span['attempts'])
+                return jsonify(self.finish_report(
+                    patient_data, test_results, html_content, pdf_success, pdf_bytes, cache_key, trace
+                ))
                     
             except Exception as e:
                 print(f"❌ Error in form submission: {e}")
@@ -626,986 +3693,1135 @@ class PathologyTestsForm(tk.Tk):
                     'success': False,
                     'message': f'Server Error: {str(e)}'
                 }), 500
+            finally:
+                trace.finish()
 
-        # Route for VIEWING PDF in browser
-        @self.flask_app.route('/view-pdf/<filename>')
-        def view_pdf(filename):
-            try:
-                if '..' in filename or filename.startswith('/'):
-                    return jsonify({'error': 'Invalid filename'}), 400
-                    
-                directory = os.path.join(os.getcwd(), 'reports', 'completed_reports')
-                filepath = os.path.join(directory, filename)
-                
-                if not os.path.exists(filepath):
-                    return jsonify({'error': f'File not found: {filename}'}), 404
-                
-                # Determine content type
-                if filename.lower().endswith('.pdf'):
-                    mimetype = 'application/pdf'
-                    print(f"📄 Serving PDF: {filename}")
-                    return send_from_directory(
-                        directory, 
-                        filename, 
-                        as_attachment=False,
-                        mimetype=mimetype
-                    )
-                elif filename.lower().endswith('.html'):
-                    mimetype = 'text/html'
-                    with open(filepath, 'r', encoding='utf-8') as f:
-                        html_content = f.read()
-                    return Response(html_content, mimetype=mimetype)
-                else:
-                    return send_from_directory(directory, filename, as_attachment=True)
-                    
-            except Exception as e:
-                return jsonify({'error': str(e)}), 404
-
-        @self.flask_app.after_request
-        def after_request(response):
-            response.headers.add('Access-Control-Allow-Origin', '*')
-            response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
-            response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
-            return response
-
-    def start_flask_server(self):
-        """Start Flask server in a separate thread"""
-        def run_flask():
-            try:
-                print("🚀 Starting Flask server on http://127.0.0.1:5000")
-                print("📁 Reports directory: reports/completed_reports/")
-                self.flask_app.run(host='127.0.0.1', port=5000, debug=False, use_reloader=False, threaded=True)
-            except Exception as e:
-                print(f"❌ Flask server error: {e}")
-        
-        self.flask_thread = threading.Thread(target=run_flask, daemon=True)
-        self.flask_thread.start()
-        time.sleep(2)  # Give server time to start
-
-    def launch_web_app(self):
-        """Launch the web application in browser"""
-        self.status_label.config(text="Opening web application...")
-        
-        flask_url = "http://localhost:5000/"
-        webbrowser.open(flask_url)
-        
-        self.status_label.config(text="Web application opened in browser!")
-        messagebox.showinfo("Success", f"Web application opened in browser!\n\nIf it doesn't load automatically, visit:\n{flask_url}")
-
-    def generate_exact_format_html_form(self, patient_data, selected_tests):
-        """Generate HTML form in the exact format as provided"""
-        serial_no = 1
-        
-        # Start building the HTML content
-        html_content = f'''<!DOCTYPE html>
-<html lang="en">
-<head>
-  <meta charset="UTF-8">
-  <title>UJJIVAN Hospital Pathology Report</title>
-  <meta name="viewport" content="width=device-width, initial-scale=1">
-  <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/css/bootstrap.min.css" rel="stylesheet">
-
-  <style>
-    body {{
-      background: #f8f9fa;
-      font-family: 'Times New Roman', serif;
-    }}
-
-    .report-container {{
-      background: #fff;
-      border: 2px solid #000;
-      padding: 40px 50px;
-      max-width: 900px;
-      margin: 30px auto;
-      box-shadow: 0 0 10px rgba(0,0,0,0.15);
-    }}
-
-    .header {{
-      text-align: center;
-      border-bottom: 2px solid #000;
-      margin-bottom: 15px;
-      padding-bottom: 8px;
-    }}
-
-    .header h2 {{
-      font-weight: bold;
-      text-transform: uppercase;
-      color: #003366;
-    }}
-
-    .hospital-info {{
-      font-size: 13px;
-    }}
-
-    .patient-info {{
-      font-size: 14px;
-      margin-bottom: 15px;
-    }}
-
-    .section-title {{
-      background: #e8f0ff;
-      color: #003366;
-      font-weight: bold;
-      border: 1px solid #003366;
-      padding: 6px 8px;
-      text-transform: uppercase;
-      margin-top: 20px;
-    }}
-
-    table {{
-      width: 100%;
-      border-collapse: collapse;
-      margin-bottom: 10px;
-      font-size: 14px;
-    }}
-
-    th, td {{
-      border: 1px solid #666;
-      padding: 6px;
-    }}
-
-    th {{
-      background: #e9ecef;
-      text-align: center;
-    }}
-
-    input.result {{
-      border: none;
-      border-bottom: 1px solid #888;
-      width: 100%;
-      outline: none;
-      text-align: center;
-      background: #fefefe;
-      font-weight: bold;
-    }}
-
-    .footer {{
-      text-align: right;
-      margin-top: 40px;
-      font-weight: bold;
-    }}
-
-    @media print {{
-      body {{
-        background: white;
-      }}
-      .report-container {{
-        box-shadow: none;
-        border: 1px solid #000;
-        margin: 0;
-      }}
-      input.result {{
-        border: none;
-      }}
-    }}
-  </style>
-</head>
-<body>
-
-  <div class="report-container">
-
-    <div class="header">
-      <h2>Pathology Test Report</h2>
-      <div class="hospital-info">
-        <p>UJJIVAN Hospital, Vidyut Nagar, Gautam Budh Nagar, Uttar Pradesh - 201008</p>
-      </div>
-    </div>
+        @self.flask_app.route('/submit-reports', methods=['POST', 'OPTIONS'])
+        def handle_batch_submission():
+            """Submit many reports at once, e.g. the results of a finished analyzer run.
 
-    <div class="row patient-info">
-      <div class="col-6">
-        <strong>OPD No:</strong> <input type="text" class="result" placeholder="" value="{patient_data['opd_no']}" id="opd_no"><br>
-        <strong>Patient Name:</strong> <input type="text" class="result" placeholder="" value="{patient_data['name']}" id="patient_name"><br>
-        <strong>Age/Sex:</strong> <input type="text" class="result" placeholder="" value="{patient_data['age']}/{patient_data['gender']}" id="age_gender">
-      </div>
-      <div class="col-6 text-end">
-        <strong>Doctor Name:</strong> <input type="text" class="result" placeholder="" value="{patient_data['doctor']}" id="doctor_name"><br>
-        <strong>Sample Date:</strong> <input type="text" class="result" placeholder="" value="{patient_data['sample_date']}" id="sample_date">
-      </div>
-    </div>
-'''
-        
-        # BIOCHEMISTRY Section
-        if any(test in selected_tests for test in ["Glucose (F)/RI", "Post Prandial / after 2 Hrs", "HbA1c"]):
-            html_content += '''
-    <!-- BIOCHEMISTRY -->
-    <div class="section-title">BIOCHEMISTRY</div>
-    <table>
-      <thead>
-        <tr>
-          <th>S.No</th>
-          <th>Test Description</th>
-          <th>Normal Value</th>
-          <th>Result Value</th>
-        </tr>
-      </thead>
-      <tbody>
-'''
-            biochemistry_tests = [
-                ("Glucose (F)/RI", "70-110 mg/dl"),
-                ("Post Prandial / after 2 Hrs", "Up to 140 mg/dl"),
-                ("HbA1c", "4.5-6.5 %")
-            ]
-            
-            for test_name, normal_value in biochemistry_tests:
-                if test_name in selected_tests:
-                    html_content += f'        <tr><td>{serial_no}</td><td>{test_name}</td><td>{normal_value}</td><td><input type="text" class="result" placeholder="Enter value" name="{test_name}" id="{test_name.replace(" ", "_").replace("(", "").replace(")", "").replace("/", "").replace(" ", "")}"></td></tr>\n'
-                    serial_no += 1
+            Accepts {"reports": [{"patient_data": ..., "test_results": ...}, ...]}
+            and answers with one status per report, streamed as NDJSON when the
+            client sends Accept: application/x-ndjson.
+            """
+            if request.method == 'OPTIONS':
+                return jsonify({'status': 'ok'}), 200
+            
+            if not request.is_json:
+                return jsonify({
+                    'success': False,
+                    'message': 'Content-Type must be application/json'
+                }), 400
+            
+            data = request.get_json(silent=True)
+            reports = data.get('reports') if isinstance(data, dict) else data
+            if not isinstance(reports, list) or not reports:
+                return jsonify({
+                    'success': False,
+                    'message': 'Expected a non-empty list of reports'
+                }), 400
+            
+            if len(reports) > MAX_BATCH_REPORTS:
+                return jsonify({
+                    'success': False,
+                    'message': f'Too many reports in one batch (max {MAX_BATCH_REPORTS})'
+                }), 413
+            
+            # Validate everything before rendering or storing anything
+            errors = []
+            for index, report in enumerate(reports):
+                if not isinstance(report, dict) or not isinstance(report.get('patient_data', {}), dict) \
+                        or not isinstance(report.get('test_results', {}), dict):
+                    errors.append({'index': index, 'message': 'patient_data and test_results must be objects'})
+                    continue
+                validation_error = self.validate_submission(report.get('patient_data', {}), report.get('test_results', {}))
+                if validation_error:
+                    errors.append({'index': index, 'message': validation_error})
             
-            html_content += '''      </tbody>
-    </table>
-'''
+            if errors:
+                return jsonify({
+                    'success': False,
+                    'message': f'{len(errors)} of {len(reports)} reports failed validation',
+                    'errors': errors
+                }), 400
+            
+            print(f"Received batch of {len(reports)} reports")
+            results = self.process_report_batch(reports, g.request_id)
+            
+            if 'application/x-ndjson' in request.headers.get('Accept', ''):
+                # The batch runs on its own thread, so it still finishes if the client disconnects
+                return Response(
+                    (json.dumps(result) + '\n' for result in consume_in_background(results, 'report-batch')),
+                    mimetype='application/x-ndjson'
+                )
+            
+            results = list(results)
+            summary = results.pop()
+            return jsonify({
+                'success': summary['success'],
+                'message': summary['message'],
+                'results': sorted(results, key=lambda result: result['index'])
+            })
 
-        # RENAL FUNCTION Section
-        if any(test in selected_tests for test in ["Urea", "Creatinine", "S. Uric Acid", "BUN"]):
-            html_content += '''
-    <!-- RENAL FUNCTION -->
-    <div class="section-title">RENAL FUNCTION</div>
-    <table>
-      <thead>
-        <tr>
-          <th>S.No</th>
-          <th>Test Description</th>
-          <th>Normal Value</th>
-          <th>Result Value</th>
-        </tr>
-      </thead>
-      <tbody>
-'''
-            renal_tests = [
-                ("Urea", "10-40 mg/dl"),
-                ("Creatinine", "0.6-1.4 mg/dl"),
-                ("S. Uric Acid", "2.8-7.0 mg/dl"),
-                ("BUN", "5-20 mg/dl")
-            ]
-            
-            for test_name, normal_value in renal_tests:
-                if test_name in selected_tests:
-                    html_content += f'        <tr><td>{serial_no}</td><td>{test_name}</td><td>{normal_value}</td><td><input type="text" class="result" placeholder="Enter value" name="{test_name}" id="{test_name.replace(" ", "_").replace(".", "").replace(" ", "")}"></td></tr>\n'
-                    serial_no += 1
+        @self.flask_app.route('/report-status/<job_id>')
+        def report_status(job_id):
+            """Poll the status of a queued report render"""
+            if not self.render_pool:
+                return jsonify({'success': False, 'message': 'PDF render workers are disabled'}), 404
             
-            html_content += '''      </tbody>
-    </table>
-'''
+            status, result = self.render_pool.get_status(job_id)
+            if status is None:
+                return jsonify({'success': False, 'message': f'Unknown job: {job_id}'}), 404
+            
+            response = {'success': True, 'job_id': job_id, 'status': status}
+            if result:
+                response.update(result)
+            return jsonify(response)
 
-        # LIPID PROFILE Section
-        if any(test in selected_tests for test in ["Cholesterol", "Triglyceride", "HDL", "LDL"]):
-            html_content += '''
-    <!-- LIPID PROFILE -->
-    <div class="section-title">LIPID PROFILE</div>
-    <table>
-      <thead>
-        <tr>
-          <th>S.No</th>
-          <th>Test Description</th>
-          <th>Normal Value</th>
-          <th>Result Value</th>
-        </tr>
-      </thead>
-      <tbody>
-'''
-            lipid_tests = [
-                ("Cholesterol", "150-200 mg/dl"),
-                ("Triglyceride", "0-170 mg/dl"),
-                ("HDL", "30-96 (F)/30-70 (M) mg/dl"),
-                ("LDL", "<100 mg/dl")
-            ]
-            
-            for test_name, normal_value in lipid_tests:
-                if test_name in selected_tests:
-                    html_content += f'        <tr><td>{serial_no}</td><td>{test_name}</td><td>{normal_value}</td><td><input type="text" class="result" placeholder="Enter value" name="{test_name}" id="{test_name.replace(" ", "_")}"></td></tr>\n'
-                    serial_no += 1
+        @self.flask_app.route('/reports')
+        def report_history():
+            """Search completed reports by mobile, opd_no, name prefix or date range.
+
+            Results are newest first. Pass the returned next_cursor as ?cursor=
+            to get the following page. Lists every patient, so admin only.
+            """
+            if not self.is_admin_request():
+                return jsonify({'success': False, 'message': 'Admin access required'}), 403
+            filters = {key: request.args.get(key, '').strip() for key in ('mobile', 'opd_no', 'name', 'from', 'to')}
+            try:
+                limit = int(request.args.get('limit', REPORT_PAGE_SIZE))
+                cursor = request.args.get('cursor')
+                reports, next_cursor = self.search_reports(
+                    mobile=filters['mobile'],
+                    opd_no=filters['opd_no'],
+                    name_prefix=filters['name'],
+                    date_from=filters['from'],
+                    date_to=filters['to'],
+                    limit=limit,
+                    cursor=cursor
+                )
+            except ValueError as e:
+                return jsonify({'success': False, 'message': str(e)}), 400
+            except Exception as e:
+                print(f"❌ Error searching reports: {e}")
+                return jsonify({'success': False, 'message': f'Server Error: {str(e)}'}), 500
             
-            html_content += '''      </tbody>
-    </table>
-'''
+            return jsonify({'success': True, 'reports': reports, 'next_cursor': next_cursor})
 
-        # LIVER FUNCTION Section
-        if any(test in selected_tests for test in ["Bilirubin Total", "Bilirubin (Conjugated)", "Bilirubin (Unconjugated)", "SGOT/AST", "SGPT/ALT", "Alk. Phosphatase", "Total Protein", "Albumin", "Globulin", "A/G Ratio", "GGT"]):
-            html_content += '''
-    <!-- LIVER FUNCTION -->
-    <div class="section-title">LIVER FUNCTION</div>
-    <table>
-      <thead>
-        <tr>
-          <th>S.No</th>
-          <th>Test Description</th>
-          <th>Normal Value</th>
-          <th>Result Value</th>
-        </tr>
-      </thead>
-      <tbody>
-'''
-            liver_tests = [
-                ("Bilirubin Total", "0.1-1.2 mg/dl (new born 1.0-12.0)"),
-                ("Bilirubin (Conjugated)", "0.0-0.3 mg/dl"),
-                ("Bilirubin (Unconjugated)", "0.1-1.0 mg/dl"),
-                ("SGOT/AST", "0-35 U/L"),
-                ("SGPT/ALT", "0-40 U/L"),
-                ("Alk. Phosphatase", "175-575 U/L (<15 years) + (10-290 U/L (<15 years))"),
-                ("Total Protein", "6.5-8.0 gm/dl"),
-                ("Albumin", "3.5-5.0 gm/dl"),
-                ("Globulin", "2.3-3.5 gm/dl"),
-                ("A/G Ratio", "1.0-2.5"),
-                ("GGT", "8-60 U/L")
-            ]
-            
-            for test_name, normal_value in liver_tests:
-                if test_name in selected_tests:
-                    html_content += f'        <tr><td>{serial_no}</td><td>{test_name}</td><td>{normal_value}</td><td><input type="text" class="result" placeholder="Enter value" name="{test_name}" id="{test_name.replace(" ", "_").replace("(", "").replace(")", "").replace("/", "").replace(".", "").replace(" ", "")}"></td></tr>\n'
-                    serial_no += 1
+        @self.flask_app.route('/reports/trend')
+        def report_trend():
+            """Values of one test over time for a patient, e.g. ?mobile=...&test=HbA1c. Admin only."""
+            if not self.is_admin_request():
+                return jsonify({'success': False, 'message': 'Admin access required'}), 403
+            mobile = request.args.get('mobile', '').strip()
+            test_name = request.args.get('test', '').strip()
+            if not mobile or not test_name:
+                return jsonify({'success': False, 'message': 'mobile and test are required'}), 400
+            if test_name not in TEST_CATALOG:
+                return jsonify({'success': False, 'message': f'Unknown test: {test_name}'}), 400
             
-            html_content += '''      </tbody>
-    </table>
-'''
+            try:
+                series = self.get_test_trend(mobile, test_name, request.args.get('name', '').strip())
+            except Exception as e:
+                print(f"❌ Error loading trend: {e}")
+                return jsonify({'success': False, 'message': f'Server Error: {str(e)}'}), 500
+            
+            test = TEST_CATALOG[test_name]
+            return jsonify({
+                'success': True,
+                'test': test_name,
+                'normal_range': test.normal_range,
+                'units': test.units,
+                'series': series
+            })
 
-        # ELECTROLYTES Section
-        if any(test in selected_tests for test in ["S. Calcium", "S. Sodium", "S. Potassium"]):
-            html_content += '''
-    <!-- ELECTROLYTES -->
-    <div class="section-title">ELECTROLYTES</div>
-    <table>
-      <thead>
-        <tr>
-          <th>S.No</th>
-          <th>Test Description</th>
-          <th>Normal Value</th>
-          <th>Result Value</th>
-        </tr>
-      </thead>
-      <tbody>
-'''
-            electrolyte_tests = [
-                ("S. Calcium", "8.8-11.0 mg/dl"),
-                ("S. Sodium", "138-148 meq/l"),
-                ("S. Potassium", "3.8-4.8 meq/l")
-            ]
-            
-            for test_name, normal_value in electrolyte_tests:
-                if test_name in selected_tests:
-                    html_content += f'        <tr><td>{serial_no}</td><td>{test_name}</td><td>{normal_value}</td><td><input type="text" class="result" placeholder="Enter value" name="{test_name}" id="{test_name.replace(" ", "_").replace(".", "").replace(" ", "")}"></td></tr>\n'
-                    serial_no += 1
+        @self.flask_app.route('/render-cache')
+        def render_cache_stats():
+            """Hit/miss counters and size of the rendered-report cache"""
+            return jsonify(self.render_cache.stats())
+
+        @self.flask_app.route('/notification-queue')
+        def notification_queue_stats():
+            """Queued, sent and failed WhatsApp notifications by provider"""
+            return jsonify(self.notifications.stats())
+
+        @self.flask_app.route('/notifications/dispatch', methods=['POST'])
+        def dispatch_notifications():
+            """Send all due WhatsApp API notifications now as template messages.
+
+            Optional ?limit= and ?concurrency= override the bulk defaults, up to
+            NOTIFICATION_DISPATCH_MAX_LIMIT / _MAX_CONCURRENCY. The response
+            lists every recipient's result and the overall send rate.
+            """
+            if not self.is_admin_request():
+                return jsonify({'success': False, 'message': 'Admin access required'}), 403
+            if not self.whatsapp_api_configured():
+                return jsonify({'success': False, 'message': 'WhatsApp Business API not configured'}), 400
+            try:
+                limit = int(request.args.get('limit', NOTIFICATION_BULK_LIMIT))
+                concurrency = int(request.args.get('concurrency', self.notification_bulk_concurrency))
+            except ValueError:
+                return jsonify({'success': False, 'message': 'limit and concurrency must be integers'}), 400
+            if limit < 1 or concurrency < 1:
+                return jsonify({'success': False, 'message': 'limit and concurrency must be positive'}), 400
+            limit = min(limit, NOTIFICATION_DISPATCH_MAX_LIMIT)
+            concurrency = min(concurrency, NOTIFICATION_DISPATCH_MAX_CONCURRENCY)
             
-            html_content += '''      </tbody>
-    </table>
-'''
+            summary = self.notifications.dispatch_bulk(
+                'whatsapp_api', self.deliver_template_notification, concurrency, limit
+            )
+            summary['success'] = True
+            return jsonify(summary)
 
-        # OTHER TESTS Section
-        if any(test in selected_tests for test in ["Urine Protein (24 Hrs)", "Urine micro protein (albumin)", "CK-MB", "S. Phosphorous", "S. Amylase", "TROP-T"]):
-            html_content += '''
-    <!-- OTHER TESTS -->
-    <div class="section-title">OTHER TESTS</div>
-    <table>
-      <thead>
-        <tr>
-          <th>S.No</th>
-          <th>Test Description</th>
-          <th>Normal Value</th>
-          <th>Result Value</th>
-        </tr>
-      </thead>
-      <tbody>
-'''
-            other_tests = [
-                ("Urine Protein (24 Hrs)", "24-120 mg/24 Hrs"),
-                ("Urine micro protein (albumin)", "28-150 mg/24 Hrs (24 hrs.) (<10mg/dl for ran)"),
-                ("CK-MB", "0-24 U/L"),
-                ("S. Phosphorous", "2.7-4.5 mg/dl"),
-                ("S. Amylase", "0-110 U/L"),
-                ("TROP-T", "-")
-            ]
-            
-            for test_name, normal_value in other_tests:
-                if test_name in selected_tests:
-                    html_content += f'        <tr><td>{serial_no}</td><td>{test_name}</td><td>{normal_value}</td><td><input type="text" class="result" placeholder="Enter value" name="{test_name}" id="{test_name.replace(" ", "_").replace("(", "").replace(")", "").replace(".", "").replace(" ", "")}"></td></tr>\n'
-                    serial_no += 1
+        @self.flask_app.route('/export/completed-reports')
+        def export_reports():
+            """Stream completed reports, one line per test: ?format=csv|ndjson|columnar&from=&to="""
+            if not self.is_admin_request():
+                return jsonify({'success': False, 'message': 'Admin access required'}), 403
+            fmt = request.args.get('format', 'csv')
+            if fmt not in EXPORT_FORMATS:
+                return jsonify({'success': False, 'message': f"format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+            try:
+                date_from = _export_date(request.args.get('from'))
+                date_to = _export_date(request.args.get('to'))
+            except ValueError:
+                return jsonify({'success': False, 'message': 'from and to must be YYYY-MM-DD dates'}), 400
             
-            html_content += '''      </tbody>
-    </table>
-'''
+            mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+            extension = 'csv' if fmt == 'csv' else 'ndjson'
+            return Response(
+                export_completed_reports(self.db, fmt, date_from, date_to), mimetype=mimetype,
+                headers={'Content-Disposition': f'attachment; filename=completed_reports.{extension}'}
+            )
 
-        # HAEMATOLOGY Section - NEW
-        if any(test in selected_tests for test in ["Haemoglobin", "Total leukocyte count", "Differential WBC count - Polymorphs", 
-                                                  "Differential WBC count - Lymphocytes", "Differential WBC count - Eosinophils",
-                                                  "Differential WBC count - Monocytes", "Differential WBC count - Basophiles",
-                                                  "AEC", "E.S.R. (Westergren)", "Platelet Count", "RBC Count", 
-                                                  "Reticulocyte count", "Haematocrit/PCV", "MCV", "MCH", "MCHC",
-                                                  "Malaria Parasite", "BLOOD GROUP", "Bleeding Time", "Clotting Time",
-                                                  "Prothrombin Time", "PERIPHERAL BLOOD SMEAR - RBC", 
-                                                  "PERIPHERAL BLOOD SMEAR - WBC", "PERIPHERAL BLOOD SMEAR - PLATELET",
-                                                  "PERIPHERAL BLOOD SMEAR - HAEMOPARASITE"]):
-            html_content += '''
-    <!-- HAEMATOLOGY -->
-    <div class="section-title">HAEMATOLOGY</div>
-    <table>
-      <thead>
-        <tr>
-          <th>S.No</th>
-          <th>Test Description</th>
-          <th>Normal Value</th>
-          <th>Result Value</th>
-        </tr>
-      </thead>
-      <tbody>
-'''
-            haematology_tests = [
-                ("Haemoglobin", "14-18 gm% (M)/12-15 gm% (F)"),
-                ("Total leukocyte count", "4000-10,000/cu mm of blood"),
-                ("Differential WBC count - Polymorphs", "40-75%"),
-                ("Differential WBC count - Lymphocytes", "20-45%"),
-                ("Differential WBC count - Eosinophils", "1-6%"),
-                ("Differential WBC count - Monocytes", "0-10%"),
-                ("Differential WBC count - Basophiles", "0-1%"),
-                ("AEC", "40-500 No/cu mm"),
-                ("E.S.R. (Westergren)", "0-12 mm (F), 0-10 mm (M) at the end of 1st hr."),
-                ("Platelet Count", "1.5-4.5 lac/cu mm of blood"),
-                ("RBC Count", "F=3.5 to 5.0, M=4.2-5.5 lac/cu mm"),
-                ("Reticulocyte count", "2-5% of RBC"),
-                ("Haematocrit/PCV", "M=39-49%, F=33-43%"),
-                ("MCV", "76-100 fl"),
-                ("MCH", "29.5 ± 2.5 pg"),
-                ("MCHC", "32.5 ± 2.5 gm/dl"),
-                ("Malaria Parasite", "-"),
-                ("BLOOD GROUP", "Rh = Positive/Negative"),
-                ("Bleeding Time", "2-7 Min. (Ivy's method)"),
-                ("Clotting Time", "6 Min. (Lee & White, 37°C)"),
-                ("Prothrombin Time", "10-14 Sec."),
-                ("PERIPHERAL BLOOD SMEAR - RBC", "-"),
-                ("PERIPHERAL BLOOD SMEAR - WBC", "-"),
-                ("PERIPHERAL BLOOD SMEAR - PLATELET", "-"),
-                ("PERIPHERAL BLOOD SMEAR - HAEMOPARASITE", "-")
-            ]
-            
-            for test_name, normal_value in haematology_tests:
-                if test_name in selected_tests:
-                    html_content += f'        <tr><td>{serial_no}</td><td>{test_name}</td><td>{normal_value}</td><td><input type="text" class="result" placeholder="Enter value" name="{test_name}" id="{test_name.replace(" ", "_").replace("(", "").replace(")", "").replace("/", "").replace(".", "").replace(" ", "").replace("-", "_")}"></td></tr>\n'
-                    serial_no += 1
+        @self.flask_app.route('/import/analyzer-results', methods=['POST'])
+        def import_analyzer_file():
+            """Create reports from an uploaded analyzer file (multipart or raw body); ?format=csv|hl7"""
+            if not self.is_admin_request():
+                return jsonify({'success': False, 'message': 'Admin access required'}), 403
+            fmt = request.args.get('format')
+            if fmt and fmt not in IMPORT_FORMATS:
+                return jsonify({'success': False, 'message': f"format must be one of {', '.join(IMPORT_FORMATS)}"}), 400
             
-            html_content += '''      </tbody>
-    </table>
-'''
+            upload = next(iter(request.files.values()), None)
+            stream = upload.stream if upload else request.stream
+            # Universal newlines also split HL7 segments, which end in a bare CR
+            lines = io.TextIOWrapper(stream, encoding='utf-8-sig', errors='replace', newline=None)
+            summary = self.import_analyzer_results(lines, fmt, request_id=g.request_id)
+            return jsonify(summary), 200 if summary['success'] else 400
 
-        # SEROLOGY Section - NEW
-        if any(test in selected_tests for test in ["HbsAg", "HIV (1+2)", "HCV", "VDRL", "ASO Titer", "R.A. factor", 
-                                                  "CRP", "Gravindex (PREGNANCY)", "WIDAL TEST - S. Typhi, 'O'",
-                                                  "WIDAL TEST - S. Typhi, 'H'", "WIDAL TEST - S. Paratyphi, 'AH'",
-                                                  "WIDAL TEST - S. Paratyphi, 'BH'", "Dengue NS1", "Typhi Dot"]):
-            html_content += '''
-    <!-- SEROLOGY -->
-    <div class="section-title">SEROLOGY</div>
-    <table>
-      <thead>
-        <tr>
-          <th>S.No</th>
-          <th>Test Description</th>
-          <th>Normal Value</th>
-          <th>Result Value</th>
-        </tr>
-      </thead>
-      <tbody>
-'''
-            serology_tests = [
-                ("HbsAg", "Negative"),
-                ("HIV (1+2)", "Negative"),
-                ("HCV", "Negative"),
-                ("VDRL", "Non-reactive"),
-                ("ASO Titer", "<200 IU/ml"),
-                ("R.A. factor", "<20 IU/ml"),
-                ("CRP", "<6 mg/L"),
-                ("Gravindex (PREGNANCY)", "Negative"),
-                ("WIDAL TEST - S. Typhi, 'O'", "Negative (<1:80)"),
-                ("WIDAL TEST - S. Typhi, 'H'", "Negative (<1:160)"),
-                ("WIDAL TEST - S. Paratyphi, 'AH'", "Negative (<1:80)"),
-                ("WIDAL TEST - S. Paratyphi, 'BH'", "Negative (<1:80)"),
-                ("Dengue NS1", "Negative"),
-                ("Typhi Dot", "Negative")
-            ]
-            
-            for test_name, normal_value in serology_tests:
-                if test_name in selected_tests:
-                    html_content += f'        <tr><td>{serial_no}</td><td>{test_name}</td><td>{normal_value}</td><td><input type="text" class="result" placeholder="Enter value" name="{test_name}" id="{test_name.replace(" ", "_").replace("(", "").replace(")", "").replace("/", "").replace(".", "").replace(" ", "").replace("-", "_").replace("'", "").replace(",", "")}"></td></tr>\n'
-                    serial_no += 1
+        @self.flask_app.route('/debug/trace/<request_id>')
+        def debug_trace(request_id):
+            """Stage timings recorded for a request, from its X-Request-ID. Admin only."""
+            if not self.is_admin_request():
+                return jsonify({'success': False, 'message': 'Admin access required'}), 403
+            spans = self.tracer.find(request_id)
+            if not spans:
+                return jsonify({'success': False, 'message': f'No trace for request: {request_id}'}), 404
+            return jsonify({
+                'success': True,
+                'request_id': request_id,
+                # First span start to last span end, including background work
+                'total_ms': round(max(span['start'] * 1000 + span['duration_ms'] for span in spans)
+                                  - spans[0]['start'] * 1000, 3),
+                'spans': spans
+            })
+
+        @self.flask_app.route('/debug/profile')
+        def debug_profile():
+            """Sample every thread for ?seconds=N and return flamegraph collapsed stacks"""
+            if not self.is_admin_request():
+                return jsonify({'success': False, 'message': 'Admin access required'}), 403
+            try:
+                seconds = min(max(float(request.args.get('seconds', 10)), 0.1), PROFILE_MAX_SECONDS)
+                interval = max(float(request.args.get('interval', PROFILE_SAMPLE_INTERVAL)), 0.001)
+            except ValueError:
+                return jsonify({'success': False, 'message': 'seconds and interval must be numbers'}), 400
             
-            html_content += '''      </tbody>
-    </table>
-'''
+            success, stacks = sample_stacks(seconds, interval)
+            if not success:
+                return jsonify({'success': False, 'message': stacks}), 409
+            return Response(stacks, mimetype='text/plain', headers={
+                'Content-Disposition': f'attachment; filename=stacks-{os.getpid()}.collapsed'
+            })
 
-        html_content += f'''
-    <div class="footer">
-      Signature<br>(Pathologist)
-    </div>
+        @self.flask_app.route('/debug/profile/<request_id>')
+        def debug_request_profile(request_id):
+            """cProfile of a request sent with an X-Profile header; ?format=prof for the raw pstats file"""
+            if not self.is_admin_request():
+                return jsonify({'success': False, 'message': 'Admin access required'}), 403
+            if not _REQUEST_ID.match(request_id):
+                return jsonify({'success': False, 'message': 'Invalid request id'}), 400
+            path = os.path.join(PROFILE_DIR, f"{request_id}.prof")
+            if not os.path.exists(path):
+                return jsonify({'success': False, 'message': f'No profile for request: {request_id}'}), 404
+            if request.args.get('format') == 'prof':
+                return send_from_directory(PROFILE_DIR, f"{request_id}.prof", as_attachment=True)
+            
+            try:
+                limit = min(max(int(request.args.get('limit', 50)), 1), PROFILE_MAX_LIMIT)
+            except ValueError:
+                return jsonify({'success': False, 'message': 'limit must be a whole number'}), 400
+            
+            import pstats
+            output = io.StringIO()
+            stats = pstats.Stats(path, stream=output)
+            try:
+                stats.sort_stats(request.args.get('sort', 'cumulative'))
+            except KeyError:
+                return jsonify({'success': False, 'message': 'Unknown sort key'}), 400
+            stats.print_stats(limit)
+            return Response(output.getvalue(), mimetype='text/plain')
 
-    <!-- ✅ Submit Button -->
-    <div class="d-grid gap-2 d-md-flex justify-content-md-end mt-4">
-      <button type="button" class="btn btn-success me-md-2" onclick="submitForm()">
-        ✅ Submit & Send WhatsApp Report
-      </button>
-      <button type="reset" class="btn btn-secondary">Clear Form</button>
-    </div>
+        @self.flask_app.route('/metrics')
+        def metrics():
+            """Counters, latency histograms and gauges in the Prometheus text format.
 
-  </div>
+            With METRICS_DIR set, counters and histograms are summed over every
+            process serving the app; render_queue_depth is this process's own.
+            """
+            return Response(METRICS.render(self.metrics_gauges()), mimetype='text/plain; version=0.0.4')
 
-  <script>
-    function submitForm() {{
-      const inputs = document.querySelectorAll('input.result');
-      const testResults = {{}};
-      
-      inputs.forEach(input => {{
-        if (input.value.trim() !== '' && input.name) {{
-          testResults[input.name] = input.value;
-        }}
-      }});
-      
-      // Validate that at least one test result is entered
-      if (Object.keys(testResults).length === 0) {{
-        alert('Please enter at least one test result.');
-        return;
-      }}
-      
-      const submissionData = {{
-        patient_data: {{
-          name: "{patient_data['name']}",
-          age: "{patient_data['age']}",
-          gender: "{patient_data['gender']}",
-          mobile: "{patient_data['mobile']}",
-          doctor: "{patient_data['doctor']}",
-          opd_no: "{patient_data['opd_no']}",
-          sample_date: "{patient_data['sample_date']}"
-        }},
-        test_results: testResults
-      }};
-      
-      console.log('Submitting data:', submissionData);
-      
-      fetch('http://localhost:5000/submit-report', {{
-        method: 'POST',
-        headers: {{
-          'Content-Type': 'application/json',
-        }},
-        body: JSON.stringify(submissionData)
-      }})
-      .then(response => {{
-        if (!response.ok) {{
-          // Try to parse error response as JSON first
-          return response.json().then(err => {{
-            throw new Error(err.message || 'HTTP error ' + response.status);
-          }}).catch(() => {{
-            throw new Error('HTTP error ' + response.status);
-          }});
-        }}
-        return response.json();
-      }})
-      .then(data => {{
-        if (data.success) {{
-          alert('✅ Report submitted successfully!\\\\n\\\\n' + data.message + '\\\\n\\\\nWhatsApp Status: ' + data.whatsapp_message + '\\\\n\\\\nThe patient will receive this link to view their report:\\\\n' + data.pdf_url);
-          if (data.pdf_url) {{
-            window.open(data.pdf_url, '_blank');
-          }}
-        }} else {{
-          alert('❌ Error: ' + data.message);
-        }}
-      }})
-      .catch(error => {{
-        alert('❌ Error submitting form: ' + error);
-        console.error('Error:', error);
-      }});
-    }}
-  </script>
-</body>
-</html>'''
-        return html_content
+        @self.flask_app.route('/messaging')
+        def messaging_stats():
+            """Request latency histograms and error counts per messaging provider"""
+            return jsonify(self.messaging.stats())
 
-    def generate_pdf_html(self, patient_data, test_results):
-        """Generate HTML for PDF with filled results including normal ranges"""
-        html_content = f'''
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="UTF-8">
-            <style>
-                body {{ 
-                    font-family: 'Times New Roman', serif; 
-                    margin: 20px;
-                    line-height: 1.4;
-                }}
-                .header {{ 
-                    text-align: center; 
-                    border-bottom: 2px solid #000; 
-                    padding-bottom: 10px; 
-                    margin-bottom: 20px; 
-                }}
-                .header h1 {{
-                    color: #003366;
-                    margin-bottom: 5px;
-                    font-size: 24px;
-                }}
-                .patient-info {{ 
-                    margin-bottom: 20px;
-                    background: #f8f9fa;
-                    padding: 15px;
-                    border-radius: 5px;
-                    border: 1px solid #ddd;
-                }}
-                .patient-info p {{
-                    margin: 5px 0;
-                    font-size: 14px;
-                }}
-                .section {{ 
-                    margin-bottom: 20px; 
-                }}
-                .section-title {{ 
-                    background: #003366; 
-                    color: white; 
-                    padding: 8px 12px; 
-                    font-weight: bold;
-                    border-radius: 3px;
-                    margin-bottom: 10px;
-                    font-size: 16px;
-                }}
-                table {{ 
-                    width: 100%; 
-                    border-collapse: collapse; 
-                    margin-bottom: 15px;
-                    font-size: 12px;
-                }}
-                th, td {{ 
-                    border: 1px solid #000; 
-                    padding: 8px; 
-                    text-align: left; 
-                }}
-                th {{ 
-                    background: #e9ecef; 
-                    font-weight: bold;
-                    font-size: 13px;
-                }}
-                .normal-range {{
-                    color: #666;
-                    font-size: 11px;
-                }}
-                .footer {{
-                    margin-top: 40px; 
-                    text-align: right;
-                    border-top: 1px solid #000;
-                    padding-top: 20px;
-                }}
-                .abnormal {{
-                    color: #dc3545;
-                    font-weight: bold;
-                }}
-                .normal {{
-                    color: #28a745;
-                }}
-                .hospital-info {{
-                    font-size: 12px;
-                    color: #666;
-                }}
-                @media print {{
-                    body {{ margin: 0; padding: 10px; }}
-                    .header {{ border-bottom: 2px solid #000; }}
-                }}
-            </style>
-        </head>
-        <body>
-            <div class="header">
-                <h1>UJJIVAN HOSPITAL PATHOLOGY REPORT</h1>
-                <div class="hospital-info">
-                    <p>Vidyut Nagar, Gautam Budh Nagar, Uttar Pradesh - 201008</p>
-                    <p>Phone: [Hospital Phone] | Email: [Hospital Email]</p>
-                </div>
-            </div>
-            
-            <div class="patient-info">
-                <p><strong>Patient Name:</strong> {patient_data.get('name', '')}</p>
-                <p><strong>Age/Gender:</strong> {patient_data.get('age', '')}/{patient_data.get('gender', '')}</p>
-                <p><strong>Mobile:</strong> {patient_data.get('mobile', '')}</p>
-                <p><strong>Doctor:</strong> {patient_data.get('doctor', '')}</p>
-                <p><strong>OPD No:</strong> {patient_data.get('opd_no', '')}</p>
-                <p><strong>Sample Date:</strong> {patient_data.get('sample_date', '')}</p>
-                <p><strong>Report Date:</strong> {datetime.now().strftime('%Y-%m-%d %H:%M')}</p>
-            </div>
-            
-            <div class="section">
-                <div class="section-title">TEST RESULTS</div>
-                <table>
-                    <tr>
-                        <th width="40%">Test Name</th>
-                        <th width="30%">Normal Range</th>
-                        <th width="30%">Result</th>
-                    </tr>
-        '''
+        @self.flask_app.route('/healthz')
+        def healthz():
+            """Readiness check for process managers and load balancers"""
+            try:
+                with self.db.connection() as conn:
+                    conn.execute('SELECT 1')
+            except Exception as e:
+                return jsonify({'status': 'unavailable', 'message': f'Database error: {str(e)}'}), 503
+            return jsonify({
+                'status': 'ok',
+                # Doesn't wait for the backend probe while warm-up is still running
+                'pdf_backend': PDF_RENDERERS.active_backend() if PDF_RENDERERS.probed else None,
+                'warmed_up': self.warmed_up.is_set()
+            })
+
+        @self.flask_app.route('/pdf-backends')
+        def pdf_backends():
+            """Show which PDF backend is active and which ones are failing"""
+            return jsonify(PDF_RENDERERS.status())
+
+        # Route for VIEWING PDF in browser
+        @self.flask_app.route('/view-pdf/<filename>')
+        def view_pdf(filename):
+            """Serve a saved report.
+
+            send_from_directory streams the file from disk in chunks and
+            answers If-None-Match/If-Modified-Since with 304 and Range
+            requests with 206, so repeated or resumed views are cheap.
+            """
+            try:
+                if '..' in filename or filename.startswith('/'):
+                    return jsonify({'error': 'Invalid filename'}), 400
+                    
+                store_key = _STORE_KEY.match(filename)
+                if store_key:
+                    directory = os.path.join(os.getcwd(), self.report_store.directory_for(filename))
+                    # The content hash is the ideal strong ETag
+                    etag = store_key.group('digest')
+                else:
+                    directory = os.path.join(os.getcwd(), LEGACY_REPORTS_DIR)
+                    etag = True
+                
+                # Determine content type
+                if filename.lower().endswith('.pdf'):
+                    print(f"📄 Serving PDF: {filename}")
+                    response = send_from_directory(directory, filename, mimetype='application/pdf',
+                                                   conditional=True, etag=etag, max_age=REPORT_CACHE_MAX_AGE)
+                elif filename.lower().endswith('.html'):
+                    response = send_from_directory(directory, filename, mimetype='text/html',
+                                                   conditional=True, etag=etag, max_age=REPORT_CACHE_MAX_AGE)
+                else:
+                    response = send_from_directory(directory, filename, as_attachment=True,
+                                                   conditional=True, etag=etag, max_age=REPORT_CACHE_MAX_AGE)
+                
+                # Reports hold patient data: browsers may keep them, shared caches may not
+                response.cache_control.public = False
+                response.cache_control.private = True
+                return response
+                    
+            except NotFound:
+                return jsonify({'error': f'File not found: {filename}'}), 404
+            except HTTPException as e:
+                # e.g. 416 for a Range past the end of the file
+                return e
+            except Exception as e:
+                return jsonify({'error': str(e)}), 404
+
+        @self.flask_app.before_request
+        def start_request_timer():
+            g.request_started = time.perf_counter()
+            # Keep the caller's id (e.g. from a proxy) so logs and traces line up
+            request_id = request.headers.get('X-Request-ID', '')
+            g.request_id = request_id if _REQUEST_ID.match(request_id) else uuid.uuid4().hex
+            if request.headers.get('X-Profile') and self.is_admin_request():
+                g.profiler = start_request_profile()
+
+        @self.flask_app.after_request
+        def record_request_metrics(response):
+            # The URL rule, not the path, so job ids and file names don't each get a series
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            started = g.get('request_started')
+            if started is not None:
+                METRICS.observe('http_request_duration_seconds', time.perf_counter() - started, route, request.method)
+            METRICS.inc('http_requests_total', route, request.method, str(response.status_code))
+            if 'request_id' in g:
+                response.headers['X-Request-ID'] = g.request_id
+            return response
+
+        @self.flask_app.after_request
+        def after_request(response):
+            response.headers.add('Access-Control-Allow-Origin', '*')
+            response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
+            response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
+            response.headers.add('Access-Control-Expose-Headers', 'X-Request-ID,X-Profile')
+            return response
+
+        # Registered last so it runs first and the profile covers only the view
+        @self.flask_app.after_request
+        def save_request_profile(response):
+            profiler = g.pop('profiler', False)
+            if profiler is None:
+                response.headers['X-Profile'] = 'busy'
+            elif profiler:
+                stop_request_profile(profiler, os.path.join(PROFILE_DIR, f"{g.request_id}.prof"))
+                response.headers['X-Profile'] = f"/debug/profile/{g.request_id}"
+            return response
+
+        @self.flask_app.teardown_request
+        def release_request_profile(error=None):
+            # after_request is skipped when the response fails to build
+            profiler = g.pop('profiler', None)
+            if profiler:
+                stop_request_profile(profiler)
+
+    def metrics_gauges(self):
+        """Point-in-time values for /metrics, read when it is scraped"""
+        cache = self.render_cache.stats()
+        gauges = [
+            ('render_queue_depth', "Report renders queued or running in this process", (),
+             {(): self.render_pool.queue_depth() if self.render_pool else 0}),
+            ('reports_directory_bytes', "Size of the report store on disk", (),
+             {(): self.reports_directory_size()}),
+            ('render_cache_bytes', "Bytes held by the render cache", ('tier',),
+             {('memory',): cache['memory_bytes'], ('disk',): cache['disk_bytes']})
+        ]
+        try:
+            with self.db.connection() as conn:
+                rows = conn.execute('''
+                    SELECT status, COUNT(*) FROM notification_queue
+                    WHERE status IN ('pending', 'sending') GROUP BY status
+                ''').fetchall()
+            depth = {('pending',): 0, ('sending',): 0}
+            depth.update(((status,), count) for status, count in rows)
+            gauges.append(('notification_queue_depth', "Notifications waiting to be sent", ('status',), depth))
+        except Exception as e:
+            print(f"⚠️ Could not read notification queue depth: {e}")
+        return gauges
+
+    def reports_directory_size(self):
+        """Bytes under the report store; walking it is slow, so the total is reused for a while"""
+        measured_at, size = self.reports_size
+        if time.time() - measured_at > REPORTS_SIZE_TTL_SECONDS:
+            size = directory_size(REPORT_STORE_DIR)
+            self.reports_size = (time.time(), size)
+        return size
+
+    def start_server(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        """Serve the web app from a background thread.
+
+        The socket is bound before this returns, so the app accepts
+        connections as soon as the call completes.
+        """
+        from werkzeug.serving import make_server
+        self.server = make_server(host, port, self.flask_app, threaded=True)
+        self.trust_loopback = True
+        self.server_thread = threading.Thread(target=self.server.serve_forever, name='flask-server', daemon=True)
+        self.server_thread.start()
+        print(f"🚀 Flask server listening on http://{host}:{port}")
+        print(f"📁 Reports directory: {REPORT_STORE_DIR}/")
+        return self.server
+
+    def is_admin_request(self):
+        """Whether the current request may use the admin endpoints.
+
+        With ADMIN_TOKEN set that takes the X-Admin-Token header; without it,
+        only a loopback request to the built-in server. Fails closed otherwise.
+        """
+        if self.admin_token:
+            return hmac.compare_digest(request.headers.get('X-Admin-Token', ''), self.admin_token)
+        return self.trust_loopback and request.remote_addr in ('127.0.0.1', '::1')
+
+    def install_profile_signal(self):
+        """Sample all threads for PROFILE_SIGNAL_SECONDS on SIGUSR2 (not on Windows)"""
+        # Handlers can only be set from the main thread, e.g. not when embedded in a test runner
+        if not hasattr(signal, 'SIGUSR2') or threading.current_thread() is not threading.main_thread():
+            return
+        seconds = float(os.environ.get('PROFILE_SIGNAL_SECONDS', PROFILE_SIGNAL_SECONDS))
+        signal.signal(signal.SIGUSR2, lambda signum, frame: sample_stacks_to_file(seconds))
+
+    def close(self):
+        """Stop the server and background workers; queued renders are finished first"""
+        if getattr(self, 'server', None):
+            self.server.shutdown()
+            self.server.server_close()
+        if self.render_pool:
+            self.render_pool.shutdown()
+        self.notifications.stop()
+        # After the render pool, so the counters of its last renders are included
+        self.metrics_stopping.set()
+        METRICS.retire()
+        self.tracer.close()
+        self.db.close()
+
+    def publish_metrics_periodically(self, interval):
+        """Keep this process's file in METRICS_DIR current for scrapes answered by other processes"""
+        while not self.metrics_stopping.wait(interval):
+            try:
+                METRICS.publish()
+            except Exception as e:
+                print(f"⚠️ Could not publish metrics: {e}")
+
+    def generate_exact_format_html_form(self, patient_data, selected_tests):
+        """Generate HTML form in the exact format as provided"""
+        selected = set(selected_tests)
+        sections = []
+        serial_no = 1
+        for category, tests in TEST_CATEGORIES:
+            rows = []
+            for test_name, normal_range in tests:
+                if test_name in selected:
+                    rows.append({
+                        'serial_no': serial_no,
+                        'test_name': test_name,
+                        'normal_value': normal_range,
+                        'html_id': TEST_CATALOG[test_name].slug
+                    })
+                    serial_no += 1
+            if rows:
+                sections.append({'category': category, 'rows': rows})
         
+        return REPORT_TEMPLATES.get_template('fillable_form.html').render(patient_data=patient_data, sections=sections)
+
+    def generate_pdf_html(self, patient_data, test_results):
+        """Generate HTML for PDF with filled results including normal ranges"""
         # Group tests by category for better organization
-        test_categories = {
-            "BIOCHEMISTRY": [],
-            "RENAL FUNCTION": [],
-            "LIPID PROFILE": [],
-            "LIVER FUNCTION": [],
-            "ELECTROLYTES": [],
-            "OTHER TESTS": [],
-            "HAEMATOLOGY": [],
-            "SEROLOGY": []
-        }
-        
-        # Categorize tests
+        test_categories = {category: [] for category, tests in TEST_CATEGORIES}
         for test_name, result in test_results.items():
-            category_found = False
-            for category, tests in self.tests.items():
-                if test_name in tests:
-                    test_categories[category].append((test_name, result))
-                    category_found = True
-                    break
-            if not category_found:
-                test_categories["OTHER TESTS"].append((test_name, result))
+            test = TEST_CATALOG.get(test_name)
+            test_categories[test.category if test else "OTHER TESTS"].append((test_name, result))
+        
+        # Flag all results against their reference ranges in one pass
+        flags = classify_report(patient_data, test_results)
         
-        # Generate table rows for each category
+        # Build table rows for each category
+        sections = []
         serial_no = 1
         for category, tests in test_categories.items():
             if tests:
-                html_content += f'''
-                    <tr>
-                        <td colspan="3" style="background: #e8f0ff; font-weight: bold; text-align: center; font-size: 14px;">
-                            {category}
-                        </td>
-                    </tr>
-                '''
-                
+                rows = []
                 for test_name, result in tests:
-                    normal_range = self.normal_ranges.get(test_name, "Not specified")
+                    test = TEST_CATALOG.get(test_name)
+                    normal_range = test.normal_range if test else "Not specified"
                     
-                    # Simple check for abnormal values
-                    status_class = "normal"
-                    result_str = str(result).lower()
-                    if any(word in result_str for word in ['positive', 'high', 'low', 'abnormal', 'reactive']):
-                        status_class = "abnormal"
-                    elif test_name in ["Glucose (F)/RI", "HbA1c", "Urea", "Creatinine"] and result.replace('.', '').replace('-', '').isdigit():
-                        try:
-                            value = float(result)
-                            if test_name == "Glucose (F)/RI" and (value < 70 or value > 110):
-                                status_class = "abnormal"
-                            elif test_name == "HbA1c" and (value < 4.5 or value > 6.5):
-                                status_class = "abnormal"
-                            elif test_name == "Urea" and (value < 10 or value > 40):
-                                status_class = "abnormal"
-                            elif test_name == "Creatinine" and (value < 0.6 or value > 1.4):
-                                status_class = "abnormal"
-                        except:
-                            pass
+                    flag = flags.get(test_name)
+                    status_class = "normal" if flag in (None, 'normal') else "abnormal"
                     
-                    html_content += f'''
-                    <tr>
-                        <td>{serial_no}. {test_name}</td>
-                        <td><span class="normal-range">{normal_range}</span></td>
-                        <td class="{status_class}"><strong>{result}</strong></td>
-                    </tr>
-                    '''
+                    rows.append({
+                        'serial_no': serial_no,
+                        'test_name': test_name,
+                        'normal_range': normal_range,
+                        'status_class': status_class,
+                        'flag_label': FLAG_LABELS.get(flag, ''),
+                        'result': result
+                    })
                     serial_no += 1
+                sections.append({'category': category, 'rows': rows})
         
-        html_content += '''
-                </table>
-            </div>
-            
-            <div class="footer">
-                <p><strong>Signature</strong></p>
-                <p>_________________________</p>
-                <p>(Pathologist)</p>
-                <p>UJJIVAN Hospital Pathology Department</p>
-                <p>License No: [Pathology License Number]</p>
-            </div>
-            
-            <div style="margin-top: 20px; font-size: 10px; color: #666; text-align: center; border-top: 1px solid #eee; padding-top: 10px;">
-                <p>This is a computer generated report. For any queries, please contact the laboratory.</p>
-                <p>Report ID: ''' + datetime.now().strftime('%Y%m%d%H%M%S') + ''' | Generated on: ''' + datetime.now().strftime('%Y-%m-%d %H:%M:%S') + '''</p>
-            </div>
-        </body>
-        </html>
-        '''
-        return html_content
+        now = datetime.now()
+        return REPORT_TEMPLATES.get_template('pdf_report.html').render(
+            patient_data=patient_data,
+            sections=sections,
+            report_date=now.strftime('%Y-%m-%d %H:%M'),
+            report_id=now.strftime('%Y%m%d%H%M%S'),
+            generated_on=now.strftime('%Y-%m-%d %H:%M:%S')
+        )
+
+    def generate_report_html(self, patient_data, test_results):
+        """Report HTML plus the PDF already rendered for the same content, if any.
 
-    def generate_pdf_bytes(self, html_content):
+        Returns (cache_key, html_content, pdf_bytes); pdf_bytes is None when
+        the report still has to be rendered.
+        """
+        cache_key = render_cache_key(patient_data, test_results)
+        cached = self.render_cache.get(cache_key)
+        if cached:
+            return cache_key, cached[0], cached[1]
+        return cache_key, self.generate_pdf_html(patient_data, test_results), None
+
+    def generate_pdf_bytes(self, html_content, attempts=None):
         """Generate PDF bytes from HTML content using available methods"""
-        try:
-            # Method 1: Try WeasyPrint (only if available and not Windows)
-            if WEASYPRINT_AVAILABLE:
-                try:
-                    from weasyprint import HTML
-                    
-                    # Generate PDF
-                    pdf_bytes = HTML(string=html_content, encoding='utf-8').write_pdf()
-                    
-                    print("✅ PDF generated successfully with WeasyPrint")
-                    return True, pdf_bytes
-                    
-                except Exception as e:
-                    print(f"❌ WeasyPrint failed: {e}")
+        return render_pdf_bytes(html_content, attempts)
+
+    def save_report_file(self, html_content, pdf_success, pdf_bytes):
+        """Save the PDF, or the HTML when PDF generation failed; returns (filepath, view_url)"""
+        if pdf_success and pdf_bytes:
+            key, filepath = self.report_store.put(pdf_bytes, 'pdf')
+            print(f"✅ PDF saved to: {filepath}")
+        else:
+            key, filepath = self.report_store.put(html_content.encode('utf-8'), 'html')
+        
+        # Use view-pdf for HTML files as well
+        return filepath, f"{self.base_url}/view-pdf/{key}"
+
+    def finish_report(self, patient_data, test_results, html_content, pdf_success, pdf_bytes, cache_key=None,
+                      trace=None):
+        """Save the rendered report, send WhatsApp and store it; returns the JSON response body"""
+        trace = trace or Trace(None, None)
+        if cache_key:
+            with trace.span('cache_put'):
+                self.render_cache.put(cache_key, html_content, pdf_bytes if pdf_success else None)
+        
+        with trace.span('save_file', pdf=bool(pdf_success and pdf_bytes)):
+            report_path, report_url = self.save_report_file(html_content, pdf_success, pdf_bytes)
+        
+        # Store in database; the WhatsApp message with the report link is queued in the same transaction
+        with trace.span('store_db'):
+            whatsapp_status, whatsapp_message = self.store_completed_report(
+                patient_data, 
+                test_results, 
+                report_path, 
+                report_url,
+                trace.request_id,
+                cache_key
+            )
+        
+        if pdf_success and pdf_bytes:
+            message = 'Report submitted successfully! PDF generated and WhatsApp message queued.'
+        else:
+            message = 'Report submitted successfully! (HTML version - PDF generation failed)'
+        
+        return {
+            'success': True,
+            'message': message,
+            'whatsapp_status': whatsapp_status,
+            'whatsapp_message': whatsapp_message,
+            'pdf_path': report_path,
+            'pdf_url': report_url
+        }
+
+    def process_report_batch(self, reports, request_id=None, chunk_size=None):
+        """Render, save and send a validated batch of reports.
+
+        Finished PDFs are stored chunk_size at a time (BATCH_STORE_CHUNK by
+        default), each chunk in one transaction with its WhatsApp messages.
+        Yields a status dict per report once its chunk is stored, then a summary.
+        """
+        cache_keys = []
+        html_documents = []
+        cached = []
+        to_render = []
+        for index, report in enumerate(reports):
+            cache_key, html_content, cached_pdf = self.generate_report_html(
+                report.get('patient_data', {}), report.get('test_results', {})
+            )
+            cache_keys.append(cache_key)
+            html_documents.append(html_content)
+            if cached_pdf:
+                cached.append((index, (True, cached_pdf)))
+            else:
+                to_render.append(index)
+        
+        # Only reports without a cached PDF are rendered; results are mapped back to batch indexes
+        documents = [html_documents[index] for index in to_render]
+        if self.render_pool:
+            rendered = self.render_pool.render_many(documents)
+        else:
+            rendered = enumerate(render_pdf_batch(documents)) if documents else iter(())
+        rendered = itertools.chain(cached, ((to_render[position], result) for position, result in rendered))
+        
+        stored = 0
+        chunk_size = chunk_size or BATCH_STORE_CHUNK
+        while True:
+            chunk = list(itertools.islice(rendered, chunk_size))
+            if not chunk:
+                break
             
-            # Method 2: Try pdfkit
-            if PDFKIT_AVAILABLE:
+            finished = []
+            for index, (pdf_success, pdf_bytes) in chunk:
+                self.render_cache.put(cache_keys[index], html_documents[index], pdf_bytes if pdf_success else None)
                 try:
-                    options = {
-                        'page-size': 'A4',
-                        'margin-top': '0.5in',
-                        'margin-right': '0.5in',
-                        'margin-bottom': '0.5in',
-                        'margin-left': '0.5in',
-                        'encoding': "UTF-8",
-                        'no-outline': None,
-                        'quiet': ''
-                    }
-                    
-                    config = None
-                    possible_paths = [
-                        '/usr/bin/wkhtmltopdf',
-                        '/usr/local/bin/wkhtmltopdf',
-                        'C:/Program Files/wkhtmltopdf/bin/wkhtmltopdf.exe',
-                        'C:/wkhtmltopdf/bin/wkhtmltopdf.exe'
-                    ]
-                    
-                    for path in possible_paths:
-                        if os.path.exists(path):
-                            config = pdfkit.configuration(wkhtmltopdf=path)
-                            break
-                    
-                    # Create temporary PDF file
-                    import tempfile
-                    with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp:
-                        tmp_path = tmp.name
-                    
-                    if config:
-                        pdfkit.from_string(html_content, tmp_path, options=options, configuration=config)
-                    else:
-                        pdfkit.from_string(html_content, tmp_path, options=options)
-                    
-                    # Read PDF bytes
-                    with open(tmp_path, 'rb') as f:
-                        pdf_bytes = f.read()
-                    
-                    # Clean up temp file
-                    os.unlink(tmp_path)
-                    
-                    print("✅ PDF generated successfully with pdfkit")
-                    return True, pdf_bytes
-                    
+                    report_path, report_url = self.save_report_file(html_documents[index], pdf_success, pdf_bytes)
                 except Exception as e:
-                    print(f"❌ pdfkit failed: {e}")
+                    print(f"❌ Error finishing batch report {index}: {e}")
+                    yield {'index': index, 'success': False, 'message': f'Server Error: {str(e)}'}
+                    continue
+                finished.append((index, bool(pdf_success and pdf_bytes), report_path, report_url))
+            if not finished:
+                continue
             
-            # Method 3: Try alternative using xhtml2pdf (pure Python)
-            try:
-                from xhtml2pdf import pisa
-                import io
-                
-                # Create a PDF in memory
-                pdf_bytes = io.BytesIO()
-                pisa_status = pisa.CreatePDF(html_content, dest=pdf_bytes)
-                
-                if pisa_status.err:
-                    print("❌ xhtml2pdf failed")
-                    raise Exception("PDF generation failed")
-                
-                pdf_data = pdf_bytes.getvalue()
-                pdf_bytes.close()
-                
-                print("✅ PDF generated successfully with xhtml2pdf")
-                return True, pdf_data
-                
-            except ImportError:
-                print("⚠️ xhtml2pdf not available.")
-            except Exception as e:
-                print(f"❌ xhtml2pdf failed: {e}")
+            # The chunk is stored in one transaction before its statuses go out,
+            # so a client that stops reading loses nothing
+            statuses = self.store_completed_reports(
+                [
+                    (reports[index].get('patient_data', {}), reports[index].get('test_results', {}),
+                     report_path, report_url, cache_keys[index])
+                    for index, _, report_path, report_url in finished
+                ],
+                request_id
+            )
+            if not statuses:
+                for index, _, _, _ in finished:
+                    yield {'index': index, 'success': False, 'message': 'Report could not be stored in the database'}
+                continue
             
-            # Method 4: Try alternative using reportlab (basic PDF)
+            stored += len(finished)
+            for (index, pdf_generated, report_path, report_url), (whatsapp_status, whatsapp_message) in zip(finished, statuses):
+                yield {
+                    'index': index,
+                    'success': True,
+                    'pdf_generated': pdf_generated,
+                    'whatsapp_status': whatsapp_status,
+                    'whatsapp_message': whatsapp_message,
+                    'pdf_path': report_path,
+                    'pdf_url': report_url
+                }
+        
+        yield {
+            'done': True,
+            'success': stored == len(reports),
+            'stored': stored,
+            'message': f'{stored} of {len(reports)} reports completed'
+        }
+
+    def load_analyzer_codes(self, path=None):
+        """ANALYZER_CODES plus the optional JSON mapping in path, keyed by upper-case code"""
+        codes = {name.upper(): name for name in self.normal_ranges}
+        codes.update((code.upper(), name) for code, name in ANALYZER_CODES.items())
+        if path:
             try:
-                from reportlab.lib.pagesizes import letter
-                from reportlab.pdfgen import canvas
-                from reportlab.lib.utils import ImageReader
-                import io
-                
-                # Create a simple PDF with reportlab
-                pdf_bytes = io.BytesIO()
-                c = canvas.Canvas(pdf_bytes, pagesize=letter)
-                width, height = letter
-                
-                # Add simple text to PDF
-                c.setFont("Helvetica", 12)
-                c.drawString(100, height - 100, "UJJIVAN HOSPITAL PATHOLOGY REPORT")
-                c.drawString(100, height - 120, "Patient Report - HTML version available")
-                c.drawString(100, height - 140, "Please view the HTML report for detailed results")
-                c.save()
-                
-                pdf_data = pdf_bytes.getvalue()
-                pdf_bytes.close()
-                
-                print("✅ Basic PDF generated with reportlab")
-                return True, pdf_data
-                
-            except ImportError:
-                print("⚠️ reportlab not available.")
-            except Exception as e:
-                print(f"❌ reportlab failed: {e}")
+                with open(path, encoding='utf-8') as f:
+                    codes.update((str(code).upper(), name) for code, name in json.load(f).items())
+                print(f"🧪 Loaded analyzer codes from {path}")
+            except (OSError, ValueError, AttributeError) as e:
+                print(f"⚠️ Could not load analyzer codes from {path}: {e}")
+        
+        unknown = sorted({name for name in codes.values() if name not in self.normal_ranges})
+        if unknown:
+            print(f"⚠️ Analyzer codes map to tests not in the catalog: {', '.join(unknown)}")
+            codes = {code: name for code, name in codes.items() if name in self.normal_ranges}
+        return codes
+
+    def import_analyzer_results(self, lines, fmt=None, batch_size=IMPORT_BATCH_SIZE, request_id=None):
+        """Turn an analyzer result file into completed reports; returns a summary dict.
+
+        lines is read one at a time. Results are grouped by sample id, which
+        is the OPD no of the form submission the sample belongs to; patient
+        details come from the latest submission with that OPD no. Analyzers
+        don't always write a sample's results together (e.g. files sorted by
+        assay), so the whole file is first staged in a temporary on-disk
+        SQLite database and read back in sample order. Samples are then
+        handed to process_report_batch batch_size at a time, which renders
+        them together and stores each batch with its WhatsApp messages in
+        one transaction.
+        Memory use doesn't depend on the file size or its order.
+        """
+        batch_size = max(1, min(batch_size, 500))
+        summary = {
+            'results': 0, 'samples': 0, 'reports_created': 0, 'unmatched': 0, 'already_reported': 0,
+            'invalid': 0, 'unknown_codes': {}, 'unmatched_samples': [], 'errors': []
+        }
+        started = time.perf_counter()
+        # '' is a private temporary database; pages beyond its small cache go to disk
+        staging = sqlite3.connect('')
+        
+        try:
+            staging.execute('CREATE TABLE results (sample_id TEXT, test_name TEXT, value TEXT)')
+            # Parsed to the end first, so nothing is created from a partly unreadable file
+            self._stage_analyzer_results(parse_analyzer_results(lines, fmt), staging, summary)
             
-            # Method 5: Final fallback - generate HTML file only
-            print("⚠️ No PDF generation method available. Using HTML fallback.")
-            return False, None
+            # A later result for the same test (a rerun) replaces the earlier one
+            rows = staging.execute('SELECT sample_id, test_name, value FROM results ORDER BY sample_id, rowid')
+            samples = (
+                (sample_id, {test_name: value for _, test_name, value in results})
+                for sample_id, results in itertools.groupby(rows, key=lambda row: row[0])
+            )
+            while True:
+                batch = list(itertools.islice(samples, batch_size))
+                if not batch:
+                    break
+                self._import_batch(batch, summary, request_id)
+            failure = None
             
-        except Exception as e:
-            print(f"❌ Error in PDF generation: {e}")
-            return False, None
+        except (ValueError, csv.Error, UnicodeDecodeError) as e:
+            failure = f"Unreadable file: {e}"
+            self._import_error(summary, failure)
+        finally:
+            staging.close()
+        
+        summary['success'] = failure is None
+        summary['message'] = (
+            f"{summary['reports_created']} reports created from {summary['results']} results "
+            f"in {time.perf_counter() - started:.1f}s"
+        ) + (f"; {failure}" if failure else '')
+        print(f"📥 {summary['message']}")
+        return summary
+
+    def _stage_analyzer_results(self, results, staging, summary, chunk_size=5000):
+        """Write mapped results into the staging database a chunk at a time"""
+        def mapped():
+            for result in results:
+                summary['results'] += 1
+                code, sample_id, value = result.code.strip().upper(), result.sample_id.strip(), result.value.strip()
+                test_name = self.analyzer_codes.get(code)
+                if not test_name:
+                    if code in summary['unknown_codes'] or len(summary['unknown_codes']) < IMPORT_MAX_EXAMPLES:
+                        summary['unknown_codes'][code] = summary['unknown_codes'].get(code, 0) + 1
+                    continue
+                if sample_id and value:
+                    yield sample_id, test_name, value
+        
+        rows = mapped()
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            staging.executemany('INSERT INTO results VALUES (?, ?, ?)', chunk)
+        staging.execute('CREATE INDEX results_sample ON results (sample_id)')
+
+    def _import_error(self, summary, message):
+        if len(summary['errors']) < IMPORT_MAX_EXAMPLES:
+            summary['errors'].append(message)
+
+    def _import_batch(self, batch, summary, request_id=None):
+        """Create reports for (OPD no, results) samples matched to their form submissions"""
+        summary['samples'] += len(batch)
+        opd_nos = [sample_id for sample_id, _ in batch]
+        placeholders = ','.join('?' * len(opd_nos))
+        with self.db.connection() as conn:
+            # Latest submission per OPD no wins
+            submissions = {row[5]: row for row in conn.execute(f'''
+                SELECT patient_name, patient_age, patient_gender, patient_mobile, doctor_name, opd_no, sample_date
+                FROM form_submissions WHERE opd_no IN ({placeholders}) ORDER BY id
+            ''', opd_nos)}
+            # Re-importing a file must not create the same reports twice
+            reported = set(conn.execute(f'''
+                SELECT opd_no, sample_date FROM lab_reports WHERE kind = ? AND opd_no IN ({placeholders})
+            ''', [REPORT_KIND_COMPLETED] + opd_nos).fetchall())
+        
+        reports = []
+        for sample_id, test_results in batch:
+            submission = submissions.get(sample_id)
+            if not submission:
+                summary['unmatched'] += 1
+                if len(summary['unmatched_samples']) < IMPORT_MAX_EXAMPLES:
+                    summary['unmatched_samples'].append(sample_id)
+                continue
+            patient_data = dict(zip(('name', 'age', 'gender', 'mobile', 'doctor', 'opd_no', 'sample_date'), submission))
+            if (sample_id, patient_data['sample_date']) in reported:
+                summary['already_reported'] += 1
+                continue
+            validation_error = self.validate_submission(patient_data, test_results)
+            if validation_error:
+                summary['invalid'] += 1
+                self._import_error(summary, f"OPD {sample_id}: {validation_error}")
+                continue
+            reports.append({'patient_data': patient_data, 'test_results': test_results})
+        
+        if not reports:
+            return
+        for status in self.process_report_batch(reports, request_id, chunk_size=len(reports)):
+            if status.get('done'):
+                summary['reports_created'] += status['stored']
+                if not status['success']:
+                    self._import_error(summary, status['message'])
+            elif not status['success']:
+                self._import_error(summary, f"OPD {reports[status['index']]['patient_data']['opd_no']}: {status['message']}")
 
     def store_report_in_database(self, patient_data, selected_tests):
         """Store form submission in database"""
+        started = time.perf_counter()
         try:
             selected_tests_json = json.dumps(selected_tests)
             
-            self.cursor.execute('''
-                INSERT INTO form_submissions 
-                (patient_name, patient_age, patient_gender, patient_mobile, doctor_name, opd_no, sample_date, selected_tests)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                patient_data['name'],
-                patient_data['age'],
-                patient_data['gender'],
-                patient_data['mobile'],
-                patient_data['doctor'],
-                patient_data['opd_no'],
-                patient_data['sample_date'],
-                selected_tests_json
-            ))
-            
-            self.conn.commit()
+            with self.db.transaction() as conn:
+                cursor = conn.execute(INSERT_FORM_SUBMISSION, (
+                    patient_data['name'],
+                    patient_data['age'],
+                    patient_data['gender'],
+                    patient_data['mobile'],
+                    patient_data['doctor'],
+                    patient_data['opd_no'],
+                    patient_data['sample_date'],
+                    selected_tests_json
+                ))
+                self.insert_normalized_report(
+                    conn, REPORT_KIND_ORDERED, cursor.lastrowid, patient_data, dict.fromkeys(selected_tests)
+                )
+            METRICS.observe('db_write_duration_seconds', time.perf_counter() - started, 'form_submission')
+            METRICS.inc('db_writes_total', 'form_submission', 'success')
+            
             print("Form submission stored in database")
             
         except Exception as e:
+            METRICS.inc('db_writes_total', 'form_submission', 'failure')
             print(f"Error storing form submission: {e}")
 
-    def store_completed_report(self, patient_data, test_results, pdf_path, whatsapp_success, whatsapp_message):
-        """Store completed report in database with WhatsApp status"""
+    def insert_normalized_report(self, conn, kind, source_id, patient_data, test_results, pdf_path=None):
+        """Write one report and its per-test rows on an open connection.
+
+        test_results maps test name -> result; ordered tests without a result
+        yet map to None. Returns the lab_reports id, or None if the source row
+        was already copied.
+        """
+        name = str(patient_data.get('name') or '').strip()
+        mobile = str(patient_data.get('mobile') or '').strip()
+        patient = conn.execute(SELECT_LAB_PATIENT, (mobile, name)).fetchone()
+        if not patient:
+            conn.execute(INSERT_LAB_PATIENT, (name, mobile, patient_data.get('gender', '')))
+            patient = conn.execute(SELECT_LAB_PATIENT, (mobile, name)).fetchone()
+        patient_id = patient[0]
+        
+        cursor = conn.execute(INSERT_LAB_REPORT, (
+            patient_id,
+            kind,
+            source_id,
+            patient_data.get('age', ''),
+            _age_in_years(patient_data.get('age')),
+            patient_data.get('doctor', ''),
+            patient_data.get('opd_no', ''),
+            patient_data.get('sample_date', ''),
+            pdf_path
+        ))
+        if not cursor.rowcount:
+            return None
+        
+        report_id = cursor.lastrowid
+        flags = classify_report(patient_data, {
+            test_name: result for test_name, result in test_results.items() if result is not None
+        })
+        conn.executemany(INSERT_LAB_RESULT, [
+            (
+                report_id,
+                test_name,
+                TEST_CATALOG[test_name].category if test_name in TEST_CATALOG else None,
+                None if result is None else str(result),
+                None if result is None else _result_value(result),
+                flags.get(test_name)
+            )
+            for test_name, result in test_results.items()
+        ])
+        return report_id
+
+    def search_reports(self, mobile='', opd_no='', name_prefix='', date_from='', date_to='',
+                       limit=REPORT_PAGE_SIZE, cursor=None):
+        """One page of completed reports, newest first; returns (reports, next_cursor).
+
+        Uses keyset pagination on (sample_date, id) so later pages cost the
+        same as the first; reports without a sample date sort last. Raises
+        ValueError for bad arguments.
+        """
+        if not 1 <= limit <= MAX_REPORT_PAGE_SIZE:
+            raise ValueError(f'limit must be between 1 and {MAX_REPORT_PAGE_SIZE}')
+        
+        filters = []
+        params = [REPORT_KIND_COMPLETED]
+        if mobile:
+            filters.append('p.mobile = ?')
+            params.append(mobile)
+        if opd_no:
+            filters.append('r.opd_no = ?')
+            params.append(opd_no)
+        if name_prefix:
+            # A range on the NOCASE name index instead of LIKE, which can't always use it
+            filters.append('p.name >= ? AND p.name < ?')
+            params.extend([name_prefix, name_prefix + '\uffff'])
+        if date_from:
+            filters.append('r.sample_date >= ?')
+            params.append(date_from)
+        if date_to:
+            filters.append('r.sample_date <= ?')
+            params.append(date_to)
+        if cursor:
+            filters.append("(COALESCE(r.sample_date, ''), r.id) < (?, ?)")
+            params.extend(_decode_cursor(cursor))
+        
+        sql = SELECT_REPORT_HISTORY.format(filters=''.join(' AND ' + condition for condition in filters))
+        with self.db.connection() as conn:
+            # One extra row tells us whether there is another page
+            rows = conn.execute(sql, params + [limit + 1]).fetchall()
+            rows, has_more = rows[:limit], len(rows) > limit
+            
+            counts = {}
+            if rows:
+                placeholders = ', '.join('?' * len(rows))
+                for report_id, tests, abnormal in conn.execute(
+                        SELECT_RESULT_COUNTS.format(placeholders=placeholders), [row[0] for row in rows]):
+                    counts[report_id] = (tests, abnormal or 0)
+        
+        reports = []
+        for report_id, source_id, name, mobile, gender, age, doctor, opd_no, sample_date, pdf_path in rows:
+            tests, abnormal = counts.get(report_id, (0, 0))
+            reports.append({
+                'report_id': source_id,
+                'patient_data': {
+                    'name': name,
+                    'age': age,
+                    'gender': gender,
+                    'mobile': mobile,
+                    'doctor': doctor,
+                    'opd_no': opd_no,
+                    'sample_date': sample_date
+                },
+                'tests': tests,
+                'abnormal': abnormal,
+                'pdf_path': pdf_path,
+                'pdf_url': f"{self.base_url}/view-pdf/{os.path.basename(pdf_path)}" if pdf_path else None
+            })
+        
+        next_cursor = _encode_cursor(rows[-1][8] or '', rows[-1][0]) if has_more else None
+        return reports, next_cursor
+
+    def get_test_trend(self, mobile, test_name, name=''):
+        """Results of one test for the patients on a mobile number, oldest first"""
+        filters = ''
+        params = [REPORT_KIND_COMPLETED, test_name, mobile]
+        if name:
+            filters = 'AND p.name = ?'
+            params.append(name)
+        
+        with self.db.connection() as conn:
+            rows = conn.execute(SELECT_TEST_TREND.format(filters=filters), params).fetchall()
+        
+        return [
+            {
+                'report_id': report_id,
+                'sample_date': sample_date,
+                'name': patient_name,
+                'result': result_text,
+                'value': result_value,
+                'flag': flag
+            }
+            for report_id, sample_date, patient_name, result_text, result_value, flag in rows
+        ]
+
+    def prepare_notification(self, patient_data):
+        """Initial WhatsApp state of a report: (whatsapp_status, whatsapp_message, formatted_mobile)"""
+        formatted_mobile, mobile_error = self.validate_mobile_number(patient_data.get('mobile', ''))
+        if mobile_error:
+            return 'failed', f"Mobile number error: {mobile_error}", None
+        return 'queued', 'WhatsApp message queued for delivery', formatted_mobile
+
+    def _insert_completed_report(self, conn, patient_data, test_results, pdf_path, pdf_url, request_id=None,
+                                 content_key=None):
+        """Insert a completed report and queue its WhatsApp message; returns (whatsapp_status, whatsapp_message).
+
+        When a report with the same content_key is already stored, nothing
+        is inserted or queued and the stored report's status is returned.
+        """
+        whatsapp_status, whatsapp_message, formatted_mobile = self.prepare_notification(patient_data)
+        cursor = conn.execute(INSERT_COMPLETED_REPORT, (
+            patient_data.get('name', ''),
+            patient_data.get('age', ''),
+            patient_data.get('gender', ''),
+            patient_data.get('mobile', ''),
+            patient_data.get('doctor', ''),
+            patient_data.get('opd_no', ''),
+            patient_data.get('sample_date', ''),
+            json.dumps(test_results),
+            pdf_path,
+            whatsapp_status,
+            None if formatted_mobile else whatsapp_message,
+            request_id,
+            content_key
+        ))
+        if not cursor.rowcount:
+            stored_status = conn.execute(
+                'SELECT whatsapp_status FROM completed_reports WHERE content_key = ?', (content_key,)
+            ).fetchone()
+            print("♻️ Report already stored; not queuing its WhatsApp message again")
+            return stored_status[0] if stored_status else whatsapp_status, \
+                'Report was already submitted; WhatsApp message not sent again'
+        self.insert_normalized_report(
+            conn, REPORT_KIND_COMPLETED, cursor.lastrowid, patient_data, test_results, pdf_path
+        )
+        if formatted_mobile:
+            self.notifications.enqueue(conn, cursor.lastrowid, self.notification_provider(), formatted_mobile, {
+                'patient_data': patient_data,
+                'pdf_url': pdf_url
+            }, request_id)
+        return whatsapp_status, whatsapp_message
+
+    def store_completed_report(self, patient_data, test_results, pdf_path, pdf_url, request_id=None,
+                               content_key=None):
+        """Store completed report in database and queue its WhatsApp message.
+
+        request_id, of the submission, is saved on the row and its notification.
+        content_key (render_cache_key) makes resubmitting the same report a no-op.
+        Returns (whatsapp_status, whatsapp_message) for the response.
+        """
+        started = time.perf_counter()
         try:
-            test_results_json = json.dumps(test_results)
-            whatsapp_status = "sent" if whatsapp_success else "failed"
-            
-            self.cursor.execute('''
-                INSERT INTO completed_reports 
-                (patient_name, patient_age, patient_gender, patient_mobile, doctor_name, opd_no, sample_date, test_results, pdf_path, whatsapp_status, whatsapp_error)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                patient_data.get('name', ''),
-                patient_data.get('age', ''),
-                patient_data.get('gender', ''),
-                patient_data.get('mobile', ''),
-                patient_data.get('doctor', ''),
-                patient_data.get('opd_no', ''),
-                patient_data.get('sample_date', ''),
-                test_results_json,
-                pdf_path,
-                whatsapp_status,
-                whatsapp_message
-            ))
-            
-            self.conn.commit()
+            with self.db.transaction() as conn:
+                whatsapp_status, whatsapp_message = self._insert_completed_report(
+                    conn, patient_data, test_results, pdf_path, pdf_url, request_id, content_key
+                )
+            METRICS.observe('db_write_duration_seconds', time.perf_counter() - started, 'completed_report')
+            METRICS.inc('db_writes_total', 'completed_report', 'success')
+            self.notifications.wake()
+            
             print(f"✅ Completed report stored in database. WhatsApp: {whatsapp_status}")
-            return True
+            return whatsapp_status, whatsapp_message
             
         except Exception as e:
+            METRICS.inc('db_writes_total', 'completed_report', 'failure')
             print(f"❌ Error storing completed report: {e}")
-            return False
+            return 'failed', f'Report could not be stored, WhatsApp message not queued: {str(e)}'
+
+    def store_completed_reports(self, reports, request_id=None):
+        """Store many completed reports in one transaction.
+
+        reports is a list of (patient_data, test_results, pdf_path, pdf_url,
+        content_key) tuples. Their WhatsApp messages are queued in the same
+        transaction. Returns a (whatsapp_status, whatsapp_message) per report,
+        or None when nothing could be stored.
+        """
+        started = time.perf_counter()
+        try:
+            with self.db.transaction() as conn:
+                statuses = [
+                    self._insert_completed_report(conn, *report[:4], request_id=request_id, content_key=report[4])
+                    for report in reports
+                ]
+            METRICS.observe('db_write_duration_seconds', time.perf_counter() - started, 'completed_reports_batch')
+            METRICS.inc('db_writes_total', 'completed_reports_batch', 'success')
+            self.notifications.wake()
+            print(f"✅ {len(reports)} completed reports stored in database")
+            return statuses
+            
+        except Exception as e:
+            METRICS.inc('db_writes_total', 'completed_reports_batch', 'failure')
+            print(f"❌ Error storing completed reports: {e}")
+            return None
+
+    def validate_submission(self, patient_data, test_results):
+        """Check a report submission; returns an error message or None"""
+        # Validate required fields
+        required_fields = ['name', 'age', 'gender', 'mobile']
+        for field in required_fields:
+            if not patient_data.get(field):
+                return f'Missing required field: {field}'
+        
+        unknown_tests = [test_name for test_name in test_results if test_name not in TEST_CATALOG]
+        if unknown_tests:
+            return f"Unknown test: {', '.join(unknown_tests)}"
+        return None
 
     def validate_mobile_number(self, mobile_number):
         """Validate and format mobile number"""
@@ -1624,50 +4840,45 @@ class PathologyTestsForm(tk.Tk):
         except Exception as e:
             return None, f"Mobile validation error: {str(e)}"
 
-    def send_whatsapp_direct(self, mobile_number, patient_data, pdf_url):
-        """Send WhatsApp message directly using multiple methods"""
-        try:
-            # Validate and format mobile number
-            formatted_mobile, mobile_error = self.validate_mobile_number(mobile_number)
-            if mobile_error:
-                return False, f"Mobile number error: {mobile_error}"
-            
-            print(f"📱 Attempting to send WhatsApp to: {formatted_mobile}")
-            
-            # Method 1: WhatsApp Business API
-            api_success, api_message = self.send_whatsapp_api(formatted_mobile, patient_data, pdf_url)
-            if api_success:
-                return True, api_message
-            
+    def whatsapp_api_configured(self):
+        # You need to get these from Facebook Developer Portal
+        return (self.whatsapp_phone_number_id != "YOUR_PHONE_NUMBER_ID" and
+                self.whatsapp_access_token != "YOUR_ACCESS_TOKEN")
+
+    def notification_provider(self):
+        """Provider new WhatsApp notifications are queued for"""
+        return 'whatsapp_api' if self.whatsapp_api_configured() else 'whatsapp_web'
+
+    def deliver_notification(self, provider, mobile_number, payload):
+        """Send one queued notification; returns (success, message, retryable)"""
+        patient_data = payload.get('patient_data', {})
+        pdf_url = payload.get('pdf_url', '')
+        print(f"📱 Attempting to send WhatsApp to: {mobile_number} via {provider}")
+        
+        # Method 1: WhatsApp Business API
+        if provider == 'whatsapp_api':
+            api_success, api_message = self.send_whatsapp_api(mobile_number, patient_data, pdf_url)
+            return api_success, api_message, True
+        
+        if provider == 'whatsapp_web':
             # Method 2: WhatsApp Web (Manual)
-            web_success, web_message = self.send_whatsapp_web(formatted_mobile, patient_data, pdf_url)
+            web_success, web_message = self.send_whatsapp_web(mobile_number, patient_data, pdf_url)
             if web_success:
-                return True, web_message
+                return True, web_message, False
             
             # Method 3: Simple SMS-style message (fallback)
-            return self.send_simple_message(formatted_mobile, patient_data, pdf_url)
-            
-        except Exception as e:
-            error_msg = f"WhatsApp sending failed: {str(e)}"
-            print(f"❌ {error_msg}")
-            return False, error_msg
+            simple_success, simple_message = self.send_simple_message(mobile_number, patient_data, pdf_url)
+            return simple_success, simple_message, False
+        
+        return False, f"Unknown notification provider: {provider}", False
 
     def send_whatsapp_api(self, mobile_number, patient_data, pdf_url):
         """Send WhatsApp using WhatsApp Business API"""
         try:
             # This requires WhatsApp Business API setup
-            # You need to get these from Facebook Developer Portal
-            if (self.whatsapp_phone_number_id == "YOUR_PHONE_NUMBER_ID" or 
-                self.whatsapp_access_token == "YOUR_ACCESS_TOKEN"):
+            if not self.whatsapp_api_configured():
                 return False, "WhatsApp Business API not configured"
             
-            url = f"{self.whatsapp_api_url}{self.whatsapp_phone_number_id}/messages"
-            
-            headers = {
-                "Authorization": f"Bearer {self.whatsapp_access_token}",
-                "Content-Type": "application/json"
-            }
-            
             message_body = self.create_whatsapp_message(patient_data, pdf_url)
             
             payload = {
@@ -1679,17 +4890,66 @@ class PathologyTestsForm(tk.Tk):
                 }
             }
             
-            response = requests.post(url, json=payload, headers=headers)
-            
-            if response.status_code == 200:
-                print("✅ WhatsApp message sent via API!")
-                return True, "WhatsApp message sent via Business API"
-            else:
-                return False, f"API Error: {response.status_code} - {response.text}"
+            return self.post_whatsapp_message(payload)
                 
         except Exception as e:
             return False, f"API method failed: {str(e)}"
 
+    def send_whatsapp_template(self, mobile_number, patient_data, pdf_url):
+        """Send the pre-registered report template; only its parameters change per patient"""
+        try:
+            if not self.whatsapp_api_configured():
+                return False, "WhatsApp Business API not configured"
+            
+            values = dict(patient_data, pdf_url=pdf_url)
+            payload = {
+                "messaging_product": "whatsapp",
+                "to": mobile_number,
+                "type": "template",
+                "template": {
+                    "name": self.whatsapp_template_name,
+                    "language": {"code": self.whatsapp_template_language},
+                    "components": [{
+                        "type": "body",
+                        "parameters": [
+                            {"type": "text", "text": str(values.get(name) or '-')}
+                            for name in WHATSAPP_TEMPLATE_PARAMETERS
+                        ]
+                    }]
+                }
+            }
+            
+            return self.post_whatsapp_message(payload)
+            
+        except Exception as e:
+            return False, f"Template method failed: {str(e)}"
+
+    def post_whatsapp_message(self, payload):
+        """POST a message payload to the Business API; returns (success, message)"""
+        url = f"{self.whatsapp_api_url}{self.whatsapp_phone_number_id}/messages"
+        
+        headers = {
+            "Authorization": f"Bearer {self.whatsapp_access_token}",
+            "Content-Type": "application/json"
+        }
+        
+        response = self.messaging.post('whatsapp_api', url, json=payload, headers=headers)
+        
+        if response.status_code == 200:
+            print("✅ WhatsApp message sent via API!")
+            return True, "WhatsApp message sent via Business API"
+        else:
+            return False, f"API Error: {response.status_code} - {response.text}"
+
+    def deliver_template_notification(self, provider, mobile_number, payload):
+        """deliver_notification for bulk sends: the API gets the template message"""
+        if provider != 'whatsapp_api':
+            return self.deliver_notification(provider, mobile_number, payload)
+        success, message = self.send_whatsapp_template(
+            mobile_number, payload.get('patient_data', {}), payload.get('pdf_url', '')
+        )
+        return success, message, True
+
     def send_whatsapp_web(self, mobile_number, patient_data, pdf_url):
         """Send WhatsApp using WhatsApp Web (opens browser)"""
         try:
@@ -1697,6 +4957,7 @@ class PathologyTestsForm(tk.Tk):
             
             # URL encode the message
             import urllib.parse
+            import webbrowser
             encoded_message = urllib.parse.quote(message_body)
             
             # Create WhatsApp Web URL
@@ -1723,13 +4984,14 @@ class PathologyTestsForm(tk.Tk):
             print(f"📄 Report URL that will be sent to patient: {pdf_url}")
             print("\n✅ The patient can click this link to view/download their report.")
             
-            # Show message box with the URL
-            messagebox.showinfo("Report Ready", 
-                f"Report generated successfully!\n\n"
-                f"Patient: {patient_data.get('name', '')}\n"
-                f"Mobile: {mobile_number}\n\n"
-                f"Report URL:\n{pdf_url}\n\n"
-                f"Copy this URL and send it to the patient via WhatsApp or SMS.")
+            # Show message box with the URL when the launcher window is open
+            if self.on_manual_message:
+                self.on_manual_message("Report Ready", 
+                    f"Report generated successfully!\n\n"
+                    f"Patient: {patient_data.get('name', '')}\n"
+                    f"Mobile: {mobile_number}\n\n"
+                    f"Report URL:\n{pdf_url}\n\n"
+                    f"Copy this URL and send it to the patient via WhatsApp or SMS.")
             
             return True, f"Message prepared. URL: {pdf_url}"
             
@@ -1772,10 +5034,6 @@ Thank you for choosing UJJIVAN Hospital.
     def send_sms_fast2sms(self, mobile_number, message):
         """Example SMS integration with Fast2SMS"""
         try:
-            # You need to sign up at https://www.fast2sms.com/
-            api_key = "YOUR_FAST2SMS_API_KEY"
-            url = "https://www.fast2sms.com/dev/bulkV2"
-            
             payload = {
                 "message": message,
                 "language": "english",
@@ -1784,12 +5042,12 @@ Thank you for choosing UJJIVAN Hospital.
             }
             
             headers = {
-                'authorization': api_key,
+                'authorization': self.fast2sms_api_key,
                 'Content-Type': "application/x-www-form-urlencoded",
                 'Cache-Control': "no-cache"
             }
             
-            response = requests.post(url, data=payload, headers=headers)
+            response = self.messaging.post('fast2sms', self.fast2sms_url, data=payload, headers=headers)
             
             if response.status_code == 200:
                 return True, "SMS sent via Fast2SMS"
@@ -1799,6 +5057,167 @@ Thank you for choosing UJJIVAN Hospital.
         except Exception as e:
             return False, f"SMS method failed: {str(e)}"
 
+
+class PathologyTestsForm:
+    """Tk launcher window for the desktop install; the web app runs in the background"""
+
+    def __init__(self, service=None, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        # Tk is only needed here, so headless servers never import it
+        import tkinter as tk
+        from tkinter import messagebox
+        self.messagebox = messagebox
+        
+        self.service = service or PathologyService()
+        self.service.start_server(host, port)
+        self.flask_url = f"http://localhost:{port}/"
+        
+        self.root = tk.Tk()
+        self.root.title("UJJIVAN Hospital Pathology System Launcher")
+        self.root.geometry("600x400")
+        self.root.configure(bg="#f0e1c6")
+        
+        # Notification workers run off the Tk thread; show their message boxes from the main loop
+        self.service.on_manual_message = lambda title, text: self.root.after(
+            0, lambda: messagebox.showinfo(title, text)
+        )
+        
+        # Main title
+        title_label = tk.Label(self.root, text="UJJIVAN HOSPITAL PATHOLOGY SYSTEM", 
+                              font=("Arial", 20, "bold"), bg="#f0e1c6", fg="#003366")
+        title_label.pack(pady=(20,10))
+        
+        subtitle_label = tk.Label(self.root, text="Vidyut Nagar, Gautam Budh Nagar, Uttar Pradesh - 201008", 
+                                 font=("Arial", 12), bg="#f0e1c6")
+        subtitle_label.pack(pady=(0,20))
+
+        # Info text
+        info_label = tk.Label(self.root, text="This system will open in your web browser\nwhere you can fill patient information and select tests", 
+                             font=("Arial", 12), bg="#f0e1c6", justify=tk.CENTER)
+        info_label.pack(pady=(0,30))
+
+        # Launch button
+        launch_btn = tk.Button(self.root, text="🚀 Launch Web Application", 
+                              fg="white", bg="#28a745", font=("Arial", 16, "bold"), 
+                              command=self.launch_web_app, height=3, width=25)
+        launch_btn.pack(pady=(0, 20))
+
+        # Status label
+        self.status_label = tk.Label(self.root, text="Ready to launch...", 
+                                   font=("Arial", 10), bg="#f0e1c6", fg="#666")
+        self.status_label.pack(pady=(10,5))
+
+    def launch_web_app(self):
+        """Launch the web application in browser"""
+        import webbrowser
+        self.status_label.config(text="Opening web application...")
+        
+        webbrowser.open(self.flask_url)
+        
+        self.status_label.config(text="Web application opened in browser!")
+        self.messagebox.showinfo("Success", f"Web application opened in browser!\n\nIf it doesn't load automatically, visit:\n{self.flask_url}")
+
+    def mainloop(self):
+        try:
+            self.root.mainloop()
+        finally:
+            self.service.close()
+
+
+def create_app():
+    """Build the web app without any GUI, e.g. for gunicorn 'single_app:create_app()'"""
+    return PathologyService().flask_app
+
+
+def notify_ready():
+    """Tell systemd (Type=notify) that the server accepts connections"""
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return
+    if address.startswith('@'):
+        # Abstract namespace socket
+        address = '\0' + address[1:]
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.connect(address)
+        sock.sendall(b'READY=1')
+
+
+def serve(host, port):
+    """Run the web app in the foreground without Tk until interrupted"""
+    from werkzeug.serving import make_server
+    service = PathologyService()
+    server = make_server(host, port, service.flask_app, threaded=True)
+    service.trust_loopback = True
+    print(f"🚀 Serving on http://{host}:{port}")
+    notify_ready()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("🛑 Shutting down")
+    finally:
+        server.server_close()
+        service.close()
+
+
+def export(fmt, date_from=None, date_to=None, output=None, batch_size=EXPORT_BATCH_SIZE):
+    """Write an export straight from the database, without starting the app"""
+    db = SQLiteConnectionPool(DB_PATH, size=1)
+    try:
+        # The database may not have been opened by this version of the app yet
+        with db.transaction() as conn:
+            PathologyService.create_tables(conn)
+        chunks = export_completed_reports(db, fmt, date_from, date_to, batch_size)
+        if output:
+            with open(output, 'w', encoding='utf-8', newline='') as f:
+                f.writelines(chunks)
+            print(f"📤 Export written to {output}", file=sys.stderr)
+        else:
+            sys.stdout.writelines(chunks)
+    finally:
+        db.close()
+
+
+def import_results(path, fmt=None, batch_size=IMPORT_BATCH_SIZE):
+    """Import an analyzer file; the WhatsApp messages stay queued for the running server if not sent here"""
+    service = PathologyService()
+    try:
+        with open(path, encoding='utf-8-sig', errors='replace', newline=None) as f:
+            summary = service.import_analyzer_results(f, fmt, batch_size)
+        print(json.dumps(summary, indent=2))
+        return summary['success']
+    finally:
+        service.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="UJJIVAN Hospital Pathology System")
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('launcher', help="open the Tk launcher window (default)")
+    serve_parser = commands.add_parser('serve', help="run the web app headless, without Tk")
+    serve_parser.add_argument('--host', default=os.environ.get('HOST', DEFAULT_HOST))
+    serve_parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', DEFAULT_PORT)))
+    export_parser = commands.add_parser('export', help="write completed reports, one line per test")
+    export_parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+    export_parser.add_argument('--from', dest='date_from', type=_export_date, help="first report date, YYYY-MM-DD")
+    export_parser.add_argument('--to', dest='date_to', type=_export_date, help="report date to stop before, YYYY-MM-DD")
+    export_parser.add_argument('--output', '-o', help="file to write (default: stdout)")
+    export_parser.add_argument('--batch-size', type=int, default=EXPORT_BATCH_SIZE)
+    import_parser = commands.add_parser('import-results', help="create reports from an analyzer CSV or HL7 file")
+    import_parser.add_argument('path')
+    import_parser.add_argument('--format', choices=IMPORT_FORMATS, help="default: HL7 if the file starts with MSH")
+    import_parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+    args = parser.parse_args(argv)
+    
+    if args.command == 'serve':
+        serve(args.host, args.port)
+    elif args.command == 'export':
+        export(args.format, args.date_from, args.date_to, args.output, args.batch_size)
+    elif args.command == 'import-results':
+        sys.exit(0 if import_results(args.path, args.format, args.batch_size) else 1)
+    else:
+        PathologyTestsForm(
+            host=os.environ.get('HOST', DEFAULT_HOST), port=int(os.environ.get('PORT', DEFAULT_PORT))
+        ).mainloop()
+
+
 if __name__ == "__main__":
-    app = PathologyTestsForm()
-    app.mainloop()
\ No newline at end of file
+    main()
\ No newline at end of file
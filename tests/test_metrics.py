@@ -0,0 +1,41 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import single_app  # noqa: E402
+
+
+def worker_registry(directory):
+    """A registry standing in for one web server process"""
+    registry = single_app.MetricsRegistry()
+    registry.counter('http_requests_total', "HTTP requests", ('route',))
+    registry.histogram('http_request_duration_seconds', "Time to answer HTTP requests", ('route',))
+    registry.share(str(directory))
+    return registry
+
+
+def test_scrape_sums_every_process_sharing_the_directory(tmp_path):
+    first, second = worker_registry(tmp_path), worker_registry(tmp_path)
+    first.inc('http_requests_total', '/healthz', amount=2)
+    second.inc('http_requests_total', '/healthz', amount=3)
+    second.observe('http_request_duration_seconds', 0.02, '/healthz')
+    second.publish()
+
+    text = first.render()
+
+    assert 'http_requests_total{route="/healthz"} 5' in text
+    assert 'http_request_duration_seconds_count{route="/healthz"} 1' in text
+
+
+def test_counters_of_a_retired_process_stay_in_the_sum(tmp_path):
+    first, second = worker_registry(tmp_path), worker_registry(tmp_path)
+    first.inc('http_requests_total', '/healthz')
+    second.inc('http_requests_total', '/healthz', amount=4)
+    first.publish()
+
+    second.retire()
+    third = worker_registry(tmp_path)
+
+    assert 'http_requests_total{route="/healthz"} 5' in third.render()
+    assert sorted(name for name in os.listdir(tmp_path) if name.endswith('.json'))[-1] == 'retired.json'
+    assert len([name for name in os.listdir(tmp_path) if name.endswith('.json')]) == 3
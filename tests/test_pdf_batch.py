@@ -0,0 +1,36 @@
+import os
+import subprocess
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import single_app  # noqa: E402
+
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason="fake wkhtmltopdf is a shell script")
+
+
+def fake_wkhtmltopdf(tmp_path, script):
+    """A pdfkit configuration whose wkhtmltopdf runs the given shell script"""
+    path = tmp_path / 'wkhtmltopdf'
+    path.write_text('#!/bin/sh\n' + script)
+    path.chmod(0o755)
+    return types.SimpleNamespace(wkhtmltopdf=str(path))
+
+
+def test_batch_raises_when_wkhtmltopdf_fails(tmp_path):
+    config = fake_wkhtmltopdf(tmp_path, 'echo "Exit with code 1 due to network error" >&2\nexit 1\n')
+
+    with pytest.raises(RuntimeError, match='code 1'):
+        single_app._render_pdfkit_batch(config, ['<p>one</p>', '<p>two</p>'])
+
+
+def test_batch_is_killed_after_its_timeout(tmp_path, monkeypatch):
+    monkeypatch.setattr(single_app, 'PDFKIT_BATCH_TIMEOUT', 0)
+    monkeypatch.setattr(single_app, 'PDFKIT_BATCH_SECONDS_PER_DOCUMENT', 0.1)
+    config = fake_wkhtmltopdf(tmp_path, 'exec sleep 30\n')
+
+    with pytest.raises(subprocess.TimeoutExpired):
+        single_app._render_pdfkit_batch(config, ['<p>one</p>', '<p>two</p>'])
@@ -0,0 +1,116 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import single_app  # noqa: E402
+
+
+REPORT = {
+    'patient_data': {
+        'name': 'Test Patient',
+        'age': '42',
+        'gender': 'Female',
+        'mobile': '9876543210',
+        'doctor': 'Dr. Test',
+        'opd_no': '12345',
+        'sample_date': '2026-10-18'
+    },
+    'test_results': {'Haemoglobin': '13.2', 'Urea': '31'}
+}
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    """A service with its database and report store in a temporary directory"""
+    monkeypatch.chdir(tmp_path)
+    # Render inside the request and send messages to the local fake provider
+    monkeypatch.setenv('PDF_RENDER_WORKERS', '0')
+    monkeypatch.setenv('MESSAGING_MOCK', '1')
+    service = single_app.PathologyService()
+    # No PDF backend may be installed; a rendered PDF is what the render cache reuses
+    monkeypatch.setattr(service, 'generate_pdf_bytes', lambda html_content, attempts=None: (True, b'%PDF-1.4 test'))
+    yield service
+    service.close()
+    # Let in-flight sends finish before the next test changes directory
+    for thread in service.notifications.threads:
+        thread.join(timeout=5)
+
+
+def count_rows(table):
+    with sqlite3.connect(single_app.DB_PATH) as conn:
+        return conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+
+
+def test_resubmitted_report_is_stored_and_queued_once(service):
+    client = service.flask_app.test_client()
+
+    first = client.post('/submit-report', json=REPORT).get_json()
+    second = client.post('/submit-report', json=REPORT).get_json()
+
+    assert first['success'] and second['success']
+    assert first['whatsapp_message'] == 'WhatsApp message queued for delivery'
+    assert 'not sent again' in second['whatsapp_message']
+    assert count_rows('completed_reports') == 1
+    assert count_rows('notification_queue') == 1
+
+
+def test_batch_larger_than_a_store_chunk_is_stored_in_full(service):
+    client = service.flask_app.test_client()
+    reports = []
+    for number in range(single_app.BATCH_STORE_CHUNK * 2 + 3):
+        report = {'patient_data': dict(REPORT['patient_data'], opd_no=str(20000 + number)),
+                  'test_results': REPORT['test_results']}
+        reports.append(report)
+
+    response = client.post('/submit-reports', json={'reports': reports}).get_json()
+
+    assert response['success']
+    assert [result['index'] for result in response['results']] == list(range(len(reports)))
+    assert all(result['success'] for result in response['results'])
+    assert count_rows('completed_reports') == len(reports)
+    assert count_rows('notification_queue') == len(reports)
+
+
+def test_trend_requires_admin(service, monkeypatch):
+    monkeypatch.setattr(service, 'admin_token', 'secret')
+    client = service.flask_app.test_client()
+    client.post('/submit-report', json=REPORT)
+    query = {'mobile': REPORT['patient_data']['mobile'], 'test': 'Haemoglobin'}
+
+    assert client.get('/reports/trend', query_string=query).status_code == 403
+    response = client.get('/reports/trend', query_string=query, headers={'X-Admin-Token': 'secret'})
+    assert response.status_code == 200
+
+
+def test_admin_endpoints_fail_closed_without_token_outside_builtin_server(service):
+    client = service.flask_app.test_client()
+
+    # Behind gunicorn or a proxy every request comes from loopback
+    assert client.get('/reports', environ_base={'REMOTE_ADDR': '127.0.0.1'}).status_code == 403
+    service.trust_loopback = True
+    assert client.get('/reports', environ_base={'REMOTE_ADDR': '127.0.0.1'}).status_code == 200
+    assert client.get('/reports', environ_base={'REMOTE_ADDR': '10.0.0.7'}).status_code == 403
+
+
+def test_trace_requires_admin(service, monkeypatch):
+    monkeypatch.setattr(service, 'admin_token', 'secret')
+    client = service.flask_app.test_client()
+    request_id = client.post('/submit-report', json=REPORT).headers['X-Request-ID']
+
+    assert client.get(f'/debug/trace/{request_id}').status_code == 403
+    response = client.get(f'/debug/trace/{request_id}', headers={'X-Admin-Token': 'secret'})
+    assert response.status_code == 200
+    assert response.get_json()['spans']
+
+
+def test_profile_limit_must_be_a_number(service, monkeypatch):
+    monkeypatch.setattr(service, 'admin_token', 'secret')
+    client = service.flask_app.test_client()
+    admin = {'X-Admin-Token': 'secret'}
+    profile_url = client.get('/healthz', headers=dict(admin, **{'X-Profile': '1'})).headers['X-Profile']
+
+    assert client.get(profile_url, query_string={'limit': 'abc'}, headers=admin).status_code == 400
+    assert client.get(profile_url, query_string={'limit': '-5'}, headers=admin).status_code == 200